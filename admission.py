@@ -0,0 +1,170 @@
+"""Admission control for the write routes.
+
+Borrows, returns and book imports all need SQLite's single write lock, so past a handful of
+concurrent writers extra requests only wait inside the busy handler and drag every writer's
+latency up with them. `AdmissionMiddleware` caps how many requests of a route group run at
+once. A bounded number more wait, oldest first, for up to the group's timeout, and the rest
+get an immediate 503 with `Retry-After` so clients back off instead of piling on.
+
+Limits are per process and read from ADMISSION_<GROUP>_LIMIT, _QUEUE and _TIMEOUT; a limit of
+0 turns a group off. In-flight requests, queue depth and shed requests are exported on /metrics.
+"""
+import asyncio
+import os
+from collections import defaultdict, deque
+from typing import List, Optional, Tuple
+from starlette.responses import JSONResponse
+from metrics import escape
+
+RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 1))
+
+
+class AdmissionGroup:
+    """Concurrency limit with a bounded FIFO wait queue.
+
+    Everything runs on the event loop, so the counters need no lock. A released slot is handed
+    straight to the oldest waiter, so a new arrival can't overtake the queue.
+    """
+
+    def __init__(self, name: str, routes: List[Tuple[str, str]], limit: int, queue_size: int, timeout: float):
+        self.name = name
+        self.routes = routes  # (method, path prefix) pairs
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.admitted = 0
+        self.shed = defaultdict(int)  # reason -> requests answered with 503
+        self._waiters = deque()
+
+    @classmethod
+    def from_env(cls, name: str, routes, limit: int, queue_size: int, timeout: float, environ=os.environ):
+        """Reads ADMISSION_<NAME>_LIMIT, _QUEUE and _TIMEOUT, falling back to the given defaults"""
+        prefix = f"ADMISSION_{name.upper()}"
+        return cls(
+            name,
+            routes,
+            limit=int(environ.get(f"{prefix}_LIMIT", limit)),
+            queue_size=int(environ.get(f"{prefix}_QUEUE", queue_size)),
+            timeout=float(environ.get(f"{prefix}_TIMEOUT", timeout)),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit > 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def matches(self, method: str, path: str) -> bool:
+        return any(method == route_method and path.startswith(prefix) for route_method, prefix in self.routes)
+
+    async def acquire(self) -> bool:
+        """Waits for a slot; False means the request should be shed"""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            self.shed["queue_full"] += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait((waiter,), timeout=self.timeout)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        if waiter.done():
+            self.admitted += 1
+            return True
+        self._abandon(waiter)
+        self.shed["timeout"] += 1
+        return False
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def _abandon(self, waiter):
+        if waiter.done():
+            # the slot was handed over just as the wait ended
+            self.release()
+        else:
+            waiter.cancel()
+            self._waiters.remove(waiter)
+
+
+class AdmissionController:
+    def __init__(self, groups: List[AdmissionGroup]):
+        self.groups = groups
+
+    def group_for(self, method: str, path: str) -> Optional[AdmissionGroup]:
+        return next((group for group in self.groups if group.enabled and group.matches(method, path)), None)
+
+    def render(self) -> str:
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name, kind, attribute, help_text in (
+            ("admission_in_flight", "gauge", "active", "Requests running inside an admission group."),
+            ("admission_queue_depth", "gauge", "queue_depth", "Requests waiting for an admission slot."),
+            ("admission_admitted_total", "counter", "admitted", "Requests admitted to an admission group."),
+        ):
+            family(name, kind, help_text)
+            for group in self.groups:
+                lines.append(f'{name}{{group="{escape(group.name)}"}} {getattr(group, attribute)}')
+
+        family("admission_shed_total", "counter", "Requests answered with 503, by reason.")
+        for group in self.groups:
+            for reason in ("queue_full", "timeout"):
+                lines.append(f'admission_shed_total{{group="{escape(group.name)}",reason="{reason}"}} {group.shed[reason]}')
+        return "\n".join(lines) + "\n"
+
+
+# paths as main.py mounts them
+admission_controller = AdmissionController([
+    AdmissionGroup.from_env(
+        "circulation",
+        [("POST", "/api/borrow/"), ("POST", "/api/return/"), ("POST", "/api/circulation/batch")],
+        limit=4, queue_size=32, timeout=2.0,
+    ),
+    AdmissionGroup.from_env("books", [("POST", "/api/books/")], limit=2, queue_size=8, timeout=5.0),
+])
+
+
+class AdmissionMiddleware:
+    """ASGI middleware that runs write requests through their `AdmissionGroup`"""
+
+    def __init__(self, app, controller: AdmissionController = admission_controller, retry_after: int = RETRY_AFTER):
+        self.app = app
+        self.controller = controller
+        self.retry_after = retry_after
+
+    async def __call__(self, scope, receive, send):
+        group = self.controller.group_for(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if group is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await group.acquire():
+            response = JSONResponse(
+                {"detail": "Too many concurrent writes, retry later"},
+                status_code=503,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            group.release()
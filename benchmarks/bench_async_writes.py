@@ -0,0 +1,134 @@
+"""Throughput of parallel clients mixing writes and reads, blocking vs async sessions.
+
+`before` replays the pre-async handler (blocking `Session` calls inside `async def`),
+`after` is the app as shipped. Both use the SQLITE_* settings from the environment.
+Run with `python -m benchmarks.bench_async_writes`.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from dataclasses import replace
+from pathlib import Path
+
+import httpx
+from fastapi import APIRouter, Depends, FastAPI, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+from database import (
+    Base, DatabaseSettings, create_async_db_engine, create_db_engine, create_read_db_engine, get_async_db, get_db,
+    get_read_only_db,
+)
+from migrations import migrate
+from models import Genre
+from routes import genre
+from schemas import GenreCreate
+
+legacy_router = APIRouter()
+
+
+@legacy_router.post("/genres/", response_model=GenreCreate)
+async def create_genre_blocking(genre: GenreCreate, db: Session = Depends(get_db)):
+    if db.query(Genre).filter(Genre.name == genre.name).first():
+        raise HTTPException(status_code=400, detail="Publisher already exist")
+
+    new_genre = Genre(name=genre.name)
+    db.add(new_genre)
+    db.commit()
+    db.refresh(new_genre)
+    return new_genre
+
+
+def build_app(mode: str, database_path: Path, clients: int) -> FastAPI:
+    # a blocked event loop cannot hand pooled connections back, so size pools for every client
+    settings = DatabaseSettings.from_env({**os.environ, "DATABASE_URL": f"sqlite:///{database_path}"})
+    settings = replace(settings, pool_size=max(settings.pool_size, clients * 2))
+    engine = create_db_engine(settings)
+    async_engine = create_async_db_engine(settings)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    migrate(engine)
+    read_engine = create_read_db_engine(settings)
+
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    read_session_factory = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+    async_session_factory = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+    def override_get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def override_get_async_db():
+        async with async_session_factory() as db:
+            yield db
+
+    def override_get_read_only_db():
+        db = read_session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app = FastAPI()
+    if mode == "before":
+        app.include_router(legacy_router, prefix="/api")
+    app.include_router(genre.router, prefix="/api")
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    app.dependency_overrides[get_read_only_db] = override_get_read_only_db
+    return app
+
+
+async def run_client(client: httpx.AsyncClient, client_id: int, requests: int, read_latencies: list):
+    for i in range(requests):
+        if i % 2:
+            started = time.perf_counter()
+            response = await client.get("/api/genres/")
+            read_latencies.append(time.perf_counter() - started)
+        else:
+            response = await client.post("/api/genres/", json={"name": f"genre-{client_id}-{i}"})
+        response.raise_for_status()
+
+
+async def measure(mode: str, clients: int, requests: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        app = build_app(mode, Path(directory) / "bench.db", clients)
+        transport = httpx.ASGITransport(app=app)
+        read_latencies = []
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(run_client(client, c, requests, read_latencies) for c in range(clients)))
+            elapsed = time.perf_counter() - started
+
+    read_latencies.sort()
+    return {
+        "mode": mode,
+        "requests_per_second": clients * requests / elapsed,
+        "read_p50_ms": statistics.median(read_latencies) * 1000,
+        "read_p95_ms": read_latencies[int(len(read_latencies) * 0.95)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=50, help="requests per client")
+    args = parser.parse_args()
+
+    for mode in ("before", "after"):
+        result = asyncio.run(measure(mode, args.clients, args.requests))
+        print(
+            f"{result['mode']:>6}: {result['requests_per_second']:8.1f} req/s  "
+            f"read p50 {result['read_p50_ms']:7.2f} ms  p95 {result['read_p95_ms']:7.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Filtered GET /books queries with and without the list indexes, and genre filter strategies.
+
+Run with `python -m benchmarks.bench_book_filters --scale 1m`.
+"""
+import argparse
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy import asc, distinct, exists, select, text
+
+from benchmarks.datagen import SCALES, dataset, scale_books
+from database import DatabaseSettings, create_db_engine
+from loaders import book_rows_query
+from migrations import migrate
+from models import Book, book_genre_association
+from routes.book import book_filters
+
+LIST_INDEXES = ("ix_books_publish_date", "ix_books_title")
+
+CASES = [
+    ("genre", {"genre_ids": [7, 9]}, "id"),
+    ("genre, sorted by title", {"genre_ids": [7, 9]}, "title"),
+    ("all genres", {"genre_ids": [7, 9], "genre_match": "all"}, "id"),
+    ("author + genre", {"author_id": 4242, "genre_ids": [7]}, "id"),
+    ("publisher + date range", {"publisher_id": 17, "published_since": datetime(1990, 1, 1),
+                                "published_before": datetime(2000, 1, 1)}, "id"),
+    ("date range", {"published_since": datetime(1990, 1, 1), "published_before": datetime(1990, 2, 1)}, "id"),
+    ("date range, sorted by date", {"published_since": datetime(1990, 1, 1),
+                                    "published_before": datetime(1990, 2, 1)}, "publish_date"),
+    ("genre + date range", {"genre_ids": [7], "published_since": datetime(1990, 1, 1),
+                            "published_before": datetime(1991, 1, 1)}, "id"),
+]
+
+
+def filtered_query(filters: dict, sort_by: str, limit: int):
+    filters = {"genre_ids": [], "genre_match": "any", "author_id": None, "publisher_id": None,
+               "published_since": None, "published_before": None, **filters}
+    sort_key = (Book.id,) if sort_by == "id" else (getattr(Book, sort_by), Book.id)
+    return book_rows_query().where(*book_filters(**filters)).order_by(*map(asc, sort_key)).limit(limit)
+
+
+def genre_strategies(genre_ids):
+    """The same genre filter written as EXISTS (shipped), IN (semi-join) and JOIN + DISTINCT"""
+    link = book_genre_association.c
+    return {
+        "exists": select(Book.id).where(
+            exists().where(link.book_id == Book.id, link.genre_id.in_(genre_ids))
+        ),
+        "in": select(Book.id).where(Book.id.in_(select(link.book_id).where(link.genre_id.in_(genre_ids)))),
+        "join distinct": select(distinct(Book.id)).join(book_genre_association, link.book_id == Book.id)
+        .where(link.genre_id.in_(genre_ids)),
+    }
+
+
+def timed(conn, statement, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(statement).all()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", default="1m", help=f"one of {', '.join(SCALES)} or a book count")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--data-dir", type=Path, default=Path(".bench-data"))
+    args = parser.parse_args()
+
+    source = dataset(scale_books(args.scale), args.data_dir)
+    with tempfile.TemporaryDirectory() as directory:
+        working_copy = Path(directory) / "filters.db"
+        shutil.copyfile(source, working_copy)
+        engine = create_db_engine(DatabaseSettings(url=f"sqlite:///{working_copy}"))
+        migrate(engine)
+
+        with engine.connect() as conn:
+            with_indexes = {name: timed(conn, filtered_query(filters, sort_by, args.limit), args.repeat)
+                            for name, filters, sort_by in CASES}
+            for index in LIST_INDEXES:
+                conn.execute(text(f"DROP INDEX {index}"))
+            without_indexes = {name: timed(conn, filtered_query(filters, sort_by, args.limit), args.repeat)
+                               for name, filters, sort_by in CASES}
+            conn.commit()
+
+            print(f"{'':>28}  {'without':>10}  {'with indexes':>12}")
+            for name, _, _ in CASES:
+                print(f"{name:>28}: {without_indexes[name]:7.2f} ms  {with_indexes[name]:9.2f} ms")
+
+            print("\ngenre filter strategies (ORDER BY id LIMIT)")
+            for name, statement in genre_strategies([7, 9]).items():
+                first_page = timed(conn, statement.order_by(Book.id).limit(args.limit), args.repeat)
+                deep_page = timed(conn, statement.order_by(Book.id).limit(args.limit).offset(10000), args.repeat)
+                print(f"{name:>28}: first page {first_page:8.2f} ms  offset 10000 {deep_page:8.2f} ms")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
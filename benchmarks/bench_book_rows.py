@@ -0,0 +1,71 @@
+"""Per-row cost of a GET /books page: ORM + BookResponse + json vs Core rows + orjson.
+
+Run with `python -m benchmarks.bench_book_rows --books 10000 --page 100`.
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+from pydantic import TypeAdapter
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from benchmarks.datagen import generate
+from database import DatabaseSettings, create_db_engine
+from loaders import book_load_options, book_rows_query, book_rows_to_dicts
+from models import Book
+from responses import UTCORJSONResponse
+from schemas import BookResponse
+
+BOOK_LIST_ADAPTER = TypeAdapter(List[BookResponse])
+
+
+def orm_page(session: Session, offset: int, page: int) -> bytes:
+    """What GET /books did before: ORM instances, response_model validation, stdlib json"""
+    books = session.scalars(
+        select(Book).join(Book.author).options(*book_load_options()).offset(offset).limit(page)
+    ).all()
+    content = BOOK_LIST_ADAPTER.dump_python(
+        BOOK_LIST_ADAPTER.validate_python(books, from_attributes=True), mode="json"
+    )
+    return json.dumps(content).encode()
+
+
+def rows_page(session: Session, offset: int, page: int) -> bytes:
+    rows = session.execute(book_rows_query().offset(offset).limit(page)).all()
+    return UTCORJSONResponse(book_rows_to_dicts(session, rows)).body
+
+
+def measure(engine, render, books: int, page: int) -> float:
+    rendered_rows = 0
+    started = time.perf_counter()
+    for offset in range(0, books, page):
+        # a fresh session per page, like a request, so the identity map does not carry over
+        with Session(engine) as session:
+            render(session, offset, page)
+        rendered_rows += min(page, books - offset)
+    return (time.perf_counter() - started) / rendered_rows * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--books", type=int, default=10000)
+    parser.add_argument("--page", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_db_engine(DatabaseSettings(url=f"sqlite:///{Path(directory) / 'rows.db'}"))
+        generate(engine, args.books)
+
+        assert json.loads(orm_page(Session(engine), 0, 5)) == json.loads(rows_page(Session(engine), 0, 5))
+
+        for name, render in (("orm", orm_page), ("rows", rows_page)):
+            print(f"{name:>5}: {measure(engine, render, args.books, args.page):7.1f} us/row")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""FTS5 search vs a `LIKE '%q%'` scan over book titles and author names.
+
+Run with `python -m benchmarks.bench_search --books 1000000`.
+"""
+import argparse
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+
+from benchmarks.datagen import RARE_WORD, generate
+from database import DatabaseSettings, create_db_engine
+from routes.book import fts_query
+
+FTS_SQL = text(
+    "SELECT rowid FROM book_search WHERE book_search MATCH :query"
+    " ORDER BY bm25(book_search, 2.0, 1.0), rowid LIMIT 10"
+)
+LIKE_SQL = text(
+    "SELECT books.id FROM books LEFT JOIN authors ON authors.id = books.author_id"
+    " WHERE books.title LIKE :pattern OR authors.name LIKE :pattern ORDER BY books.id LIMIT 10"
+)
+
+
+def timed(conn, statement, params, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(statement, params).all()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--books", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_db_engine(DatabaseSettings(url=f"sqlite:///{Path(directory) / 'search.db'}"))
+
+        started = time.perf_counter()
+        generate(engine, args.books)
+        print(f"seeded {args.books} books in {time.perf_counter() - started:.1f} s")
+
+        with engine.connect() as conn:
+            # common terms let LIKE stop after ten hits, rare ones force it through the whole table
+            for q in ("lantern", "falcon meadow", "mirr", RARE_WORD, "zephyr lantern", "ironson 4242"):
+                fts_ms = timed(conn, FTS_SQL, {"query": fts_query(q)}, args.repeat)
+                like_ms = timed(conn, LIKE_SQL, {"pattern": f"%{q}%"}, args.repeat)
+                print(f"{q!r:>16}: fts {fts_ms:9.2f} ms  like {like_ms:9.2f} ms")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Worker startup: schema work at import time vs the lifespan step and its skip mode.
+
+Each sample is a fresh interpreter importing `main` and starting the app against a copy of a
+benchmark dataset that is already migrated, which is what every worker restart sees.
+Run with `python -m benchmarks.bench_startup --scale 100k`.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from benchmarks.datagen import SCALES, dataset, scale_books
+from database import DatabaseSettings, create_db_engine
+from migrations import migrate
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# prints seconds spent importing the app and seconds spent starting it
+PROBE = """
+import asyncio, sys, time
+started = time.perf_counter()
+import database, main, migrations
+imported = time.perf_counter()
+if sys.argv[1] == "import-time":
+    # what `main` did on import before schema setup moved into the lifespan
+    database.Base.metadata.create_all(bind=database.engine)
+    migrations.migrate(database.engine)
+else:
+    async def start():
+        async with main.app.router.lifespan_context(main.app):
+            pass
+    asyncio.run(start())
+print(imported - started, time.perf_counter() - imported)
+"""
+
+MODES = {"import-time": "migrate", "lifespan": "migrate", "lifespan-skip": "skip"}
+
+
+def sample(mode: str, database_path: Path) -> tuple:
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{database_path}", "DATABASE_SCHEMA_SETUP": MODES[mode]}
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE, mode], env=env, cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    import_seconds, startup_seconds = map(float, result.stdout.split())
+    return import_seconds * 1000, startup_seconds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", default="1k", help=f"one of {', '.join(SCALES)} or a book count")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--data-dir", type=Path, default=Path(".bench-data"))
+    args = parser.parse_args()
+
+    source = dataset(scale_books(args.scale), args.data_dir, args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        working_copy = Path(directory) / "startup.db"
+        shutil.copyfile(source, working_copy)
+        engine = create_db_engine(DatabaseSettings(url=f"sqlite:///{working_copy}"))
+        migrate(engine)
+        engine.dispose()
+
+        for mode in MODES:
+            samples = [sample(mode, working_copy) for _ in range(args.repeat)]
+            import_ms = statistics.median(import_seconds for import_seconds, _ in samples)
+            startup_ms = statistics.median(startup_seconds for _, startup_seconds in samples)
+            print(f"{mode:>14}: import {import_ms:8.1f} ms  schema/startup {startup_ms:7.1f} ms"
+                  f"  total {import_ms + startup_ms:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Deterministic benchmark dataset: authors, publishers, genres, books and borrow history.
+
+The same `books` and `seed` always produce the same rows, so timings from different
+commits compare like for like. Rows are inserted into a schema built by `create_all`
+and the migrations run afterwards, which fills the derived state (active loans,
+search index, change counters) through the same backfills an upgraded database gets.
+
+Run `python -m benchmarks.datagen --scale 100k --data-dir .bench-data` to build a dataset up front.
+"""
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import text
+
+import models  # noqa: F401 - registers the tables on Base.metadata
+from database import Base, DatabaseSettings, create_db_engine
+from migrations import migrate
+from routes.borrow import MAX_BORROW_COUNT
+
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+
+# bump whenever the generated rows change, so cached datasets are rebuilt
+DATASET_VERSION = 1
+
+WORDS = (
+    "shadow river crown winter garden silent empire glass storm harbor iron forest "
+    "midnight ember paper orchard lantern summer mirror falcon copper meadow saint"
+).split()
+
+RARE_WORD = "zephyr"  # in one title per 10k books
+
+GENRES = 50
+CHUNK_SIZE = 50000
+HISTORY_START = datetime(2020, 1, 1)
+
+
+def scale_books(scale: str) -> int:
+    """Accepts a named scale (`1k`, `100k`, `1m`) or a plain book count"""
+    return SCALES[scale.lower()] if scale.lower() in SCALES else int(scale)
+
+
+def title(rng: random.Random, book_id: int) -> str:
+    words = rng.choices(WORDS, k=3)
+    if book_id % 10000 == 0:
+        words.append(RARE_WORD)
+    return " ".join(words).capitalize() + f" {book_id}"
+
+
+def timestamp(value: datetime) -> str:
+    # the format CURRENT_TIMESTAMP writes, so seeded rows sort and compare like live ones
+    return value.isoformat(sep=" ")
+
+
+def insert_chunked(conn, statement, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        conn.execute(text(statement), rows[start:start + CHUNK_SIZE])
+
+
+def history(rng: random.Random, books: int, events: int, users: int):
+    """Alternating borrows and returns, skewed so low book ids are the popular ones.
+
+    Returns (borrows, returns); books still out at the end keep an open borrow, and no
+    user ever holds more than MAX_BORROW_COUNT books at once.
+    """
+    borrows, returns = [], []
+    open_borrows = {}
+    user_loans = {}
+
+    for event in range(events):
+        created_at = timestamp(HISTORY_START + timedelta(minutes=event))
+        book_id = int(books * rng.random() ** 3) + 1
+
+        if book_id in open_borrows:
+            borrow = open_borrows.pop(book_id)
+            borrow["is_done"] = True
+            user_loans[borrow["user_id"]] -= 1
+            returns.append({"id": len(returns) + 1, "user_id": borrow["user_id"], "book_id": book_id,
+                            "created_at": created_at})
+            continue
+
+        user_id = rng.randint(1, users)
+        if user_loans.get(user_id, 0) >= MAX_BORROW_COUNT:
+            continue
+        user_loans[user_id] = user_loans.get(user_id, 0) + 1
+        borrow = {"id": len(borrows) + 1, "user_id": user_id, "book_id": book_id, "is_done": False,
+                  "created_at": created_at}
+        open_borrows[book_id] = borrow
+        borrows.append(borrow)
+
+    return borrows, returns
+
+
+def generate(engine, books: int, seed: int = 42):
+    """Fills an empty database with `books` books and proportional related rows, then migrates it"""
+    rng = random.Random(seed)
+    authors = max(books // 10, 10)
+    publishers = max(books // 1000, 5)
+
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        insert_chunked(conn, "INSERT INTO authors (id, name, birth_date) VALUES (:id, :name, :birth_date)", [
+            {"id": i, "name": f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()}son {i}",
+             "birth_date": timestamp(datetime(1930, 1, 1) + timedelta(days=rng.randint(0, 25000)))}
+            for i in range(1, authors + 1)
+        ])
+        insert_chunked(conn, "INSERT INTO publishers (id, name) VALUES (:id, :name)", [
+            {"id": i, "name": f"{rng.choice(WORDS).title()} Press {i}"} for i in range(1, publishers + 1)
+        ])
+        insert_chunked(conn, "INSERT INTO genres (id, name) VALUES (:id, :name)", [
+            {"id": i, "name": f"{WORDS[i % len(WORDS)].title()} {i}"} for i in range(1, GENRES + 1)
+        ])
+
+        for start in range(0, books, CHUNK_SIZE):
+            book_ids = range(start + 1, min(start + CHUNK_SIZE, books) + 1)
+            conn.execute(
+                text(
+                    "INSERT INTO books (id, title, isbn, publish_date, author_id, publisher_id)"
+                    " VALUES (:id, :title, :isbn, :publish_date, :author_id, :publisher_id)"
+                ),
+                [
+                    {"id": i, "title": title(rng, i), "isbn": f"0-{i // 100000:05d}-{i % 100000:05d}-{i % 10}",
+                     "publish_date": timestamp(datetime(1950, 1, 1) + timedelta(days=rng.randint(0, 27000))),
+                     "author_id": rng.randint(1, authors), "publisher_id": rng.randint(1, publishers)}
+                    for i in book_ids
+                ],
+            )
+            conn.execute(
+                text("INSERT INTO book_genre (book_id, genre_id) VALUES (:book_id, :genre_id)"),
+                [
+                    {"book_id": i, "genre_id": genre_id}
+                    for i in book_ids
+                    for genre_id in rng.sample(range(1, GENRES + 1), rng.randint(1, 3))
+                ],
+            )
+
+        borrows, returns = history(rng, books, events=books * 2, users=max(books // 5, 10))
+        insert_chunked(
+            conn,
+            "INSERT INTO borrows (id, user_id, book_id, is_done, created_at)"
+            " VALUES (:id, :user_id, :book_id, :is_done, :created_at)",
+            borrows,
+        )
+        insert_chunked(
+            conn,
+            "INSERT INTO returns (id, user_id, book_id, created_at) VALUES (:id, :user_id, :book_id, :created_at)",
+            returns,
+        )
+
+    migrate(engine)
+
+
+def dataset(books: int, data_dir: Path, seed: int = 42) -> Path:
+    """Returns the path of a generated database, building it on first use.
+
+    The file is built under a temporary name and renamed when complete, so an
+    interrupted run never leaves a half-filled dataset behind.
+    """
+    data_dir.mkdir(parents=True, exist_ok=True)
+    path = data_dir / f"books-{books}-seed{seed}-v{DATASET_VERSION}.db"
+    if path.exists():
+        return path
+
+    partial = path.with_suffix(".partial")
+    partial.unlink(missing_ok=True)
+    engine = create_db_engine(DatabaseSettings(url=f"sqlite:///{partial}", wal=False))
+    try:
+        generate(engine, books, seed)
+    finally:
+        engine.dispose()
+    os.replace(partial, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", default="1k", help=f"one of {', '.join(SCALES)} or a book count")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data-dir", type=Path, default=Path(".bench-data"))
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    path = dataset(scale_books(args.scale), args.data_dir, args.seed)
+    print(f"{path} ready in {time.perf_counter() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""In-process benchmark of every route handler against a deterministic dataset.
+
+Each case calls one handler through the app with a TestClient and records, per call,
+the wall time, the time spent executing SQL, the time spent validating and encoding the
+response, and the number of statements. Medians are written as JSON so a later run can
+be compared with a saved baseline:
+
+    python -m benchmarks.suite run --scale 100k --output baseline.json
+    python -m benchmarks.suite run --scale 100k --output current.json
+    python -m benchmarks.suite compare baseline.json current.json
+
+`compare` exits with status 1 when a case got slower than the threshold or issues more queries.
+
+Book pages and list totals are measured uncached: `page_cache` and `count_cache` are cleared
+before every call, so a case times its query and serialization path rather than a cache hit.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+import fastapi.routing
+from fastapi.responses import ORJSONResponse
+from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from starlette.responses import JSONResponse
+
+from benchmarks.datagen import DATASET_VERSION, SCALES, dataset, scale_books
+from cache import count_cache, page_cache, reference_cache
+from database import (
+    DatabaseSettings, create_async_db_engine, create_db_engine, create_read_db_engine, get_async_db, get_db,
+    get_read_only_db,
+)
+from migrations import migrate
+from responses import UTCORJSONResponse
+
+WARMUP = 3
+
+
+@dataclass(frozen=True)
+class BenchCase:
+    name: str
+    call: Callable  # (client, call number, fixtures) -> response
+    max_repeat: int = None  # caps the repeat count for cases that walk a whole table
+
+
+class Probe:
+    """Accumulates SQL and serialization time for the call being measured"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.serialize_seconds = 0.0
+
+
+@contextmanager
+def instrumented(probe: Probe, engines):
+    """Hooks cursor execution and response serialization for the duration of a run.
+
+    Serialization covers response_model validation (`serialize_response`) and the body
+    encoding of the JSON response classes; streamed bodies are encoded while the
+    client reads them, so for those it only shows up in the wall time.
+    """
+    started = {}
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started[id(cursor)] = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        probe.queries += 1
+        probe.query_seconds += time.perf_counter() - started.pop(id(cursor), time.perf_counter())
+
+    original_serialize = fastapi.routing.serialize_response
+
+    async def serialize_response(*args, **kwargs):
+        begin = time.perf_counter()
+        try:
+            return await original_serialize(*args, **kwargs)
+        finally:
+            probe.serialize_seconds += time.perf_counter() - begin
+
+    def timed_render(render):
+        def wrapper(self, content):
+            begin = time.perf_counter()
+            try:
+                return render(self, content)
+            finally:
+                probe.serialize_seconds += time.perf_counter() - begin
+        return wrapper
+
+    response_classes = (JSONResponse, ORJSONResponse, UTCORJSONResponse)
+    renders = {cls: cls.__dict__["render"] for cls in response_classes}
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    fastapi.routing.serialize_response = serialize_response
+    for cls, render in renders.items():
+        cls.render = timed_render(render)
+    try:
+        yield
+    finally:
+        for cls, render in renders.items():
+            cls.render = render
+        fastapi.routing.serialize_response = original_serialize
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+            event.remove(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def bulk_body(call: int, rows: int = 100) -> bytes:
+    return b"\n".join(
+        json.dumps({
+            "title": f"Bulk {call}-{row}", "isbn": "0-306-40615-2", "publish_date": "2001-01-01T00:00:00",
+            "author_id": 1, "publisher_id": 1, "genre_ids": [1, 2],
+        }).encode()
+        for row in range(rows)
+    )
+
+
+def new_book(call: int) -> dict:
+    return {"title": f"Bench {call}", "isbn": "0-306-40615-2", "publish_date": "2001-01-01T00:00:00",
+            "author_id": 1, "publisher_id": 1, "genre_ids": [1, 2, 3]}
+
+
+# borrow and return reuse the same call numbers, so every return closes the borrow made before it
+BENCH_USER = 10 ** 9
+
+
+def circulation_batch(books) -> dict:
+    """Borrows and returns each book, leaving the loans as they were"""
+    operations = []
+    for offset, book_id in enumerate(books):
+        user_id = 2 * BENCH_USER + offset
+        operations += [{"type": kind, "book_id": book_id, "user_id": user_id} for kind in ("borrow", "return")]
+    return {"operations": operations}
+
+
+CASES = [
+    BenchCase("get_books", lambda c, i, f: c.get("/api/books", params={"limit": 100, "offset": 500})),
+    BenchCase("get_books_sorted_author", lambda c, i, f: c.get(
+        "/api/books", params={"limit": 100, "sort_by": "author", "order": "desc"})),
+    BenchCase("get_books_filtered", lambda c, i, f: c.get(
+        "/api/books", params={"limit": 100, "genre_ids": [7, 9], "publisher_id": 3, "sort_by": "title"})),
+    BenchCase("get_books_cursor", lambda c, i, f: c.get(
+        "/api/books", params={"limit": 100, "sort_by": "title", "cursor": f["title_cursor"]})),
+    BenchCase("search_books", lambda c, i, f: c.get("/api/books/search", params={"q": "lantern mea", "limit": 20})),
+    BenchCase("get_book_history", lambda c, i, f: c.get("/api/books/1/history")),
+    BenchCase("get_book_timeline", lambda c, i, f: c.get("/api/books/1/history", params={"timeline": True})),
+    BenchCase("get_author_books", lambda c, i, f: c.get("/api/author/1/books")),
+    BenchCase("get_genres", lambda c, i, f: c.get("/api/genres/", params={"limit": 50})),
+    BenchCase("get_publishers", lambda c, i, f: c.get("/api/publishers/", params={"limit": 50})),
+    BenchCase("get_most_borrowed_books", lambda c, i, f: c.get("/api/stats/books/most-borrowed", params={"limit": 20})),
+    BenchCase("get_genre_stats", lambda c, i, f: c.get("/api/stats/genres", params={"limit": 50})),
+    BenchCase("get_author_stats", lambda c, i, f: c.get("/api/stats/authors", params={"limit": 20})),
+    BenchCase("export_books", lambda c, i, f: c.get("/api/books/export"), max_repeat=3),
+    BenchCase("create_book", lambda c, i, f: c.post("/api/books/", json=new_book(i))),
+    BenchCase("create_books_bulk", lambda c, i, f: c.post(
+        "/api/books/bulk", content=bulk_body(i), headers={"Content-Type": "application/x-ndjson"})),
+    BenchCase("create_author", lambda c, i, f: c.post(
+        "/api/author/", json={"name": f"Bench Author {i}", "birth_date": "1970-01-01T00:00:00"})),
+    BenchCase("create_genre", lambda c, i, f: c.post("/api/genres/", json={"name": f"Bench Genre {i}"})),
+    BenchCase("create_publisher", lambda c, i, f: c.post("/api/publishers/", json={"name": f"Bench Press {i}"})),
+    BenchCase("create_borrow", lambda c, i, f: c.post(
+        "/api/borrow/", json={"book_id": f["free_books"][i], "user_id": BENCH_USER + i, "is_done": False})),
+    BenchCase("create_return", lambda c, i, f: c.post(
+        "/api/return/", json={"book_id": f["free_books"][i], "user_id": BENCH_USER + i})),
+    BenchCase("circulation_batch", lambda c, i, f: c.post(
+        "/api/circulation/batch", json=circulation_batch(f["free_books"][:10]))),
+]
+
+
+def fixtures(client: TestClient, engine, calls: int) -> dict:
+    """Inputs that depend on the dataset: a mid-table cursor and books nobody has borrowed"""
+    with engine.connect() as conn:
+        free_books = conn.execute(
+            text("SELECT id FROM books WHERE active_borrow_id IS NULL ORDER BY id DESC LIMIT :calls"),
+            {"calls": calls},
+        ).scalars().all()
+
+    response = client.get("/api/books", params={"limit": 100, "sort_by": "title", "cursor": ""})
+    return {"free_books": free_books, "title_cursor": response.headers.get("X-Next-Cursor", "")}
+
+
+def measure(client: TestClient, case: BenchCase, probe: Probe, repeat: int, fixture_values: dict) -> dict:
+    repeat = min(repeat, case.max_repeat or repeat)
+    samples = {"total_ms": [], "query_ms": [], "serialize_ms": [], "queries": []}
+
+    for call in range(WARMUP + repeat):
+        page_cache.clear()
+        count_cache.clear()
+        probe.reset()
+        begin = time.perf_counter()
+        response = case.call(client, call, fixture_values)
+        elapsed = time.perf_counter() - begin
+        if response.status_code != 200:
+            raise RuntimeError(f"{case.name} returned {response.status_code}: {response.text[:200]}")
+        if call < WARMUP:
+            continue
+        samples["total_ms"].append(elapsed * 1000)
+        samples["query_ms"].append(probe.query_seconds * 1000)
+        samples["serialize_ms"].append(probe.serialize_seconds * 1000)
+        samples["queries"].append(probe.queries)
+
+    result = {metric: round(statistics.median(values), 4) for metric, values in samples.items()}
+    result["p95_ms"] = round(statistics.quantiles(samples["total_ms"], n=20)[-1], 4) if repeat > 1 else result["total_ms"]
+    result["calls"] = repeat
+    return result
+
+
+def run(args) -> dict:
+    from main import app
+
+    books = scale_books(args.scale)
+    source = dataset(books, args.data_dir, args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # writes land in a copy, so the cached dataset stays identical between runs
+        working_copy = Path(directory) / "bench.db"
+        shutil.copyfile(source, working_copy)
+        settings = DatabaseSettings.from_env({**os.environ, "DATABASE_URL": f"sqlite:///{working_copy}"})
+        engine = create_db_engine(settings)
+        # a cached dataset may predate the latest migrations
+        migrate(engine)
+        async_engine = create_async_db_engine(settings, poolclass=NullPool)
+        read_engine = create_read_db_engine(settings)
+        session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        read_session_factory = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+        async_session_factory = async_sessionmaker(
+            async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+        )
+
+        def override_get_db():
+            db = session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        async def override_get_async_db():
+            async with async_session_factory() as session:
+                yield session
+
+        def override_get_read_only_db():
+            db = read_session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app.dependency_overrides[get_db] = override_get_db
+        app.dependency_overrides[get_async_db] = override_get_async_db
+        app.dependency_overrides[get_read_only_db] = override_get_read_only_db
+        reference_cache.clear()
+
+        selected = [case for case in CASES if not args.case or case.name in args.case]
+        probe = Probe()
+        results = {}
+        try:
+            with TestClient(app) as client:
+                fixture_values = fixtures(client, engine, WARMUP + args.repeat)
+                with instrumented(probe, (engine, async_engine.sync_engine, read_engine)):
+                    for case in selected:
+                        results[case.name] = measure(client, case, probe, args.repeat, fixture_values)
+                        print(format_result(case.name, results[case.name]), flush=True)
+        finally:
+            app.dependency_overrides.clear()
+            engine.dispose()
+            async_engine.sync_engine.dispose()
+            read_engine.dispose()
+
+    return {
+        "meta": {
+            "scale": args.scale,
+            "books": books,
+            "seed": args.seed,
+            "dataset_version": DATASET_VERSION,
+            "repeat": args.repeat,
+            "caches": "page_cache and count_cache cleared before every call",
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        },
+        "results": results,
+    }
+
+
+def format_result(name: str, result: dict) -> str:
+    return (
+        f"{name:>24}: {result['total_ms']:9.3f} ms (p95 {result['p95_ms']:9.3f})"
+        f"  sql {result['query_ms']:8.3f} ms  serialize {result['serialize_ms']:8.3f} ms"
+        f"  queries {result['queries']:g}"
+    )
+
+
+def compare(baseline: dict, current: dict, threshold: float, min_delta_ms: float):
+    """Returns (report lines, regressed case names)"""
+    lines, regressions = [], []
+    if baseline["meta"].get("books") != current["meta"].get("books"):
+        lines.append(f"warning: comparing {baseline['meta'].get('books')} books against {current['meta'].get('books')}")
+
+    for name, before in baseline["results"].items():
+        after = current["results"].get(name)
+        if after is None:
+            lines.append(f"{name:>24}: missing from current results")
+            continue
+
+        delta = after["total_ms"] - before["total_ms"]
+        ratio = after["total_ms"] / before["total_ms"] if before["total_ms"] else float("inf")
+        reasons = []
+        if ratio > 1 + threshold and delta > min_delta_ms:
+            reasons.append(f"{(ratio - 1) * 100:+.0f}% time")
+        if after["queries"] > before["queries"]:
+            reasons.append(f"queries {before['queries']:g} -> {after['queries']:g}")
+        if reasons:
+            regressions.append(name)
+
+        flag = f"  REGRESSION ({', '.join(reasons)})" if reasons else ""
+        lines.append(f"{name:>24}: {before['total_ms']:9.3f} -> {after['total_ms']:9.3f} ms ({(ratio - 1) * 100:+6.1f}%){flag}")
+
+    for name in current["results"].keys() - baseline["results"].keys():
+        lines.append(f"{name:>24}: new case, no baseline")
+
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="measure every case and write the results as JSON")
+    run_parser.add_argument("--scale", default="1k", help=f"one of {', '.join(SCALES)} or a book count")
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--repeat", type=int, default=20)
+    run_parser.add_argument("--case", action="append", help="only run the named case (repeatable)")
+    run_parser.add_argument("--data-dir", type=Path, default=Path(".bench-data"))
+    run_parser.add_argument("--output", type=Path, default=Path("benchmark-results.json"))
+
+    compare_parser = commands.add_parser("compare", help="flag regressions against a saved baseline")
+    compare_parser.add_argument("baseline", type=Path)
+    compare_parser.add_argument("current", type=Path)
+    compare_parser.add_argument("--threshold", type=float, default=0.25, help="allowed relative slowdown")
+    compare_parser.add_argument("--min-delta-ms", type=float, default=0.2, help="ignore slowdowns below this")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run(args)
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"results written to {args.output}")
+        return
+
+    lines, regressions = compare(
+        json.loads(args.baseline.read_text()), json.loads(args.current.read_text()), args.threshold, args.min_delta_ms
+    )
+    print("\n".join(lines))
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import codecs
+import csv
+import io
+import json
+from collections import deque
+from typing import AsyncIterator, List, Tuple, Union
+
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+CSV_TYPES = ("text/csv",)
+
+
+async def iter_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[Union[str, UnicodeDecodeError]]:
+    """Splits a byte stream into decoded lines, newline included, without buffering the whole body.
+
+    A line that isn't valid UTF-8 is yielded as its UnicodeDecodeError, so it fails on its own row.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = b""
+
+    def decode(line: bytes):
+        try:
+            return decoder.decode(line.rstrip(b"\r") + b"\n", final=True)
+        except UnicodeDecodeError as e:
+            decoder.reset()
+            return e
+
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield decode(line)
+    if buffer:
+        yield decode(buffer)
+
+
+class NeedMoreLines(Exception):
+    """Raised to csv.reader when a record continues past the lines received so far"""
+
+
+class PendingLines:
+    """Line source of the import's csv.reader, fed as lines arrive from the body"""
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise NeedMoreLines
+        return self.lines.popleft()
+
+
+def parse_csv_row(header, values: List[str]) -> dict:
+    if len(values) != len(header):
+        raise ValueError(f"Expected {len(header)} columns, got {len(values)}")
+
+    record = dict(zip(header, values))
+    for key, value in list(record.items()):
+        if value == "":
+            record[key] = None
+    if "genre_ids" in record:
+        record["genre_ids"] = [int(genre_id) for genre_id in (record["genre_ids"] or "").split(";") if genre_id]
+    return record
+
+
+async def iter_records(stream: AsyncIterator[bytes], content_type: str) -> AsyncIterator[Tuple[int, object]]:
+    """Yields (row number, record or ValueError) for every non-empty NDJSON line or CSV data row.
+
+    CSV bodies need a header row; `genre_ids` is a `;`-separated list of ids. One csv.reader parses
+    the lines as they arrive, so quoted fields may span lines. When it runs out of lines inside a
+    quoted field, the record is parsed again once its next line is in.
+    """
+    is_csv = content_type in CSV_TYPES
+    pending = PendingLines()
+    reader = csv.reader(pending)
+    header = None
+    record_lines = []
+    row = 0
+    async for line in iter_lines(stream):
+        if isinstance(line, UnicodeDecodeError):
+            # the record this line belongs to can't be parsed either
+            record_lines = []
+            row += 1
+            yield row, ValueError(f"Invalid UTF-8: {line}")
+            continue
+        if not record_lines and not line.strip():
+            continue
+
+        if not is_csv:
+            row += 1
+            try:
+                yield row, json.loads(line)
+            except ValueError as e:
+                yield row, e
+            continue
+
+        record_lines.append(line)
+        pending.lines.clear()
+        pending.lines.extend(record_lines)
+        try:
+            values = next(reader)
+        except NeedMoreLines:
+            continue  # inside a quoted field
+        except csv.Error as e:
+            values = e
+        record_lines = []
+
+        if header is None:
+            if isinstance(values, csv.Error):
+                row += 1
+                yield row, ValueError(f"Invalid header: {values}")
+                return
+            header = values
+            continue
+
+        row += 1
+        if isinstance(values, csv.Error):
+            yield row, ValueError(str(values))
+            continue
+        try:
+            yield row, parse_csv_row(header, values)
+        except ValueError as e:
+            yield row, e
+
+    if record_lines:
+        yield row + 1, ValueError("Unterminated quoted field")
+
+
+EXPORT_FIELDS = ("id", "title", "isbn", "publish_date", "author_id", "author", "publisher_id", "genres", "genre_ids")
+
+
+def encode_ndjson(records) -> str:
+    return "".join(json.dumps(record, default=str) + "\n" for record in records)
+
+
+def encode_csv(records, header: bool = False) -> str:
+    """Writes records as CSV rows; genre names and ids are `;`-joined, ids as on import"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+    for record in records:
+        writer.writerow([
+            ";".join(map(str, record[field])) if field in ("genres", "genre_ids") else record[field]
+            for field in EXPORT_FIELDS
+        ])
+    return buffer.getvalue()
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Size-bounded LRU whose entries also expire `ttl` seconds after they were stored.
+
+    Keys are tuples whose first item is a namespace, so a write can drop everything it
+    affects with `invalidate(namespace)`. That only reaches this process; entries loaded
+    through `get_or_load` with a `version` (the `table_versions` counters they were read
+    at) are also reloaded once another process has written to those tables.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None, version=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] > self.clock() and entry[2] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not _MISSING:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, version=None):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader, version=None):
+        """Cached value for `key`, loading it when missing, expired or stored at another `version`.
+
+        Read the version before loading: a write in between then leaves an entry whose
+        version is older than its contents, which the next request simply reloads.
+        """
+        value = self.get(key, _MISSING, version)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value, version)
+        return value
+
+    def invalidate(self, namespace):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == namespace]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+reference_cache = TTLCache(
+    maxsize=int(os.getenv("REFERENCE_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("REFERENCE_CACHE_TTL", 60)),
+)
+
+# GET /books pages, stored with the table versions they were read at
+page_cache = TTLCache(
+    maxsize=int(os.getenv("PAGE_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("PAGE_CACHE_TTL", 60)),
+)
+
+# filtered list totals, stored with the table versions they were counted at
+count_cache = TTLCache(
+    maxsize=int(os.getenv("COUNT_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("COUNT_CACHE_TTL", 30)),
+)
+
+# replayable borrow/return responses by (scope, Idempotency-Key); the table is the source of truth
+idempotency_cache = TTLCache(
+    maxsize=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000)),
+    ttl=float(os.getenv("IDEMPOTENCY_KEY_TTL", 86400)),
+)
@@ -0,0 +1,108 @@
+"""Circulation summaries behind the `/stats` routes.
+
+`book_stats`, `genre_stats` and `author_stats` hold running borrow counts and, for genres and
+authors, the number of books currently out. The borrow, return and batch routes pass
+per-book deltas to `record_circulation` in their own transaction, so the summaries move
+together with the loans they describe and a stats read only touches the rows it returns.
+
+A book's genres and author are read when it is borrowed and again when it is returned. If
+they change while the book is out, or rows are written outside the routes, the active counts
+drift; `python -m circulation_stats` recomputes every summary from `borrows`.
+"""
+from typing import List
+from sqlalchemy import Integer, bindparam, select, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import AuthorStats, Book, BookStats, GenreStats, book_genre_association
+
+REBUILD_STATEMENTS = [
+    "DELETE FROM book_stats",
+    "INSERT INTO book_stats (book_id, borrow_count)"
+    " SELECT book_id, count(*) FROM borrows WHERE book_id IS NOT NULL GROUP BY book_id",
+    "DELETE FROM genre_stats",
+    "INSERT INTO genre_stats (genre_id, borrow_count, active_count)"
+    " SELECT book_genre.genre_id, count(*), sum(NOT coalesce(borrows.is_done, 0))"
+    " FROM borrows JOIN book_genre ON book_genre.book_id = borrows.book_id"
+    " WHERE book_genre.genre_id IS NOT NULL GROUP BY book_genre.genre_id",
+    "DELETE FROM author_stats",
+    "INSERT INTO author_stats (author_id, borrow_count, active_count)"
+    " SELECT books.author_id, count(*), sum(NOT coalesce(borrows.is_done, 0))"
+    " FROM borrows JOIN books ON books.id = borrows.book_id"
+    " WHERE books.author_id IS NOT NULL GROUP BY books.author_id",
+]
+
+
+def delta_statements() -> List:
+    """Upserts adding `borrows` and `active` to the summaries of book `book_id`, its genres and its author"""
+    link = book_genre_association.c
+    borrows, active = bindparam("borrows", type_=Integer), bindparam("active", type_=Integer)
+
+    book_stats = BookStats.__table__
+    book = insert(book_stats).values(book_id=bindparam("book_id"), borrow_count=borrows)
+    book = book.on_conflict_do_update(
+        index_elements=[book_stats.c.book_id],
+        set_={"borrow_count": book_stats.c.borrow_count + book.excluded.borrow_count},
+    )
+
+    genre_stats = GenreStats.__table__
+    genres = insert(genre_stats).from_select(
+        ["genre_id", "borrow_count", "active_count"],
+        select(link.genre_id, borrows, active).where(link.book_id == bindparam("book_id"), link.genre_id.is_not(None)),
+    )
+    genres = genres.on_conflict_do_update(
+        index_elements=[genre_stats.c.genre_id],
+        set_={
+            "borrow_count": genre_stats.c.borrow_count + genres.excluded.borrow_count,
+            "active_count": genre_stats.c.active_count + genres.excluded.active_count,
+        },
+    )
+
+    author_stats = AuthorStats.__table__
+    books = Book.__table__
+    author = insert(author_stats).from_select(
+        ["author_id", "borrow_count", "active_count"],
+        select(books.c.author_id, borrows, active)
+        .where(books.c.id == bindparam("book_id"), books.c.author_id.is_not(None)),
+    )
+    author = author.on_conflict_do_update(
+        index_elements=[author_stats.c.author_id],
+        set_={
+            "borrow_count": author_stats.c.borrow_count + author.excluded.borrow_count,
+            "active_count": author_stats.c.active_count + author.excluded.active_count,
+        },
+    )
+    return [book, genres, author]
+
+
+DELTA_STATEMENTS = delta_statements()
+
+
+def borrowed(book_id: int) -> dict:
+    return {"book_id": book_id, "borrows": 1, "active": 1}
+
+
+def returned(book_id: int) -> dict:
+    return {"book_id": book_id, "borrows": 0, "active": -1}
+
+
+async def record_circulation(db: AsyncSession, deltas: List[dict]):
+    """Applies per-book deltas, one executemany per summary table"""
+    if not deltas:
+        return
+    for statement in DELTA_STATEMENTS:
+        await db.execute(statement, deltas)
+
+
+def rebuild(bind):
+    """Recomputes every summary from the borrow history in one transaction"""
+    with bind.begin() as conn:
+        for statement in REBUILD_STATEMENTS:
+            conn.execute(text(statement))
+
+
+if __name__ == "__main__":
+    from database import engine, Base
+
+    Base.metadata.create_all(bind=engine)
+    rebuild(engine)
+    print("Rebuilt book_stats, genre_stats and author_stats")
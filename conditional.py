@@ -0,0 +1,102 @@
+"""HTTP validators for read endpoints, built from the per-table change counters.
+
+`table_versions` (migration 4) holds a counter and a timestamp per table that triggers bump
+on every write. An endpoint's ETag hashes its URL with the counters of the tables it reads,
+so a poll that sends the ETag back costs one primary-key lookup and gets a bodyless 304
+before the route queries or serializes anything.
+
+`Last-Modified` only has whole seconds, so it is left out while the last change is in the
+current second: a later write in that second would share its HTTP-date and be hidden from an
+`If-Modified-Since` poll. The ETag covers those responses.
+"""
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Depends, HTTPException, Request, Response
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import Session
+from database import get_read_db
+
+TABLE_VERSIONS_QUERY = text(
+    "SELECT name, version, updated_at FROM table_versions WHERE name IN :names"
+).bindparams(bindparam("names", expanding=True))
+
+
+def read_table_versions(db: Session, tables):
+    """Returns ({table: version}, time of the last change) for the given tables"""
+    rows = db.execute(TABLE_VERSIONS_QUERY, {"names": list(tables)}).all()
+
+    versions = {name: version for name, version, _ in rows}
+    changes = [datetime.fromisoformat(str(updated_at)) for _, _, updated_at in rows]
+    last_modified = max(changes).replace(tzinfo=timezone.utc) if changes else None
+    return versions, last_modified
+
+
+def request_table_versions(request: Request, db: Session, tables) -> tuple:
+    """Versions of `tables` as `conditional_get` read them for this request, or read now.
+
+    Cached responses are stored under this state, so every worker sees another worker's
+    writes at the cost of the version lookup the ETag needs anyway.
+    """
+    versions = getattr(request.state, "table_versions", None)
+    if versions is None or not set(tables) <= versions.keys():
+        versions, _ = read_table_versions(db, tables)
+    return tuple((table, versions.get(table, 0)) for table in sorted(tables))
+
+
+def make_etag(request: Request, versions: dict) -> str:
+    state = ",".join(f"{table}={versions.get(table, 0)}" for table in sorted(versions))
+    digest = hashlib.sha1(f"{request.url.path}?{request.url.query}|{state}".encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def not_modified_since(if_modified_since: str, last_modified: datetime) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return last_modified.replace(microsecond=0) <= since
+
+
+def settled(last_modified: datetime, now: datetime) -> bool:
+    """True once the second `last_modified` falls in has passed"""
+    return last_modified.replace(microsecond=0) < now.replace(microsecond=0)
+
+
+def conditional_get(*tables, require=None):
+    """Dependency that answers 304 for an unchanged resource and otherwise sets ETag/Last-Modified.
+
+    `require(request, db)` runs before a 304 is sent and may raise, e.g. a 404 for a missing row
+    the table counters can't tell apart from an unchanged one. It returns False when the route
+    should answer instead, such as for path parameters FastAPI has yet to validate.
+    """
+
+    def check(request: Request, response: Response, db: Session = Depends(get_read_db)):
+        versions, last_modified = read_table_versions(db, tables)
+        request.state.table_versions = versions
+        etag = make_etag(request, versions)
+        headers = {"ETag": etag}
+        if last_modified is not None and not settled(last_modified, datetime.now(timezone.utc)):
+            last_modified = None
+        if last_modified is not None:
+            headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+
+        if_none_match = request.headers.get("if-none-match")
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_none_match is not None:
+            not_modified = etag_matches(if_none_match, etag)
+        else:
+            not_modified = bool(if_modified_since and last_modified and not_modified_since(if_modified_since, last_modified))
+
+        if not_modified and (require is None or require(request, db)):
+            raise HTTPException(status_code=304, headers=headers)
+        response.headers.update(headers)
+
+    return check
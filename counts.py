@@ -0,0 +1,53 @@
+"""Opt-in list totals (`?count=exact|estimated`) sent as `X-Total-Count` headers.
+
+Unfiltered totals come from `table_versions.row_count`, which triggers keep exact
+(migration 6), so they cost one primary-key lookup. GET /books only lists books with
+an author, so `listed_book_count` subtracts the author-less ones, an index lookup on
+`books.author_id`; authors are never deleted, so no other book drops out of the join.
+Filtered totals are counted once and cached together with the versions of the tables
+they read: while those versions are unchanged the cached total is still exact. After a
+write, `exact` counts again, while `estimated` answers from the cached total until it
+expires and says so in `X-Total-Count-Type`.
+"""
+from fastapi import Request, Response
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import Session
+from cache import count_cache
+from conditional import request_table_versions
+from models import Book
+
+COUNT_MODES = "^(exact|estimated)$"
+
+ROW_COUNT_QUERY = text("SELECT row_count FROM table_versions WHERE name = :name")
+
+
+def table_row_count(db: Session, table: str) -> int:
+    return db.execute(ROW_COUNT_QUERY, {"name": table}).scalar() or 0
+
+
+def listed_book_count(db: Session) -> int:
+    """Books GET /books lists without filters: its join with authors drops those without one"""
+    without_author = db.execute(select(func.count()).select_from(Book).where(Book.author_id.is_(None))).scalar()
+    return table_row_count(db, "books") - without_author
+
+
+def filtered_count(request: Request, db: Session, key: tuple, tables, count_statement, mode: str):
+    """Returns (total, exact) for a filtered list, counting only when no usable total is cached"""
+    state = request_table_versions(request, db, tables)
+
+    cached = count_cache.get(key)
+    if cached is not None:
+        cached_state, total = cached
+        if cached_state == state:
+            return total, True
+        if mode == "estimated":
+            return total, False
+
+    total = db.execute(count_statement).scalar()
+    count_cache.set(key, (state, total))
+    return total, True
+
+
+def set_total_count(response: Response, total: int, exact: bool):
+    response.headers["X-Total-Count"] = str(total)
+    response.headers["X-Total-Count-Type"] = "exact" if exact else "estimated"
@@ -1,15 +1,245 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import functools
+import os
+from dataclasses import dataclass
+from typing import Optional
+from fastapi import Depends, Request
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool, StaticPool
+import metrics
 
-DATABASE_URL = "sqlite:///./test.db"
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+TEMP_STORES = ("DEFAULT", "FILE", "MEMORY")
+SCHEMA_SETUP_MODES = ("migrate", "skip")
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@dataclass(frozen=True)
+class DatabaseSettings:
+    url: str = "sqlite:///./test.db"
+    # a replica file for GET routes; by default they read the primary file through a mode=ro connection
+    read_url: Optional[str] = None
+    pool_size: int = 5
+    wal: bool = True
+    synchronous: str = "NORMAL"
+    cache_size: int = -64000
+    mmap_size: int = 268435456
+    busy_timeout: int = 5000
+    temp_store: str = "MEMORY"
+    # "migrate" brings the schema up to date on startup, "skip" trusts a deploy step to have done it
+    schema_setup: str = "migrate"
+
+    def __post_init__(self):
+        if self.synchronous.upper() not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f"SQLITE_SYNCHRONOUS must be one of {', '.join(SYNCHRONOUS_LEVELS)}")
+        if self.temp_store.upper() not in TEMP_STORES:
+            raise ValueError(f"SQLITE_TEMP_STORE must be one of {', '.join(TEMP_STORES)}")
+        if self.schema_setup.lower() not in SCHEMA_SETUP_MODES:
+            raise ValueError(f"DATABASE_SCHEMA_SETUP must be one of {', '.join(SCHEMA_SETUP_MODES)}")
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        """Reads DATABASE_* and SQLITE_* variables, falling back to the defaults above"""
+        defaults = cls()
+        return cls(
+            url=environ.get("DATABASE_URL", defaults.url),
+            read_url=environ.get("DATABASE_READ_URL", defaults.read_url),
+            pool_size=int(environ.get("DATABASE_POOL_SIZE", defaults.pool_size)),
+            wal=environ.get("SQLITE_WAL", str(defaults.wal)).lower() in ("1", "true", "yes", "on"),
+            synchronous=environ.get("SQLITE_SYNCHRONOUS", defaults.synchronous),
+            cache_size=int(environ.get("SQLITE_CACHE_SIZE", defaults.cache_size)),
+            mmap_size=int(environ.get("SQLITE_MMAP_SIZE", defaults.mmap_size)),
+            busy_timeout=int(environ.get("SQLITE_BUSY_TIMEOUT", defaults.busy_timeout)),
+            temp_store=environ.get("SQLITE_TEMP_STORE", defaults.temp_store),
+            schema_setup=environ.get("DATABASE_SCHEMA_SETUP", defaults.schema_setup),
+        )
+
+    @property
+    def async_url(self) -> str:
+        return make_url(self.url).set(drivername="sqlite+aiosqlite").render_as_string()
+
+    @property
+    def in_memory(self) -> bool:
+        return self.url.endswith(":memory:") or self.url in ("sqlite://", "sqlite:///")
+
+    @property
+    def read_only_url(self) -> str:
+        if self.read_url:
+            return self.read_url
+        url = make_url(self.url)
+        read_only = url.set(database=f"file:{url.database}", query={**url.query, "mode": "ro", "uri": "true"})
+        return read_only.render_as_string()
+
+    def pragmas(self, read_only: bool = False):
+        if read_only:
+            # journal_mode is a property of the file that only the writer may change
+            return [("query_only", "ON"), *[(name, value) for name, value in self.pragmas() if name != "journal_mode"]]
+        pragmas = [
+            ("synchronous", self.synchronous.upper()),
+            ("cache_size", self.cache_size),
+            ("mmap_size", self.mmap_size),
+            ("busy_timeout", self.busy_timeout),
+            ("temp_store", self.temp_store.upper()),
+        ]
+        if self.wal and not self.in_memory:
+            pragmas.insert(0, ("journal_mode", "WAL"))
+        return pragmas
+
+
+class TimedQueuePool(metrics.PoolWaitTimer, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(metrics.PoolWaitTimer, AsyncAdaptedQueuePool):
+    pass
+
+
+def _engine_kwargs(settings: DatabaseSettings, engine_kwargs: dict, poolclass) -> dict:
+    if "poolclass" in engine_kwargs:
+        return engine_kwargs
+    if settings.in_memory:
+        return {"poolclass": StaticPool, **engine_kwargs}
+    return {"poolclass": poolclass, "pool_size": settings.pool_size, **engine_kwargs}
+
+
+def _listen_for_pragmas(sync_engine, settings: DatabaseSettings, read_only: bool = False):
+    @event.listens_for(sync_engine, "connect")
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in settings.pragmas(read_only):
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def _listen_for_metrics(sync_engine):
+    """Reports statement time, rows and counts to the request being served, see `metrics`"""
+    event.listen(sync_engine, "before_cursor_execute", metrics.before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", metrics.after_cursor_execute)
+
+
+def _begin_immediate(sync_engine):
+    """Takes the write lock when a transaction starts instead of at its first write.
+
+    pysqlite defers BEGIN until the first DML statement, so the reads a handler does
+    before writing would otherwise run outside the transaction.
+    """
+    @event.listens_for(sync_engine, "connect")
+    def disable_implicit_begin(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(sync_engine, "begin")
+    def begin_immediate(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def create_db_engine(settings: DatabaseSettings, **engine_kwargs):
+    """Builds the sync engine and applies the SQLite pragmas on every new connection"""
+    db_engine = create_engine(
+        settings.url,
+        connect_args={"check_same_thread": False, "factory": metrics.MetricsConnection},
+        **_engine_kwargs(settings, engine_kwargs, TimedQueuePool),
+    )
+    _listen_for_pragmas(db_engine, settings)
+    _listen_for_metrics(db_engine)
+    return db_engine
+
+
+def create_read_db_engine(settings: DatabaseSettings, **engine_kwargs):
+    """Builds the engine behind `get_read_db`: its own pool of read-only connections.
+
+    Under WAL readers never block the writer, but on a shared pool a slow listing still holds
+    a connection a borrow or return is waiting for. In-memory databases can't be opened twice,
+    so they have no read engine and reads use the primary one.
+    """
+    db_engine = create_engine(
+        settings.read_only_url,
+        connect_args={"check_same_thread": False, "factory": metrics.MetricsConnection},
+        **_engine_kwargs(settings, engine_kwargs, TimedQueuePool),
+    )
+    _listen_for_pragmas(db_engine, settings, read_only=True)
+    _listen_for_metrics(db_engine)
+    return db_engine
+
+
+def create_async_db_engine(settings: DatabaseSettings, **engine_kwargs):
+    """Builds the aiosqlite engine used by the write routes.
+
+    Same pragmas as `create_db_engine`, and every transaction starts with BEGIN IMMEDIATE
+    so check-then-write sequences are serialized against other writers.
+    """
+    db_engine = create_async_engine(settings.async_url, **_engine_kwargs(settings, engine_kwargs, TimedAsyncQueuePool))
+    _listen_for_pragmas(db_engine.sync_engine, settings)
+    _listen_for_metrics(db_engine.sync_engine)
+    _begin_immediate(db_engine.sync_engine)
+    return db_engine
+
+
+settings = DatabaseSettings.from_env()
 Base = declarative_base()
 
+
+# Engines are built on first use, so importing the app, a route module or a CLI tool opens
+# no pools and touches no database file.
+@functools.lru_cache(maxsize=None)
+def get_engine():
+    return create_db_engine(settings)
+
+
+@functools.lru_cache(maxsize=None)
+def get_read_engine():
+    return get_engine() if settings.in_memory else create_read_db_engine(settings)
+
+
+@functools.lru_cache(maxsize=None)
+def get_async_engine():
+    return create_async_db_engine(settings)
+
+
+_ENGINES = {"engine": get_engine, "read_engine": get_read_engine, "async_engine": get_async_engine}
+
+
+def __getattr__(name):
+    """Keeps `from database import engine` working: the engine is built when it is first imported"""
+    if name in _ENGINES:
+        return _ENGINES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False)
+AsyncSessionLocal = async_sessionmaker(class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 def get_db():
-    db = SessionLocal()
+    db = SessionLocal(bind=get_engine())
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal(bind=get_async_engine()) as db:
+        yield db
+
+def get_read_only_db():
+    db = ReadSessionLocal(bind=get_read_engine())
+    try:
+        yield db
+    finally:
+        db.close()
+
+READ_YOUR_WRITES_HEADER = "X-Read-Your-Writes"
+
+def wants_read_your_writes(request: Request) -> bool:
+    return request.headers.get(READ_YOUR_WRITES_HEADER, "").lower() in ("1", "true", "yes", "on")
+
+def get_read_db(
+    request: Request,
+    primary: Session = Depends(get_db),
+    read_only: Session = Depends(get_read_only_db),
+):
+    """Session for GET routes: the read-only engine, or the primary with `X-Read-Your-Writes: true`.
+
+    Sessions connect on first use, so the one that isn't picked never checks out a connection.
+    """
+    return primary if wants_read_your_writes(request) else read_only
@@ -0,0 +1,121 @@
+"""`Idempotency-Key` support for POST /borrow/ and POST /return/.
+
+The first successful response for a key is stored in `idempotency_keys` in the same
+transaction as the loan it describes, so either both are committed or neither is. A retry
+with the same key is answered from the `idempotency_cache` LRU or, on another worker or after
+eviction, from the table, and never reaches the borrow/return admission checks. The table
+lookup runs inside the request's BEGIN IMMEDIATE transaction, so a duplicate sent while the
+original is still running waits for it and then replays its response.
+
+Only successful responses are stored: a rejected request wrote nothing, so its retry simply
+runs again. Reusing a key with a different body is answered with 422. Keys expire after
+IDEMPOTENCY_KEY_TTL seconds; writes schedule a background purge of expired rows at most
+once every IDEMPOTENCY_PURGE_INTERVAL seconds.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import NamedTuple, Optional
+from fastapi import BackgroundTasks, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from cache import idempotency_cache
+from models import IdempotencyKey
+
+IDEMPOTENCY_KEY_TTL = idempotency_cache.ttl
+IDEMPOTENCY_PURGE_INTERVAL = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL", 300))
+
+MAX_KEY_LENGTH = 255
+
+
+class StoredResponse(NamedTuple):
+    fingerprint: str
+    status_code: int
+    body: str
+
+
+def request_fingerprint(payload: BaseModel) -> str:
+    return hashlib.sha256(payload.model_dump_json().encode()).hexdigest()
+
+
+def expiry_cutoff():
+    """Oldest `created_at` still replayable, in the CURRENT_TIMESTAMP format the column is written in"""
+    return func.datetime("now", f"-{int(IDEMPOTENCY_KEY_TTL)} seconds")
+
+
+async def find_response(db: AsyncSession, scope: str, key: str) -> Optional[StoredResponse]:
+    stored = idempotency_cache.get((scope, key))
+    if stored is not None:
+        return stored
+
+    row = (await db.execute(
+        select(IdempotencyKey.fingerprint, IdempotencyKey.status_code, IdempotencyKey.body)
+        .where(IdempotencyKey.scope == scope, IdempotencyKey.key == key, IdempotencyKey.created_at >= expiry_cutoff())
+    )).first()
+    if row is None:
+        return None
+    stored = StoredResponse(*row)
+    idempotency_cache.set((scope, key), stored)
+    return stored
+
+
+def replay(stored: StoredResponse, fingerprint: str) -> JSONResponse:
+    if stored.fingerprint != fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+    return JSONResponse(
+        content=json.loads(stored.body),
+        status_code=stored.status_code,
+        headers={"Idempotent-Replayed": "true"},
+    )
+
+
+async def store_response(db: AsyncSession, scope: str, key: str, fingerprint: str, content, status_code: int = 200):
+    """Adds the response to the current transaction; call `remember` once it has committed"""
+    stored = StoredResponse(fingerprint, status_code, json.dumps(jsonable_encoder(content)))
+    # an expired row that hasn't been purged yet is overwritten
+    await db.execute(
+        insert(IdempotencyKey)
+        .values(scope=scope, key=key, **stored._asdict())
+        .on_conflict_do_update(
+            index_elements=[IdempotencyKey.scope, IdempotencyKey.key],
+            set_={**stored._asdict(), "created_at": func.current_timestamp()},
+        )
+    )
+    return stored
+
+
+def remember(scope: str, key: str, stored: StoredResponse):
+    idempotency_cache.set((scope, key), stored)
+
+
+async def purge_expired(bind: AsyncEngine) -> int:
+    async with bind.begin() as conn:
+        result = await conn.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < expiry_cutoff()))
+    return result.rowcount
+
+
+class PurgeSchedule:
+    """Hands at most one purge per interval to the request's background tasks"""
+
+    def __init__(self, interval: float, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def maybe_schedule(self, background_tasks: BackgroundTasks, bind: AsyncEngine):
+        with self._lock:
+            now = self.clock()
+            if now < self._next:
+                return
+            self._next = now + self.interval
+        background_tasks.add_task(purge_expired, bind)
+
+
+purge_schedule = PurgeSchedule(IDEMPOTENCY_PURGE_INTERVAL)
@@ -0,0 +1,67 @@
+import os
+from collections import defaultdict
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, lazyload, selectinload
+from models import Author, Book, Genre, book_genre_association
+
+LOAD_STRATEGIES = ("selectin", "joined", "lazy")
+
+BOOK_LOAD_STRATEGY = os.getenv("BOOK_LOAD_STRATEGY", "selectin")
+
+
+def book_load_options(strategy: str = None):
+    """Returns loader options for Book.author and Book.genres.
+
+    `selectin` issues one extra IN query per relationship, `joined` folds both into
+    the main SELECT, `lazy` keeps the per-row loading SQLAlchemy does by default.
+    """
+    strategy = strategy or BOOK_LOAD_STRATEGY
+
+    if strategy == "selectin":
+        return [selectinload(Book.author), selectinload(Book.genres)]
+    if strategy == "joined":
+        return [joinedload(Book.author), joinedload(Book.genres)]
+    if strategy == "lazy":
+        return [lazyload(Book.author), lazyload(Book.genres)]
+
+    raise ValueError(f"Unknown load strategy: {strategy}")
+
+
+def book_rows_query():
+    """Core SELECT of the columns BookResponse needs; no ORM instances are built from it"""
+    return (
+        select(
+            Book.id, Book.title, Book.isbn, Book.publish_date, Book.author_id, Book.publisher_id,
+            Author.name.label("author_name"), Author.birth_date.label("author_birth_date"),
+        )
+        .join(Author, Book.author_id == Author.id)
+    )
+
+
+def book_rows_to_dicts(db, rows):
+    """Builds BookResponse-shaped dicts, loading every book's genres with one IN query"""
+    genres = defaultdict(list)
+    if rows:
+        genre_rows = db.execute(
+            select(book_genre_association.c.book_id, Genre.name, Genre.id)
+            .join(Genre, Genre.id == book_genre_association.c.genre_id)
+            .where(book_genre_association.c.book_id.in_([row.id for row in rows]))
+        )
+        for book_id, name, genre_id in genre_rows:
+            genres[book_id].append({"name": name, "id": genre_id})
+
+    return [
+        {
+            "title": row.title,
+            "isbn": row.isbn,
+            "publish_date": row.publish_date,
+            "author_id": row.author_id,
+            "publisher_id": row.publisher_id,
+            # BookResponse inherits genre_ids from BookBase; the ORM path never filled it either
+            "genre_ids": [],
+            "id": row.id,
+            "author": {"name": row.author_name, "birth_date": row.author_birth_date},
+            "genres": genres[row.id],
+        }
+        for row in rows
+    ]
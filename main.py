@@ -1,10 +1,35 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from database import engine, Base
-from routes import book,author,publisher,genre, borrow
+from admission import AdmissionMiddleware
+import database
+from metrics import MetricsMiddleware
+from migrations import setup_schema
+from routes import book,author,publisher,genre, borrow, monitoring, stats
 
 DEFAULT_PREFIX = "/api"
 
 description = """
+## Conditional Requests
+
+`GET /books`, `GET /books/{book_id}/history`, `GET /genres/` and `GET /publishers/` send `ETag` and
+`Last-Modified` headers derived from per-table change counters. Repeating a request with `If-None-Match`
+(or `If-Modified-Since`) returns an empty `304 Not Modified` without running the listing query.
+`Last-Modified` is only sent once the second of the last change has passed, so a write later in that same
+second is never hidden behind a 304; a history request for a missing book is a 404 whatever the validators say.
+
+## Read Routing
+
+GET routes read through their own pool of read-only connections (a `mode=ro` URI on the primary file, or
+the replica file in `DATABASE_READ_URL`), so slow listings never hold a connection a write is waiting for.
+Send `X-Read-Your-Writes: true` to read from the primary instead, e.g. right after a write when reading
+from a replica that may lag behind.
+
+## Schema Setup
+
+On startup the app creates missing tables and applies pending migrations; when `PRAGMA user_version` is
+already current that is a single PRAGMA. Set `DATABASE_SCHEMA_SETUP=skip` when a deploy step has already run
+`python -m migrations`. Engines are built on first use, so importing the app opens no database file.
+
 ## Authors
 
 ### Get Author's Books
@@ -14,6 +39,7 @@ description = """
 - Returns all books by specified author
 - Returns empty list if no books found
 - Response includes full book details with author/genre relationships
+- Read as plain rows (author joined in, genres in one extra query) and encoded with orjson
 
 ### Create Author
 🔗 `POST /author/`
@@ -37,9 +63,28 @@ description = """
 - Pagination support with `limit` (1-100) and `offset` (≥0)
 - Sorting by `title`, `publish_date`, or `author` name
 - Order direction (`asc` or `desc`)
+- Keyset pagination with `cursor`: pass an empty `cursor` for the first page, then the `X-Next-Cursor` header
+  (also sent as a `Link: rel="next"` header) for each following page; ties break on book id
 - Automatic joins with authors for sorting
+- Filters, combined with AND: `genre_ids` (repeatable; books in any of them, or in all of them with
+  `genre_match=all`), `author_id`, `publisher_id`, `published_since` (inclusive) and `published_before` (exclusive)
+- `count=exact|estimated` adds the total as `X-Total-Count` (with `X-Total-Count-Type`): unfiltered totals come
+  from row counts kept by triggers, filtered totals are cached per filter until the tables change
+  (`COUNT_CACHE_TTL`, `COUNT_CACHE_SIZE`); `estimated` serves a stale cached total instead of recounting
+- Author and genres are read as plain rows in two queries and encoded with orjson, without building ORM objects
+- Pages are cached in-process (`PAGE_CACHE_TTL`, `PAGE_CACHE_SIZE`) under the table versions the `ETag` is built
+  from, so a write through any worker is seen by the next request
 - Returns 200 even with empty results
 
+### Search Books
+🔗 `GET /books/search?q=`
+
+📝 **Behavior**:
+- Full-text search over book titles and author names (SQLite FTS5, kept in sync by triggers)
+- Every word must match as a prefix; FTS operators in `q` are treated as plain words
+- Ranked with bm25 (title matches weigh more than author matches), paginated with `limit` and `offset`
+- Author and genres are eager-loaded with `BOOK_LOAD_STRATEGY` (`selectin`, `joined` or `lazy`)
+
 ### Create Book
 🔗 `POST /books/`
 
@@ -48,16 +93,41 @@ description = """
 - **Publish Date**: Must be in the past (UTC timezone enforced)
 - **Author Check**: Author must exist (404 if not found)
 - **Genre Verification**: All genre IDs must exist (404 if any missing)
+- Known author and genre ids are cached, so repeated inserts skip those lookups
 - **Database Integrity**: Atomic transactions with rollback on failure
 
+### Bulk Import Books
+🔗 `POST /books/bulk`
+
+📝 **Behavior**:
+- Streams an NDJSON (`application/x-ndjson`) or CSV (`text/csv`, header row, `;`-separated `genre_ids`) body
+- Every row is validated with the same rules as `POST /books/`
+- Authors and genres are resolved once per batch (`batch_size`, default 1000) and each batch is inserted in one transaction
+- Returns `imported`, `failed` and a per-row `errors` report instead of failing the whole load
+- 415 for any other content type
+
+### Export Books
+🔗 `GET /books/export?format=ndjson|csv`
+
+📝 **Behavior**:
+- Streams every book with its author name, genre names and genre ids, ordered by id
+- Reads through one server-side cursor in bounded batches, so memory stays flat whatever the table size
+- CSV output has a header row and `;`-separated genre names and `genre_ids`; it can be posted back to
+  `POST /books/bulk` as is, which ignores the `id`, `author` and `genres` columns
+
 ### Get Book History
 🔗 `GET /books/{book_id}/history`
 
 📝 **Behavior**:
-- Returns complete borrow/return history for a book
+- Returns the borrow/return history for a book, oldest first (`order=desc` for newest first)
 - 404 if book doesn't exist
 - Empty arrays if no history exists
 - Includes timestamps for all transactions
+- `since` (inclusive) and `until` (exclusive) filter on the transaction timestamp
+- Paginated over both kinds of events together with `limit` (1-1000, default 100) and `cursor`
+  (`X-Next-Cursor` / `Link: rel="next"` headers, as for `GET /books`)
+- `timeline=true` returns one merged `events` list instead, each event tagged `borrow` or `return`
+- The existence check and the page of events come from a single UNION query
 
 ## Genres
 
@@ -68,6 +138,9 @@ description = """
 - Pagination support with `limit` (1-100) and `offset` (≥0)
 - Returns 200 status even with empty results
 - Response includes basic genre information
+- Served from an in-process TTL/LRU cache (`REFERENCE_CACHE_TTL`, `REFERENCE_CACHE_SIZE`), dropped on `POST /genres/`
+  and reloaded once the `genres` table version moves, whichever worker wrote it
+- `count=exact` adds the total as an `X-Total-Count` header, read from a maintained row count
 
 ### Create Genre
 🔗 `POST /genres/`
@@ -90,6 +163,9 @@ description = """
 - Pagination support with `limit` (1-100) and `offset` (≥0)
 - Returns 200 status even with empty results
 - Response includes basic publisher information
+- Served from an in-process TTL/LRU cache (`REFERENCE_CACHE_TTL`, `REFERENCE_CACHE_SIZE`), dropped on `POST /publishers/`
+  and reloaded once the `publishers` table version moves, whichever worker wrote it
+- `count=exact` adds the total as an `X-Total-Count` header, read from a maintained row count
 
 ### Create Publisher
 🔗 `POST /publishers/`
@@ -110,7 +186,9 @@ description = """
 📝 **Validations**:
 - **Book Existence**: Book must exist (404 if not found)
 - **Availability**: Book must not be currently borrowed (400 if unavailable)
-- **Borrow Limit**: User can't exceed maximum borrow count (currently 3)
+- **Borrow Limit**: User can't exceed maximum active borrow count (currently 3)
+- **Concurrency**: Admission runs as conditional updates of the book's active borrow and the user's
+  active loan count inside one `BEGIN IMMEDIATE` transaction, so parallel requests can't both pass
 
 📝 **Error Responses**:
 - 400: Book already borrowed or user limit reached
@@ -120,20 +198,101 @@ description = """
 ### Return a Book
 🔗 `POST /return/`
 📝 **Validations**:
-- **Borrow Record**: Must find matching active borrow record (404 if none)
+- **Borrow Record**: Must find the book's active borrow for this user (404 if none)
 - **Database Integrity**: Updates borrow status and creates return record atomically
 
 📝 **Error Responses**:
 - 404: No active borrow found for this book/user combination
 - 500: Database operation failed (with rollback)
+
+### Circulation Batch
+🔗 `POST /circulation/batch`
+
+📝 **Behavior**:
+- Body: `{"operations": [{"type": "borrow" | "return", "book_id", "user_id"}, ...]}` (1-500 operations)
+- Operations are checked in order with the same rules as `POST /borrow/` and `POST /return/`, each seeing
+  the effect of the earlier ones, against state read with one `IN` lookup on `books` and one on `user_loans`
+- Accepted operations are written in one transaction: one multi-row insert per table, one executemany for
+  books, loan counts and the circulation stats, and a single commit
+- Returns `applied`, `failed` and a result per operation (`index`, `status_code` 200/400/404, `id` of the
+  created borrow or return, `detail` for rejected ones); rejected operations don't fail the batch
+
+### Idempotent Retries
+Both `POST /borrow/` and `POST /return/` accept an `Idempotency-Key` header (1-255 characters):
+- The first successful response for a key is stored with the loan in one transaction; a retry with the same
+  key gets that response back with `Idempotent-Replayed: true`, without re-running the admission checks
+- Replays come from an in-process LRU (`IDEMPOTENCY_CACHE_SIZE`) or the `idempotency_keys` table
+- A retry sent while the original is still running waits for it and then replays its response
+- Failed requests are not stored, so retrying them runs them again
+- 422: the key was already used with a different request body
+- Keys expire after `IDEMPOTENCY_KEY_TTL` seconds (default 86400); expired rows are purged in the
+  background at most every `IDEMPOTENCY_PURGE_INTERVAL` seconds (default 300)
+
+## Circulation Stats
+
+🔗 `GET /stats/books/most-borrowed` / `GET /stats/genres` / `GET /stats/authors`
+
+📝 **Behavior**:
+- Most borrowed books (with whether each is out now), borrows and active loans per genre, and
+  authors by active loans, paginated with `limit` (1-100, default 10) and `offset`
+- Read from summary tables that `POST /borrow/` and `POST /return/` update in the same transaction,
+  through indexes on the sort column, so a page costs as many rows as it returns
+- `python -m circulation_stats` recomputes the summaries from the borrow history
+
+## Monitoring
+
+### Metrics
+🔗 `GET /metrics`
+
+📝 **Behavior**:
+- Prometheus text format, labelled by method and route template (`unmatched` for unknown paths)
+- Request count by status and a latency histogram per route
+- Per route: SQL statements (total and a per-request histogram), SQL execution time, rows fetched
+  and time spent waiting for a pooled connection
+- Per admission group: requests in flight, queue depth, admitted requests and shed requests by reason
+
+### Admission Control
+
+📝 **Behavior**:
+- Write routes share SQLite's single write lock, so each route group runs a bounded number of requests at
+  once: `circulation` (`POST /borrow/`, `/return/`, `/circulation/batch`, default 4) and `books`
+  (`POST /books/` and `/books/bulk`, default 2)
+- Requests over the limit wait in FIFO order in a bounded queue (defaults 32 and 8) for up to a timeout
+  (defaults 2 s and 5 s)
+- A full queue or an expired wait is answered at once with `503` and `Retry-After` (`ADMISSION_RETRY_AFTER`, 1 s)
+- Configured per process with `ADMISSION_<GROUP>_LIMIT`, `_QUEUE` and `_TIMEOUT`; a limit of 0 turns a group off
+
+### Slow Queries
+🔗 `GET /admin/slow-queries` / `DELETE /admin/slow-queries`
+
+📝 **Behavior**:
+- Lists the latest requests (newest first, `SLOW_QUERY_LOG_SIZE`, default 100) that took at least
+  `SLOW_REQUEST_MS` (default 500) or ran a statement taking at least `SLOW_QUERY_MS` (default 100)
+- Each entry has the route, status, duration and its slowest statements with parameters and durations
+- Statements over `SLOW_QUERY_MS` carry their `EXPLAIN QUERY PLAN` output and the tables they scan in full
+- Every entry is also logged as a warning on the `slow_queries` logger
+- Requires an `X-Admin-Token` header matching `ADMIN_TOKEN` (403 otherwise); with `ADMIN_TOKEN` unset the
+  routes always answer 403, since entries carry SQL parameters
 """
 
-Base.metadata.create_all(bind=engine)
 
-app = FastAPI(title="Library API", description=description)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # runs before the first request is accepted, so blocking the loop here delays nothing
+    if database.settings.schema_setup.lower() != "skip":
+        setup_schema(database.get_engine())
+    yield
+
+
+app = FastAPI(title="Library API", description=description, lifespan=lifespan)
+# added first so it runs inside MetricsMiddleware; shed requests never reach routing and count as `unmatched`
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(book.router, prefix=DEFAULT_PREFIX, tags=["Books"])
 app.include_router(author.router, prefix=DEFAULT_PREFIX, tags=['Authors'])
 app.include_router(publisher.router, prefix=DEFAULT_PREFIX, tags=['Publishers'])
 app.include_router(genre.router, prefix=DEFAULT_PREFIX, tags=['Genre'])
 app.include_router(borrow.router, prefix=DEFAULT_PREFIX, tags=['Borrow'])
+app.include_router(stats.router, prefix=DEFAULT_PREFIX, tags=['Stats'])
+app.include_router(monitoring.router)
@@ -0,0 +1,262 @@
+"""Per-route request and SQL metrics, exposed in the Prometheus text format.
+
+`MetricsMiddleware` gives every HTTP request a `RequestMetrics` through a context variable.
+The engine hooks in `database.py` add each statement's time, row count and pool checkout
+wait to whatever request is current. Once the response has been sent, the middleware folds
+the totals into the registry and hands slow requests to the `slow_queries` log. Everything
+stays in process: recording a statement is a context variable lookup, a few additions and
+an append, so it can stay on in production.
+"""
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Optional
+from slow_queries import KeptStatements, StatementRecord, explain, slow_query_log
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class RequestMetrics:
+    __slots__ = ("queries", "sql_seconds", "rows", "pool_wait_seconds", "statements")
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.pool_wait_seconds = 0.0
+        self.statements = KeptStatements()
+
+
+current_request: ContextVar[Optional[RequestMetrics]] = ContextVar("current_request", default=None)
+
+
+class RowCountingCursor(sqlite3.Cursor):
+    """Counts fetched rows towards the request that executed the statement.
+
+    pysqlite only knows how many rows a SELECT produced once they are fetched, which
+    happens after the cursor events have fired.
+    """
+    request_metrics = None
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None and self.request_metrics is not None:
+            self.request_metrics.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        if self.request_metrics is not None:
+            self.request_metrics.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if self.request_metrics is not None:
+            self.request_metrics.rows += len(rows)
+        return rows
+
+
+class MetricsConnection(sqlite3.Connection):
+    """sqlite3 connection factory whose cursors count fetched rows"""
+
+    def cursor(self, factory=RowCountingCursor):
+        return super().cursor(factory)
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+class RouteStats:
+    __slots__ = ("latency", "queries_per_request", "queries", "sql_seconds", "rows", "pool_wait_seconds", "statuses")
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries_per_request = Histogram(QUERY_COUNT_BUCKETS)
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.pool_wait_seconds = 0.0
+        self.statuses = defaultdict(int)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_bound(bound) -> str:
+    return repr(float(bound))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._routes = defaultdict(RouteStats)
+        self._lock = threading.Lock()
+
+    def observe(self, method: str, route: str, status: int, seconds: float, request: RequestMetrics):
+        with self._lock:
+            stats = self._routes[(method, route)]
+            stats.latency.observe(seconds)
+            stats.queries_per_request.observe(request.queries)
+            stats.queries += request.queries
+            stats.sql_seconds += request.sql_seconds
+            stats.rows += request.rows
+            stats.pool_wait_seconds += request.pool_wait_seconds
+            stats.statuses[status] += 1
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+    def render(self) -> str:
+        with self._lock:
+            routes = sorted(self._routes.items())
+            lines = []
+
+            def family(name, kind, help_text):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+            def labels(method, route, **extra):
+                pairs = {"method": method, "route": route, **extra}
+                return "{" + ",".join(f'{key}="{escape(str(value))}"' for key, value in pairs.items()) + "}"
+
+            family("http_requests_total", "counter", "Requests served, by route and status code.")
+            for (method, route), stats in routes:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append(f"http_requests_total{labels(method, route, status=status)} {count}")
+
+            for name, attribute, help_text in (
+                ("http_request_duration_seconds", "latency", "Request latency, including streamed bodies."),
+                ("db_queries_per_request", "queries_per_request", "SQL statements executed per request."),
+            ):
+                family(name, "histogram", help_text)
+                for (method, route), stats in routes:
+                    histogram = getattr(stats, attribute)
+                    cumulative = 0
+                    for bound, count in zip(histogram.bounds, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{labels(method, route, le=format_bound(bound))} {cumulative}")
+                    lines.append(f"{name}_bucket{labels(method, route, le='+Inf')} {histogram.count}")
+                    lines.append(f"{name}_sum{labels(method, route)} {histogram.total}")
+                    lines.append(f"{name}_count{labels(method, route)} {histogram.count}")
+
+            for name, attribute, help_text in (
+                ("db_queries_total", "queries", "SQL statements executed."),
+                ("db_query_duration_seconds_total", "sql_seconds", "Time spent executing SQL statements."),
+                ("db_rows_total", "rows", "Rows fetched from SQL statements."),
+                ("db_pool_wait_seconds_total", "pool_wait_seconds", "Time spent waiting for a pooled connection."),
+            ):
+                family(name, "counter", help_text)
+                for (method, route), stats in routes:
+                    lines.append(f"{name}{labels(method, route)} {getattr(stats, attribute)}")
+
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class MetricsMiddleware:
+    """ASGI middleware that records every HTTP request under its route template.
+
+    Requests that match no route share the `unmatched` label, so the number of series
+    stays bounded by the number of routes.
+    """
+
+    def __init__(self, app, registry: MetricsRegistry = registry, slow_log=slow_query_log):
+        self.app = app
+        self.registry = registry
+        self.slow_log = slow_log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_metrics = RequestMetrics()
+        token = current_request.set(request_metrics)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_request.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            seconds = time.perf_counter() - started
+            self.registry.observe(scope["method"], route, status, seconds, request_metrics)
+            self.slow_log.observe_request(
+                scope["method"], route, status, seconds, request_metrics.queries, request_metrics.statements
+            )
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    request_metrics = current_request.get()
+    if request_metrics is None:
+        return
+    if isinstance(cursor, RowCountingCursor):
+        cursor.request_metrics = request_metrics
+    if context is not None:
+        context.metrics_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    request_metrics = current_request.get()
+    if request_metrics is None:
+        return
+    started = getattr(context, "metrics_started", None)
+    seconds = time.perf_counter() - started if started is not None else 0.0
+    request_metrics.sql_seconds += seconds
+    request_metrics.queries += 1
+
+    slow = slow_query_log.is_slow_statement(seconds)
+    if slow or request_metrics.statements.wants(seconds):
+        record = StatementRecord(statement, parameters, executemany, seconds)
+        if slow:
+            record.plan = explain(conn.connection, statement, parameters, executemany)
+        request_metrics.statements.add(record, slow)
+    # the aiosqlite adapter fetches the whole result while executing
+    prefetched = getattr(cursor, "_rows", None)
+    if prefetched is not None:
+        request_metrics.rows += len(prefetched)
+
+
+class PoolWaitTimer:
+    """Pool mixin that adds the time spent waiting for a checkout to the current request"""
+
+    def _do_get(self):
+        request_metrics = current_request.get()
+        if request_metrics is None:
+            return super()._do_get()
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            request_metrics.pool_wait_seconds += time.perf_counter() - started
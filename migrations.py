@@ -0,0 +1,227 @@
+"""Versioned schema migrations for databases created before a model change.
+
+`Base.metadata.create_all` only creates missing tables, so anything added to an existing
+table (indexes, columns) needs a migration here. The applied version is kept in SQLite's
+`PRAGMA user_version`. Every step must be safe to run against a schema that `create_all`
+just built from the current models, hence the `IF NOT EXISTS` clauses.
+
+Run `python -m migrations` to upgrade the database configured by DATABASE_URL. The app runs
+`setup_schema` on startup unless DATABASE_SCHEMA_SETUP=skip.
+"""
+from dataclasses import dataclass
+from typing import Callable, List, Union
+from sqlalchemy import text
+from circulation_stats import REBUILD_STATEMENTS
+from database import Base
+
+
+VERSIONED_TABLES = ("authors", "books", "book_genre", "genres", "publishers", "borrows", "returns")
+
+
+def version_triggers(table: str) -> List[str]:
+    """Bumps the table's row in table_versions on every insert, update and delete"""
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_version_{operation.lower()} AFTER {operation} ON {table} BEGIN"
+        f" UPDATE table_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP"
+        f" WHERE name = '{table}';"
+        f" END"
+        for operation in ("INSERT", "UPDATE", "DELETE")
+    ]
+
+
+COUNTED_TABLES = ("books", "genres", "publishers")
+
+
+def counting_version_triggers(table: str) -> List[str]:
+    """Replaces the insert/delete version triggers with ones that also keep table_versions.row_count exact"""
+    statements = []
+    for operation, delta in (("INSERT", "+ 1"), ("DELETE", "- 1")):
+        name = f"{table}_version_{operation.lower()}"
+        statements += [
+            f"DROP TRIGGER IF EXISTS {name}",
+            f"CREATE TRIGGER {name} AFTER {operation} ON {table} BEGIN"
+            f" UPDATE table_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP,"
+            f" row_count = row_count {delta}"
+            f" WHERE name = '{table}';"
+            f" END",
+        ]
+    return statements
+
+
+# sub-second change times, so a write in the same second as a poll is still told apart from it
+CHANGE_TIMESTAMP = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+def precise_version_triggers(table: str) -> List[str]:
+    """Recreates the table's version triggers to stamp `updated_at` with CHANGE_TIMESTAMP"""
+    row_count = {"INSERT": ", row_count = row_count + 1", "DELETE": ", row_count = row_count - 1"}
+    statements = []
+    for operation in ("INSERT", "UPDATE", "DELETE"):
+        name = f"{table}_version_{operation.lower()}"
+        statements += [
+            f"DROP TRIGGER IF EXISTS {name}",
+            f"CREATE TRIGGER {name} AFTER {operation} ON {table} BEGIN"
+            f" UPDATE table_versions SET version = version + 1, updated_at = {CHANGE_TIMESTAMP}"
+            f"{row_count.get(operation, '') if table in COUNTED_TABLES else ''}"
+            f" WHERE name = '{table}';"
+            f" END",
+        ]
+    return statements
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    statements: List[Union[str, Callable]]
+
+
+def add_column(table: str, column: str, definition: str):
+    """SQLite has no ADD COLUMN IF NOT EXISTS, so check the table info first"""
+
+    def step(conn):
+        columns = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+        if column not in columns:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+
+    return step
+
+
+MIGRATIONS = [
+    Migration(1, "Index hot lookup columns", [
+        "CREATE INDEX IF NOT EXISTS ix_books_isbn ON books (isbn)",
+        "CREATE INDEX IF NOT EXISTS ix_books_author_id ON books (author_id)",
+        "CREATE INDEX IF NOT EXISTS ix_books_publisher_id ON books (publisher_id)",
+        "CREATE INDEX IF NOT EXISTS ix_book_genre_book_id_genre_id ON book_genre (book_id, genre_id)",
+        "CREATE INDEX IF NOT EXISTS ix_book_genre_genre_id_book_id ON book_genre (genre_id, book_id)",
+        "CREATE INDEX IF NOT EXISTS ix_borrows_book_id_is_done ON borrows (book_id, is_done)",
+        "CREATE INDEX IF NOT EXISTS ix_borrows_user_id_is_done ON borrows (user_id, is_done)",
+        "CREATE INDEX IF NOT EXISTS ix_returns_book_id_created_at ON returns (book_id, created_at)",
+    ]),
+    Migration(2, "Track active loans per book and per user", [
+        add_column("books", "active_borrow_id", "INTEGER"),
+        "CREATE TABLE IF NOT EXISTS user_loans ("
+        " user_id INTEGER NOT NULL PRIMARY KEY,"
+        " active_count INTEGER NOT NULL)",
+        "UPDATE books SET active_borrow_id = ("
+        " SELECT max(id) FROM borrows WHERE borrows.book_id = books.id AND NOT coalesce(borrows.is_done, 0))",
+        "INSERT OR REPLACE INTO user_loans (user_id, active_count)"
+        " SELECT user_id, count(*) FROM borrows WHERE NOT coalesce(is_done, 0) GROUP BY user_id",
+    ]),
+    Migration(3, "Full-text index over book titles and author names", [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS book_search USING fts5("
+        " title, author, tokenize = 'unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER IF NOT EXISTS book_search_insert AFTER INSERT ON books BEGIN"
+        " INSERT INTO book_search (rowid, title, author)"
+        " VALUES (new.id, new.title, (SELECT name FROM authors WHERE id = new.author_id));"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS book_search_update AFTER UPDATE OF title, author_id ON books BEGIN"
+        " UPDATE book_search SET title = new.title,"
+        " author = (SELECT name FROM authors WHERE id = new.author_id) WHERE rowid = new.id;"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS book_search_delete AFTER DELETE ON books BEGIN"
+        " DELETE FROM book_search WHERE rowid = old.id;"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS book_search_author_update AFTER UPDATE OF name ON authors BEGIN"
+        " UPDATE book_search SET author = new.name"
+        " WHERE rowid IN (SELECT id FROM books WHERE author_id = new.id);"
+        " END",
+        "DELETE FROM book_search",
+        "INSERT INTO book_search (rowid, title, author)"
+        " SELECT books.id, books.title, authors.name FROM books LEFT JOIN authors ON authors.id = books.author_id",
+    ]),
+    Migration(4, "Per-table change counters for HTTP validators", [
+        "CREATE TABLE IF NOT EXISTS table_versions ("
+        " name VARCHAR NOT NULL PRIMARY KEY,"
+        " version INTEGER NOT NULL DEFAULT 0,"
+        " updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)",
+        *[f"INSERT OR IGNORE INTO table_versions (name) VALUES ('{table}')" for table in VERSIONED_TABLES],
+        *[trigger for table in VERSIONED_TABLES for trigger in version_triggers(table)],
+    ]),
+    Migration(5, "Index book columns used by list filters and sorts", [
+        "CREATE INDEX IF NOT EXISTS ix_books_publish_date ON books (publish_date)",
+        "CREATE INDEX IF NOT EXISTS ix_books_title ON books (title)",
+    ]),
+    Migration(6, "Row counts for list totals", [
+        add_column("table_versions", "row_count", "INTEGER NOT NULL DEFAULT 0"),
+        *[f"UPDATE table_versions SET row_count = (SELECT count(*) FROM {table}) WHERE name = '{table}'"
+          for table in COUNTED_TABLES],
+        *[trigger for table in COUNTED_TABLES for trigger in counting_version_triggers(table)],
+    ]),
+    Migration(7, "Circulation summaries for /stats", [
+        "CREATE TABLE IF NOT EXISTS book_stats ("
+        " book_id INTEGER NOT NULL PRIMARY KEY,"
+        " borrow_count INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS genre_stats ("
+        " genre_id INTEGER NOT NULL PRIMARY KEY,"
+        " borrow_count INTEGER NOT NULL,"
+        " active_count INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS author_stats ("
+        " author_id INTEGER NOT NULL PRIMARY KEY,"
+        " borrow_count INTEGER NOT NULL,"
+        " active_count INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_book_stats_borrow_count ON book_stats (borrow_count, book_id)",
+        "CREATE INDEX IF NOT EXISTS ix_genre_stats_borrow_count ON genre_stats (borrow_count, genre_id)",
+        "CREATE INDEX IF NOT EXISTS ix_author_stats_active_count ON author_stats (active_count, author_id)",
+        *REBUILD_STATEMENTS,
+    ]),
+    Migration(8, "Stored responses for Idempotency-Key", [
+        "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+        " scope VARCHAR NOT NULL,"
+        " key VARCHAR NOT NULL,"
+        " fingerprint VARCHAR NOT NULL,"
+        " status_code INTEGER NOT NULL,"
+        " body TEXT NOT NULL,"
+        " created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+        " PRIMARY KEY (scope, key))",
+        "CREATE INDEX IF NOT EXISTS ix_idempotency_keys_created_at ON idempotency_keys (created_at)",
+    ]),
+    Migration(9, "Sub-second change times for Last-Modified", [
+        *[trigger for table in VERSIONED_TABLES for trigger in precise_version_triggers(table)],
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(conn) -> int:
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+
+def migrate(bind) -> List[int]:
+    """Applies every pending migration in order and returns the versions it applied"""
+    applied = []
+    for migration in MIGRATIONS:
+        with bind.begin() as conn:
+            if current_version(conn) >= migration.version:
+                continue
+            for statement in migration.statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(text(statement))
+            conn.execute(text(f"PRAGMA user_version = {migration.version}"))
+        applied.append(migration.version)
+    return applied
+
+
+def setup_schema(bind) -> List[int]:
+    """Creates missing tables and applies pending migrations, unless `user_version` is already current.
+
+    Every model change ships with a migration, so a current version means the tables exist and
+    the check costs one PRAGMA instead of `create_all` probing each table.
+    """
+    with bind.connect() as conn:
+        if current_version(conn) >= LATEST_VERSION:
+            return []
+    Base.metadata.create_all(bind=bind)
+    return migrate(bind)
+
+
+if __name__ == "__main__":
+    from database import engine
+    import models  # noqa: F401 - registers the tables on Base.metadata
+
+    Base.metadata.create_all(bind=engine)
+    versions = migrate(engine)
+    print(f"Applied migrations: {versions}" if versions else "Schema is up to date")
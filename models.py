@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Table, DateTime, func, Boolean
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Table, DateTime, func, Boolean, Index
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -7,6 +7,8 @@ book_genre_association = Table(
     Base.metadata,
     Column("book_id", Integer, ForeignKey("books.id")),
     Column("genre_id", Integer, ForeignKey("genres.id")),
+    Index("ix_book_genre_book_id_genre_id", "book_id", "genre_id"),
+    Index("ix_book_genre_genre_id_book_id", "genre_id", "book_id"),
 )
 
 class Author(Base):
@@ -23,18 +25,21 @@ class Book(Base):
     __tablename__ = "books"
 
     id = Column(Integer, primary_key=True, index=True)
-    title = Column(String, nullable=False)
-    isbn = Column(String, nullable=False)
-    publish_date = Column(DateTime, nullable=False)
+    title = Column(String, nullable=False, index=True)
+    isbn = Column(String, nullable=False, index=True)
+    publish_date = Column(DateTime, nullable=False, index=True)
 
-    author_id = Column(Integer, ForeignKey("authors.id"))
+    author_id = Column(Integer, ForeignKey("authors.id"), index=True)
     author = relationship("Author", back_populates="books")
 
-    publisher_id = Column(Integer, ForeignKey("publishers.id"))
+    publisher_id = Column(Integer, ForeignKey("publishers.id"), index=True)
     publisher = relationship("Publisher", back_populates="books")
 
     genres = relationship("Genre", secondary=book_genre_association, back_populates="books")
 
+    # id of the open Borrow, maintained by the borrow/return routes; no FK to avoid a books <-> borrows cycle
+    active_borrow_id = Column(Integer, nullable=True)
+
     borrows = relationship("Borrow", back_populates="book")
     returns = relationship("Return", back_populates="book")
 
@@ -50,6 +55,10 @@ class Genre(Base):
 
 class Borrow(Base):
     __tablename__ = "borrows"
+    __table_args__ = (
+        Index("ix_borrows_book_id_is_done", "book_id", "is_done"),
+        Index("ix_borrows_user_id_is_done", "user_id", "is_done"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, nullable=False)
@@ -61,8 +70,67 @@ class Borrow(Base):
     created_at = Column(DateTime, server_default=func.now())
 
 
+class UserLoans(Base):
+    __tablename__ = "user_loans"
+
+    user_id = Column(Integer, primary_key=True)
+    active_count = Column(Integer, nullable=False, default=0)
+
+
+# circulation summaries, maintained by the borrow/return routes and rebuilt by `python -m circulation_stats`
+class BookStats(Base):
+    __tablename__ = "book_stats"
+    __table_args__ = (
+        Index("ix_book_stats_borrow_count", "borrow_count", "book_id"),
+    )
+
+    book_id = Column(Integer, primary_key=True)
+    borrow_count = Column(Integer, nullable=False, default=0)
+
+
+class GenreStats(Base):
+    __tablename__ = "genre_stats"
+    __table_args__ = (
+        Index("ix_genre_stats_borrow_count", "borrow_count", "genre_id"),
+    )
+
+    genre_id = Column(Integer, primary_key=True)
+    borrow_count = Column(Integer, nullable=False, default=0)
+    active_count = Column(Integer, nullable=False, default=0)
+
+
+class AuthorStats(Base):
+    __tablename__ = "author_stats"
+    __table_args__ = (
+        Index("ix_author_stats_active_count", "active_count", "author_id"),
+    )
+
+    author_id = Column(Integer, primary_key=True)
+    borrow_count = Column(Integer, nullable=False, default=0)
+    active_count = Column(Integer, nullable=False, default=0)
+
+
+# first successful response to a borrow/return sent with an Idempotency-Key header
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        Index("ix_idempotency_keys_created_at", "created_at"),
+    )
+
+    scope = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=False)
+    body = Column(Text, nullable=False)
+
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
 class Return(Base):
     __tablename__ = "returns"
+    __table_args__ = (
+        Index("ix_returns_book_id_created_at", "book_id", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, nullable=False)
@@ -0,0 +1,28 @@
+import base64
+import json
+from fastapi import HTTPException
+
+
+def encode_cursor(sort_by: str, order: str, value, last_id: int) -> str:
+    """Packs the sort key of the last row on a page into an opaque url-safe token"""
+    payload = json.dumps({"s": sort_by, "o": order, "v": value, "id": last_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort_by: str, order: str, parse_value=None):
+    """Returns the (value, last_id) pair stored in a cursor issued for the same sort mode.
+
+    `parse_value` converts the stored value back; any error it raises is reported as an invalid cursor.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        value, last_id = payload["v"], int(payload["id"])
+        if payload["s"] != sort_by or payload["o"] != order:
+            raise ValueError("Cursor was issued for another sort mode")
+        if parse_value is not None:
+            value = parse_value(value)
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    return value, last_id
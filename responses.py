@@ -0,0 +1,23 @@
+import orjson
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
+
+
+class UTCORJSONResponse(ORJSONResponse):
+    """orjson encoding that matches the schemas' datetime output.
+
+    SQLite hands back naive datetimes that the schema validators mark as UTC, so they are
+    written as UTC with a `Z` suffix, like pydantic does for the validated models.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+
+
+def orjson_response(content, response: Response) -> UTCORJSONResponse:
+    """Encodes already-shaped content with orjson, skipping response_model validation.
+
+    Returning a Response directly drops headers set on the injected `response`
+    (ETag, cursors), so they are carried over here.
+    """
+    return UTCORJSONResponse(content, headers=dict(response.headers))
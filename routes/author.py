@@ -1,9 +1,12 @@
 from typing import List
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Response
 from sqlalchemy import exc
 from sqlalchemy.orm import Session
-from database import get_db
+from cache import reference_cache
+from database import get_db, get_read_db
+from loaders import book_rows_query, book_rows_to_dicts
 from models import Author, Book
+from responses import orjson_response
 from schemas import AuthorCreate, BookResponse
 
 router = APIRouter()
@@ -11,11 +14,12 @@ router = APIRouter()
 @router.get('/author/{author_id}/books', response_model=List[BookResponse])
 def get_author_books(
         author_id: int,
-        db: Session = Depends(get_db)
+        response: Response,
+        db: Session = Depends(get_read_db)
 ):
-    books = db.query(Book).filter(Book.author_id == author_id).all()
+    rows = db.execute(book_rows_query().where(Book.author_id == author_id)).all()
 
-    return books
+    return orjson_response(book_rows_to_dicts(db, rows), response)
 
 @router.post('/author/', response_model=AuthorCreate)
 def create_author(
@@ -37,4 +41,5 @@ def create_author(
         db.rollback()
         raise HTTPException(status_code=500, detail="Failed to create book")
 
+    reference_cache.invalidate("authors")
     return new_author
\ No newline at end of file
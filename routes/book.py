@@ -1,43 +1,219 @@
-from fastapi import APIRouter, Depends, Query, HTTPException
+import json
+import logging
+import re
+from datetime import datetime, timezone
+from fastapi import APIRouter, Depends, Query, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from sqlalchemy import asc, desc, exc
-from database import get_db
-from models import Book, Author, Genre, Borrow, Return
-from schemas import BookResponse, BookCreate, BookHistoryResponse
-from typing import List, Optional
+from pydantic import ValidationError
+from sqlalchemy import (
+    String, asc, desc, exc, exists, func, insert, literal, null, select, text, true, tuple_, type_coerce, union_all,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+from bulk_io import CSV_TYPES, NDJSON_TYPES, encode_csv, encode_ndjson, iter_records
+from cache import page_cache, reference_cache
+from conditional import conditional_get, request_table_versions
+from counts import COUNT_MODES, filtered_count, listed_book_count, set_total_count
+from database import get_async_db, get_read_db
+from loaders import book_load_options, book_rows_query, book_rows_to_dicts
+from pagination import decode_cursor, encode_cursor
+from responses import orjson_response
+from models import Book, Author, Genre, Borrow, Return, book_genre_association
+from schemas import (
+    BookResponse, BookCreate, BookHistoryEvent, BookHistoryResponse, BookTimelineResponse, BulkImportError,
+    BulkImportResponse,
+)
+from typing import List, Optional, Union
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
-@router.get("/books", response_model=List[BookResponse])
+# tables a GET /books page is read from
+BOOK_LIST_TABLES = ("books", "authors", "genres", "book_genre")
+
+def sqlite_timestamp(value: datetime) -> str:
+    """Formats a datetime the way SQLite stores timestamps, so string comparisons line up.
+
+    Rows stamped by CURRENT_TIMESTAMP have no fraction, so whole seconds are written without one.
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(sep=" ", timespec="seconds" if not value.microsecond else "microseconds")
+
+def book_filters(genre_ids, genre_match, author_id, publisher_id, published_since, published_before):
+    """WHERE clauses for the GET /books filters.
+
+    Genres are matched with EXISTS on book_genre rather than a join, so a book in several
+    of the requested genres still comes back once; `all` adds one EXISTS per genre.
+    """
+    clauses = []
+    genre_ids = list(dict.fromkeys(genre_ids))
+    if genre_ids:
+        def has_genre(*ids):
+            return exists().where(
+                book_genre_association.c.book_id == Book.id,
+                book_genre_association.c.genre_id.in_(ids),
+            )
+
+        if genre_match == "all":
+            clauses += [has_genre(genre_id) for genre_id in genre_ids]
+        else:
+            clauses.append(has_genre(*genre_ids))
+    if author_id is not None:
+        clauses.append(Book.author_id == author_id)
+    if publisher_id is not None:
+        clauses.append(Book.publisher_id == publisher_id)
+    if published_since is not None:
+        clauses.append(type_coerce(Book.publish_date, String) >= sqlite_timestamp(published_since))
+    if published_before is not None:
+        clauses.append(type_coerce(Book.publish_date, String) < sqlite_timestamp(published_before))
+    return clauses
+
+def parse_publish_date_cursor(value):
+    if not isinstance(value, str):
+        raise ValueError("Malformed publish_date cursor")
+    datetime.fromisoformat(value)
+    return value
+
+@router.get(
+    "/books",
+    response_model=List[BookResponse],
+    dependencies=[Depends(conditional_get(*BOOK_LIST_TABLES))],
+)
 def get_books(
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_read_db),
     limit: int = Query(10, ge=1, le=100),
     offset: int = Query(0, ge=0),
     sort_by: Optional[str] = Query(None, pattern="^(title|publish_date|author)$"),
     order: str = Query("asc", pattern="^(asc|desc)$"),
+    cursor: Optional[str] = Query(None),
+    genre_ids: List[int] = Query([]),
+    genre_match: str = Query("any", pattern="^(any|all)$"),
+    author_id: Optional[int] = Query(None),
+    publisher_id: Optional[int] = Query(None),
+    published_since: Optional[datetime] = Query(None),
+    published_before: Optional[datetime] = Query(None),
+    count: Optional[str] = Query(None, pattern=COUNT_MODES),
 ):
-    query = db.query(Book).join(Author)
+    filters = book_filters(genre_ids, genre_match, author_id, publisher_id, published_since, published_before)
+    query = book_rows_query().where(*filters)
 
-    if sort_by:
-        if sort_by == "author":
-            order_by_column = Author.name
-        else:
-            order_by_column = getattr(Book, sort_by)
+    if count and not filters:
+        set_total_count(response, listed_book_count(db), exact=True)
+    elif count:
+        key = (
+            "books", tuple(sorted(set(genre_ids))), genre_match, author_id, publisher_id,
+            published_since and sqlite_timestamp(published_since), published_before and sqlite_timestamp(published_before),
+        )
+        count_statement = select(func.count()).select_from(Book).join(Author, Book.author_id == Author.id).where(*filters)
+        set_total_count(response, *filtered_count(request, db, key, ("books", "authors", "book_genre"), count_statement, count))
 
-        query = query.order_by(desc(order_by_column) if order == "desc" else asc(order_by_column))
+    if sort_by == "author":
+        order_by_column = Author.name
+    elif sort_by == "publish_date":
+        # compared and carried in cursors as stored text, like the date filters: a datetime bind
+        # renders a fraction that rows stored as whole seconds would sort below
+        order_by_column = type_coerce(Book.publish_date, String)
+        query = query.add_columns(order_by_column.label("publish_date_key"))
+    elif sort_by:
+        order_by_column = getattr(Book, sort_by)
+    else:
+        order_by_column = None
 
-    books = query.offset(offset).limit(limit).all()
-    return books
+    sort_key = (order_by_column, Book.id) if order_by_column is not None else (Book.id,)
+    direction = desc if order == "desc" else asc
+
+    if cursor is not None:
+        if cursor:
+            parse_value = parse_publish_date_cursor if sort_by == "publish_date" else None
+            value, last_id = decode_cursor(cursor, sort_by, order, parse_value)
+            last_key = (value, last_id) if order_by_column is not None else (last_id,)
+            if order == "desc":
+                query = query.where(tuple_(*sort_key) < tuple_(*last_key))
+            else:
+                query = query.where(tuple_(*sort_key) > tuple_(*last_key))
+        query = query.order_by(*[direction(column) for column in sort_key])
+    else:
+        if sort_by:
+            query = query.order_by(*[direction(column) for column in sort_key])
+        query = query.offset(offset)
+
+    def load_page():
+        rows = db.execute(query.limit(limit)).all()
+        next_cursor = None
+        if len(rows) == limit:
+            last = rows[-1]
+            if sort_by == "author":
+                last_value = last.author_name
+            elif sort_by == "publish_date":
+                last_value = last.publish_date_key
+            elif sort_by:
+                last_value = getattr(last, sort_by)
+            else:
+                last_value = None
+            next_cursor = encode_cursor(sort_by, order, last_value, last.id)
+        return book_rows_to_dicts(db, rows), next_cursor
+
+    page_key = (
+        "books", limit, offset, sort_by, order, cursor, tuple(genre_ids), genre_match, author_id, publisher_id,
+        published_since, published_before,
+    )
+    version = request_table_versions(request, db, BOOK_LIST_TABLES)
+    content, next_cursor = page_cache.get_or_load(page_key, load_page, version)
+
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+
+    return orjson_response(content, response)
+
+def fts_query(q: str) -> str:
+    """Turns free text into an FTS5 query: every word must match, as a prefix, in any column"""
+    terms = re.findall(r"\w+", q)
+    return " ".join(f'"{term}"*' for term in terms)
+
+@router.get("/books/search", response_model=List[BookResponse])
+def search_books(
+    db: Session = Depends(get_read_db),
+    q: str = Query(..., min_length=1),
+    limit: int = Query(10, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+):
+    query = fts_query(q)
+    if not query:
+        return []
+
+    # title matches weigh twice as much as author matches
+    book_ids = db.execute(
+        text(
+            "SELECT rowid FROM book_search WHERE book_search MATCH :query"
+            " ORDER BY bm25(book_search, 2.0, 1.0), rowid LIMIT :limit OFFSET :offset"
+        ),
+        {"query": query, "limit": limit, "offset": offset},
+    ).scalars().all()
+
+    books = db.query(Book).options(*book_load_options()).filter(Book.id.in_(book_ids)).all()
+    rank = {book_id: position for position, book_id in enumerate(book_ids)}
+    return sorted(books, key=lambda book: rank[book.id])
 
 @router.post("/books/", response_model=BookCreate)
-async def create_book(book: BookCreate, db: Session = Depends(get_db)):
-    author = db.query(Author).filter(Author.id == book.author_id).first()
-    if not author:
-        raise HTTPException(status_code=404, detail="Author not found")
+async def create_book(book: BookCreate, db: AsyncSession = Depends(get_async_db)):
+    # only existence is cached, so an author or genre created a moment ago is still found
+    if reference_cache.get(("authors", "id", book.author_id)) is None:
+        if await db.scalar(select(Author.id).where(Author.id == book.author_id)) is None:
+            raise HTTPException(status_code=404, detail="Author not found")
+        reference_cache.set(("authors", "id", book.author_id), True)
 
-    genres = db.query(Genre).filter(Genre.id.in_(book.genre_ids)).all()
-    if len(genres) != len(book.genre_ids):
-        raise HTTPException(status_code=404, detail="One or more genres not found")
+    genre_ids = list(dict.fromkeys(book.genre_ids))
+    unknown_genre_ids = [genre_id for genre_id in genre_ids if reference_cache.get(("genres", "id", genre_id)) is None]
+    if unknown_genre_ids:
+        found = (await db.scalars(select(Genre.id).where(Genre.id.in_(unknown_genre_ids)))).all()
+        if len(found) != len(unknown_genre_ids):
+            raise HTTPException(status_code=404, detail="One or more genres not found")
+        for genre_id in found:
+            reference_cache.set(("genres", "id", genre_id), True)
 
     new_book = Book(
         title=book.title,
@@ -45,15 +221,20 @@ async def create_book(book: BookCreate, db: Session = Depends(get_db)):
         publish_date=book.publish_date,
         publisher_id=book.publisher_id,
         author_id=book.author_id,
-        genres=genres
     )
 
     db.add(new_book)
     try:
-        db.commit()
-        db.refresh(new_book)
+        await db.flush()
+        if genre_ids:
+            await db.execute(
+                insert(book_genre_association),
+                [{"book_id": new_book.id, "genre_id": genre_id} for genre_id in genre_ids],
+            )
+        await db.commit()
+        await db.refresh(new_book)
     except exc.SQLAlchemyError as e:
-        db.rollback()
+        await db.rollback()
         print(e._message())
         raise HTTPException(status_code=500, detail="Failed to create book")
 
@@ -61,15 +242,256 @@ async def create_book(book: BookCreate, db: Session = Depends(get_db)):
 
 
 
-@router.get("/books/{book_id}/history", response_model=BookHistoryResponse)
-def get_book_history(book_id: int, db: Session = Depends(get_db)):
-    book = db.query(Book).filter(Book.id == book_id).first()
+BULK_BATCH_SIZE = 1000
+
+async def insert_book_batch(db: AsyncSession, batch, report: BulkImportResponse):
+    """Resolves the batch's authors and genres with one IN query each and inserts it in one transaction"""
+    author_ids = {book.author_id for _, book in batch}
+    genre_ids = {genre_id for _, book in batch for genre_id in book.genre_ids}
+    known_authors = set((await db.scalars(select(Author.id).where(Author.id.in_(author_ids)))).all())
+    known_genres = set((await db.scalars(select(Genre.id).where(Genre.id.in_(genre_ids)))).all())
+
+    valid = []
+    for row, book in batch:
+        if book.author_id not in known_authors:
+            report.errors.append(BulkImportError(row=row, errors=["Author not found"]))
+        elif not known_genres.issuperset(book.genre_ids):
+            report.errors.append(BulkImportError(row=row, errors=["One or more genres not found"]))
+        else:
+            valid.append((row, book))
+
+    if not valid:
+        await db.rollback()
+        return
+
+    try:
+        # the write lock is held since BEGIN IMMEDIATE, so ids can be assigned up front instead of
+        # using RETURNING, which SQLite can only batch without a guaranteed row order
+        first_id = (await db.scalar(select(func.coalesce(func.max(Book.id), 0)))) + 1
+        book_ids = range(first_id, first_id + len(valid))
+        await db.execute(
+            insert(Book),
+            [{"id": book_id, **book.model_dump(exclude={"genre_ids"})} for book_id, (_, book) in zip(book_ids, valid)],
+        )
+        links = [
+            {"book_id": book_id, "genre_id": genre_id}
+            for book_id, (_, book) in zip(book_ids, valid)
+            for genre_id in dict.fromkeys(book.genre_ids)
+        ]
+        if links:
+            await db.execute(insert(book_genre_association), links)
+        await db.commit()
+    except exc.SQLAlchemyError:
+        await db.rollback()
+        logger.exception("Bulk import batch of %d books failed", len(valid))
+        report.errors.extend(BulkImportError(row=row, errors=["Failed to insert batch"]) for row, _ in valid)
+        return
+
+    report.imported += len(valid)
+
+@router.post("/books/bulk", response_model=BulkImportResponse)
+async def create_books_bulk(
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    batch_size: int = Query(BULK_BATCH_SIZE, ge=1, le=10000),
+):
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in NDJSON_TYPES + CSV_TYPES:
+        raise HTTPException(status_code=415, detail="Body must be NDJSON or CSV")
+
+    report = BulkImportResponse()
+    batch = []
+    async for row, record in iter_records(request.stream(), content_type):
+        if isinstance(record, ValueError):
+            report.errors.append(BulkImportError(row=row, errors=[f"Malformed row: {record}"]))
+            continue
+        try:
+            batch.append((row, BookCreate.model_validate(record)))
+        except ValidationError as e:
+            report.errors.append(BulkImportError(
+                row=row,
+                errors=[f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()],
+            ))
+            continue
+
+        if len(batch) >= batch_size:
+            await insert_book_batch(db, batch, report)
+            batch = []
+
+    if batch:
+        await insert_book_batch(db, batch, report)
+
+    report.errors.sort(key=lambda error: error.row)
+    report.failed = len(report.errors)
+    return report
 
-    if not book:
+
+
+EXPORT_BATCH_SIZE = 1000
+
+def iter_book_export(bind, export_format: str):
+    """Streams the catalogue in EXPORT_BATCH_SIZE partitions of one server-side cursor"""
+    genres = (
+        select(func.json_group_array(Genre.name))
+        .select_from(book_genre_association.join(Genre))
+        .where(book_genre_association.c.book_id == Book.id)
+        .scalar_subquery()
+    )
+    genre_ids = (
+        select(func.json_group_array(book_genre_association.c.genre_id))
+        .where(book_genre_association.c.book_id == Book.id)
+        .scalar_subquery()
+    )
+    query = (
+        select(
+            Book.id, Book.title, Book.isbn, Book.publish_date, Book.author_id,
+            Author.name.label("author"), Book.publisher_id, genres.label("genres"), genre_ids.label("genre_ids"),
+        )
+        .join(Author, isouter=True)
+        .order_by(Book.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+    if export_format == "csv":
+        yield encode_csv([], header=True)
+
+    # the request's session is closed before the body is streamed, so the export owns its own
+    with Session(bind) as session:
+        for partition in session.execute(query).partitions():
+            records = [
+                {
+                    **row._asdict(),
+                    "publish_date": row.publish_date.isoformat(),
+                    "genres": json.loads(row.genres),
+                    "genre_ids": json.loads(row.genre_ids),
+                }
+                for row in partition
+            ]
+            yield encode_csv(records) if export_format == "csv" else encode_ndjson(records)
+
+@router.get("/books/export")
+def export_books(
+    db: Session = Depends(get_read_db),
+    export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+):
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        iter_book_export(db.get_bind(), export_format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="books.{export_format}"'},
+    )
+
+
+
+HISTORY_EVENT_TYPES = ("borrow", "return")
+
+
+def parse_history_cursor(value):
+    created_at, event_type = value
+    if not isinstance(created_at, str) or event_type not in HISTORY_EVENT_TYPES:
+        raise ValueError("Malformed history cursor")
+    return created_at, event_type
+
+
+def book_history_query(book_id: int, since, until, order: str, cursor, limit: int):
+    """One round trip: the book row left-joined to one page of its merged borrow/return events.
+
+    No row means the book does not exist; a single row with NULL event columns means no events.
+    `created_at` is compared and returned as stored text, so cursors match rows exactly.
+    """
+    branches = []
+    for event_type, model, is_done in (("borrow", Borrow, Borrow.is_done), ("return", Return, null())):
+        created_at = type_coerce(model.created_at, String)
+        branch = select(
+            literal(event_type).label("type"),
+            model.id.label("id"),
+            model.user_id.label("user_id"),
+            is_done.label("is_done"),
+            created_at.label("created_at"),
+        ).where(model.book_id == book_id)
+        if since is not None:
+            branch = branch.where(created_at >= sqlite_timestamp(since))
+        if until is not None:
+            branch = branch.where(created_at < sqlite_timestamp(until))
+        branches.append(branch)
+
+    events = union_all(*branches).subquery("events")
+    sort_key = (events.c.created_at, events.c.type, events.c.id)
+    direction = desc if order == "desc" else asc
+
+    page = select(events)
+    if cursor is not None:
+        (last_created_at, last_type), last_id = cursor
+        last_key = tuple_(literal(last_created_at), literal(last_type), literal(last_id))
+        page = page.where(tuple_(*sort_key) < last_key if order == "desc" else tuple_(*sort_key) > last_key)
+    page = page.order_by(*[direction(column) for column in sort_key]).limit(limit).subquery("page")
+
+    return (
+        select(Book.id.label("book_id"), page)
+        .select_from(Book)
+        .outerjoin(page, true())
+        .where(Book.id == book_id)
+        .order_by(*[direction(page.c[column.name]) for column in sort_key])
+    )
+
+
+def require_book(request: Request, db: Session) -> bool:
+    """Checked before answering 304, so a missing book is a 404 whatever the validators say"""
+    try:
+        book_id = int(request.path_params["book_id"])
+    except ValueError:
+        return False  # path validation answers 422
+    if db.scalar(select(Book.id).where(Book.id == book_id)) is None:
         raise HTTPException(status_code=404, detail="Book not found")
+    return True
 
-    borrows = db.query(Borrow).filter(Borrow.book_id == book_id).all()
-    returns = db.query(Return).filter(Return.book_id == book_id).all()
 
-    return BookHistoryResponse(borrows=borrows, returns=returns)
+@router.get(
+    "/books/{book_id}/history",
+    response_model=Union[BookHistoryResponse, BookTimelineResponse],
+    dependencies=[Depends(conditional_get("books", "borrows", "returns", require=require_book))],
+)
+def get_book_history(
+    book_id: int,
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_read_db),
+    limit: int = Query(100, ge=1, le=1000),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    since: Optional[datetime] = Query(None),
+    until: Optional[datetime] = Query(None),
+    cursor: Optional[str] = Query(None),
+    timeline: bool = Query(False),
+):
+    last_key = decode_cursor(cursor, "created_at", order, parse_history_cursor) if cursor else None
+    rows = db.execute(book_history_query(book_id, since, until, order, last_key, limit)).all()
+
+    if not rows:
+        raise HTTPException(status_code=404, detail="Book not found")
 
+    events = [
+        BookHistoryEvent(
+            type=row.type,
+            id=row.id,
+            user_id=row.user_id,
+            book_id=book_id,
+            is_done=row.is_done,
+            created_at=datetime.fromisoformat(row.created_at),
+        )
+        for row in rows
+        if row.id is not None
+    ]
+
+    if len(events) == limit:
+        last = rows[-1]
+        next_cursor = encode_cursor("created_at", order, [last.created_at, last.type], last.id)
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+
+    if timeline:
+        return BookTimelineResponse(events=events)
+
+    return BookHistoryResponse(
+        borrows=[event.model_dump(exclude={"type"}) for event in events if event.type == "borrow"],
+        returns=[event.model_dump(exclude={"type", "is_done"}) for event in events if event.type == "return"],
+    )
@@ -1,63 +1,268 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import exc
-from database import get_db
-from models import Borrow, Return, Book
-from schemas import BorrowCreate, ReturnCreate
+from fastapi import APIRouter, BackgroundTasks, Depends, Header, HTTPException
+from sqlalchemy import exc, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from circulation_stats import borrowed, record_circulation, returned
+from database import get_async_db
+from idempotency import (
+    MAX_KEY_LENGTH, find_response, purge_schedule, remember, replay, request_fingerprint, store_response,
+)
+from models import Borrow, Return, Book, UserLoans
+from schemas import BorrowCreate, CirculationBatch, CirculationBatchResponse, CirculationResult, ReturnCreate
+from typing import Optional
 
 router = APIRouter()
 
 MAX_BORROW_COUNT = 3
 
 @router.post("/borrow/", response_model=BorrowCreate)
-async def create_genre(borrow: BorrowCreate, db: Session = Depends(get_db)):
-    book = db.query(Book).filter(Book.id == borrow.book_id).first()
-    if not book:
-        raise HTTPException(status_code=404, detail="Book not found")
-
-    same_book_borrow = db.query(Borrow).filter(Borrow.book_id == borrow.book_id).first()
-
-    if same_book_borrow and not same_book_borrow.is_done:
-        raise HTTPException(status_code=400, detail="Book already borrowed")
-
-    user_borrow_count = db.query(Borrow).filter(Borrow.user_id == borrow.user_id).count()
-    if user_borrow_count >= MAX_BORROW_COUNT:
-        raise HTTPException(status_code=400, detail="User already borrowed too much books")
-
+async def create_borrow(
+    borrow: BorrowCreate,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db),
+    idempotency_key: Optional[str] = Header(None, min_length=1, max_length=MAX_KEY_LENGTH),
+):
+    # the session starts with BEGIN IMMEDIATE, so the conditional updates below cannot interleave
+    # with another borrow or return; any failed admission rolls the whole transaction back
     new_borrow = Borrow(
        book_id = borrow.book_id,
        user_id = borrow.user_id,
        is_done = False
     )
 
-    db.add(new_borrow)
+    fingerprint = request_fingerprint(borrow)
+    stored = None
+
     try:
-        db.commit()
-        db.refresh(new_borrow)
+        if idempotency_key:
+            replayable = await find_response(db, "borrow", idempotency_key)
+            if replayable is not None:
+                return replay(replayable, fingerprint)
+
+        db.add(new_borrow)
+        await db.flush()
+
+        claimed = await db.execute(
+            update(Book)
+            .where(Book.id == borrow.book_id, Book.active_borrow_id.is_(None))
+            .values(active_borrow_id=new_borrow.id)
+            .execution_options(synchronize_session=False)
+        )
+        if claimed.rowcount == 0:
+            await db.rollback()
+            if await db.scalar(select(Book.id).where(Book.id == borrow.book_id)) is None:
+                raise HTTPException(status_code=404, detail="Book not found")
+            raise HTTPException(status_code=400, detail="Book already borrowed")
+
+        counted = await db.execute(
+            insert(UserLoans)
+            .values(user_id=borrow.user_id, active_count=1)
+            .on_conflict_do_update(
+                index_elements=[UserLoans.user_id],
+                set_={"active_count": UserLoans.active_count + 1},
+                where=UserLoans.active_count < MAX_BORROW_COUNT,
+            )
+        )
+        if counted.rowcount == 0:
+            await db.rollback()
+            raise HTTPException(status_code=400, detail="User already borrowed too much books")
+
+        await record_circulation(db, [borrowed(borrow.book_id)])
+        if idempotency_key:
+            stored = await store_response(
+                db, "borrow", idempotency_key, fingerprint, BorrowCreate.model_validate(new_borrow, from_attributes=True)
+            )
+
+        await db.commit()
+        await db.refresh(new_borrow)
     except exc.SQLAlchemyError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Failed to create borrow")
 
+    if stored is not None:
+        remember("borrow", idempotency_key, stored)
+        purge_schedule.maybe_schedule(background_tasks, db.bind)
     return new_borrow
 
 @router.post("/return/", response_model=ReturnCreate)
-async def create_genre(returnBook: ReturnCreate, db: Session = Depends(get_db)):
-    borrow = db.query(Borrow).filter(Borrow.user_id == returnBook.user_id and Borrow.book_id == returnBook.book_id).first()
+async def create_return(
+    returnBook: ReturnCreate,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db),
+    idempotency_key: Optional[str] = Header(None, min_length=1, max_length=MAX_KEY_LENGTH),
+):
+    active_borrow_id = (
+        select(Book.active_borrow_id).where(Book.id == returnBook.book_id).scalar_subquery()
+    )
+    new_return = Return(book_id = returnBook.book_id, user_id = returnBook.user_id)
+    fingerprint = request_fingerprint(returnBook)
+    stored = None
 
-    if not borrow:
-        raise HTTPException(status_code=404, detail="Borrow with for this book and user not found")
+    try:
+        if idempotency_key:
+            replayable = await find_response(db, "return", idempotency_key)
+            if replayable is not None:
+                return replay(replayable, fingerprint)
 
-    new_return = Return(book_id = returnBook.book_id, user_id = returnBook.user_id)
+        closed = await db.execute(
+            update(Borrow)
+            .where(Borrow.id == active_borrow_id, Borrow.user_id == returnBook.user_id)
+            .values(is_done=True)
+            .execution_options(synchronize_session=False)
+        )
+        if closed.rowcount == 0:
+            await db.rollback()
+            raise HTTPException(status_code=404, detail="Borrow with for this book and user not found")
 
-    borrow.is_done = True
-    db.add(new_return)
+        await db.execute(
+            update(Book)
+            .where(Book.id == returnBook.book_id)
+            .values(active_borrow_id=None)
+            .execution_options(synchronize_session=False)
+        )
+        await db.execute(
+            update(UserLoans)
+            .where(UserLoans.user_id == returnBook.user_id)
+            .values(active_count=UserLoans.active_count - 1)
+            .execution_options(synchronize_session=False)
+        )
+        await record_circulation(db, [returned(returnBook.book_id)])
+        db.add(new_return)
+        if idempotency_key:
+            stored = await store_response(
+                db, "return", idempotency_key, fingerprint, ReturnCreate.model_validate(new_return, from_attributes=True)
+            )
 
-    try:
-        db.commit()
-        db.refresh(new_return)
-        db.refresh(borrow)
+        await db.commit()
+        await db.refresh(new_return)
     except exc.SQLAlchemyError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Failed to create borrow")
 
+    if stored is not None:
+        remember("return", idempotency_key, stored)
+        purge_schedule.maybe_schedule(background_tasks, db.bind)
     return new_return
+
+async def load_circulation_state(db: AsyncSession, operations):
+    """One IN lookup per table: the books' open borrows, who holds them and the users' loan counts"""
+    book_ids = {operation.book_id for operation in operations}
+    user_ids = {operation.user_id for operation in operations}
+
+    books = dict((await db.execute(select(Book.id, Book.active_borrow_id).where(Book.id.in_(book_ids)))).all())
+    open_borrow_ids = [borrow_id for borrow_id in books.values() if borrow_id is not None]
+    holders = {}
+    if open_borrow_ids:
+        holders = dict((await db.execute(
+            select(Borrow.id, Borrow.user_id).where(Borrow.id.in_(open_borrow_ids))
+        )).all())
+    loans = dict((await db.execute(
+        select(UserLoans.user_id, UserLoans.active_count).where(UserLoans.user_id.in_(user_ids))
+    )).all())
+    return books, holders, loans
+
+def open_borrow_id(state):
+    if state is None:
+        return None
+    _, borrow = state
+    return borrow["id"] if isinstance(borrow, dict) else borrow
+
+async def insert_rows(db: AsyncSession, model, rows):
+    """Inserts the rows in one multi-row INSERT and sets their ids.
+
+    The write lock is held since BEGIN IMMEDIATE, so ids are assigned up front from max(id),
+    as the bulk book import does, instead of relying on the order of RETURNING rows.
+    """
+    if rows:
+        first_id = (await db.scalar(select(func.coalesce(func.max(model.id), 0)))) + 1
+        for row_id, row in enumerate(rows, start=first_id):
+            row["id"] = row_id
+        await db.execute(insert(model), rows)
+
+@router.post("/circulation/batch", response_model=CirculationBatchResponse)
+async def create_circulation_batch(batch: CirculationBatch, db: AsyncSession = Depends(get_async_db)):
+    # operations are checked in order against state read inside this BEGIN IMMEDIATE transaction,
+    # so each one sees the effect of the earlier ones (a book can be returned and borrowed again)
+    report = CirculationBatchResponse()
+    applied = []
+
+    try:
+        books, holders, loans = await load_circulation_state(db, batch.operations)
+        # book id -> (user id, open borrow), the borrow being an id or a row added by this batch
+        active = {
+            book_id: (holders.get(borrow_id), borrow_id)
+            for book_id, borrow_id in books.items() if borrow_id is not None
+        }
+        new_borrows, new_returns, closed_borrow_ids, deltas = [], [], [], []
+
+        for index, operation in enumerate(batch.operations):
+            result = CirculationResult(index=index, **operation.model_dump(), status_code=200)
+            report.results.append(result)
+            holder, borrow = active.get(operation.book_id) or (None, None)
+
+            if operation.type == "borrow":
+                if operation.book_id not in books:
+                    result.status_code, result.detail = 404, "Book not found"
+                elif borrow is not None:
+                    result.status_code, result.detail = 400, "Book already borrowed"
+                elif loans.get(operation.user_id, 0) >= MAX_BORROW_COUNT:
+                    result.status_code, result.detail = 400, "User already borrowed too much books"
+                else:
+                    row = {"book_id": operation.book_id, "user_id": operation.user_id, "is_done": False}
+                    new_borrows.append(row)
+                    applied.append((result, row))
+                    active[operation.book_id] = (operation.user_id, row)
+                    loans[operation.user_id] = loans.get(operation.user_id, 0) + 1
+                    deltas.append(borrowed(operation.book_id))
+            else:
+                if borrow is None or holder != operation.user_id:
+                    result.status_code, result.detail = 404, "Borrow with for this book and user not found"
+                else:
+                    if isinstance(borrow, dict):
+                        borrow["is_done"] = True
+                    else:
+                        closed_borrow_ids.append(borrow)
+                    row = {"book_id": operation.book_id, "user_id": operation.user_id}
+                    new_returns.append(row)
+                    applied.append((result, row))
+                    active[operation.book_id] = None
+                    # like POST /return/, a holder without a user_loans row just stays at zero
+                    loans[operation.user_id] = max(loans.get(operation.user_id, 0) - 1, 0)
+                    deltas.append(returned(operation.book_id))
+
+        if applied:
+            await insert_rows(db, Borrow, new_borrows)
+            await insert_rows(db, Return, new_returns)
+            if closed_borrow_ids:
+                await db.execute(
+                    update(Borrow)
+                    .where(Borrow.id.in_(closed_borrow_ids))
+                    .values(is_done=True)
+                    .execution_options(synchronize_session=False)
+                )
+
+            book_ids = {result.book_id for result, _ in applied}
+            await db.execute(update(Book), [
+                {"id": book_id, "active_borrow_id": open_borrow_id(active.get(book_id))} for book_id in book_ids
+            ])
+            user_ids = {result.user_id for result, _ in applied}
+            counts = insert(UserLoans)
+            await db.execute(
+                counts.on_conflict_do_update(
+                    index_elements=[UserLoans.user_id],
+                    set_={"active_count": counts.excluded.active_count},
+                ),
+                [{"user_id": user_id, "active_count": loans[user_id]} for user_id in user_ids],
+            )
+            await record_circulation(db, deltas)
+
+            await db.commit()
+    except exc.SQLAlchemyError:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail="Failed to apply circulation batch")
+
+    for result, row in applied:
+        result.id = row["id"]
+    report.applied = len(applied)
+    report.failed = len(report.results) - len(applied)
+    return report
@@ -1,27 +1,39 @@
-from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi import APIRouter, Depends, Query, HTTPException, Request, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import exc
-from database import get_db
+from sqlalchemy import exc, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import reference_cache
+from conditional import conditional_get, request_table_versions
+from counts import COUNT_MODES, set_total_count, table_row_count
+from database import get_async_db, get_read_db
 from models import Genre
-from schemas import GenreBase, GenreCreate
-from typing import List
+from schemas import GenreBase, GenreCreate, GenreResponse
+from typing import List, Optional
 
 router = APIRouter()
 
-@router.get("/genres/", response_model=List[GenreBase])
+@router.get("/genres/", response_model=List[GenreBase], dependencies=[Depends(conditional_get("genres"))])
 def get_genres(
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_read_db),
     limit: int = Query(10, ge=1, le=100),
     offset: int = Query(0, ge=0),
+    count: Optional[str] = Query(None, pattern=COUNT_MODES),
 ):
-    query = db.query(Genre)
+    if count:
+        set_total_count(response, table_row_count(db, "genres"), exact=True)
 
-    genres = query.offset(offset).limit(limit).all()
-    return genres
+    def load_genres():
+        query = db.query(Genre)
+        return [GenreResponse.model_validate(genre) for genre in query.offset(offset).limit(limit).all()]
+
+    version = request_table_versions(request, db, ("genres",))
+    return reference_cache.get_or_load(("genres", "page", limit, offset), load_genres, version)
 
 @router.post("/genres/", response_model=GenreCreate)
-async def create_genre(genre: GenreCreate, db: Session = Depends(get_db)):
-    duplicate_genre = db.query(Genre).filter(Genre.name == genre.name).first()
+async def create_genre(genre: GenreCreate, db: AsyncSession = Depends(get_async_db)):
+    duplicate_genre = await db.scalar(select(Genre).where(Genre.name == genre.name))
     if duplicate_genre:
         raise HTTPException(status_code=400, detail="Publisher already exist")
 
@@ -31,10 +43,12 @@ async def create_genre(genre: GenreCreate, db: Session = Depends(get_db)):
 
     db.add(new_genre)
     try:
-        db.commit()
-        db.refresh(new_genre)
+        await db.commit()
+        await db.refresh(new_genre)
     except exc.SQLAlchemyError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Failed to create genre")
 
+    reference_cache.invalidate("genres")
+
     return new_genre
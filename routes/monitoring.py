@@ -0,0 +1,29 @@
+import os
+import secrets
+from admission import admission_controller
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from metrics import CONTENT_TYPE, registry
+from schemas import SlowRequest
+from slow_queries import slow_query_log
+from typing import List, Optional
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+router = APIRouter()
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Admin routes need an X-Admin-Token header matching ADMIN_TOKEN; without ADMIN_TOKEN they are closed"""
+    if not ADMIN_TOKEN or not secrets.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@router.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(registry.render() + admission_controller.render(), media_type=CONTENT_TYPE)
+
+@router.get("/admin/slow-queries", response_model=List[SlowRequest], dependencies=[Depends(require_admin)])
+def get_slow_queries():
+    return slow_query_log.entries()
+
+@router.delete("/admin/slow-queries", status_code=204, dependencies=[Depends(require_admin)])
+def clear_slow_queries():
+    slow_query_log.clear()
@@ -1,27 +1,39 @@
-from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi import APIRouter, Depends, Query, HTTPException, Request, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import exc
-from database import get_db
+from sqlalchemy import exc, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import reference_cache
+from conditional import conditional_get, request_table_versions
+from counts import COUNT_MODES, set_total_count, table_row_count
+from database import get_async_db, get_read_db
 from models import Publisher
-from schemas import PublisherBase, PublisherCreate
-from typing import List
+from schemas import PublisherBase, PublisherCreate, PublisherResponse
+from typing import List, Optional
 
 router = APIRouter()
 
-@router.get("/publishers/", response_model=List[PublisherBase])
+@router.get("/publishers/", response_model=List[PublisherBase], dependencies=[Depends(conditional_get("publishers"))])
 def get_publishers(
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_read_db),
     limit: int = Query(10, ge=1, le=100),
     offset: int = Query(0, ge=0),
+    count: Optional[str] = Query(None, pattern=COUNT_MODES),
 ):
-    query = db.query(Publisher)
+    if count:
+        set_total_count(response, table_row_count(db, "publishers"), exact=True)
 
-    publishers = query.offset(offset).limit(limit).all()
-    return publishers
+    def load_publishers():
+        query = db.query(Publisher)
+        return [PublisherResponse.model_validate(publisher) for publisher in query.offset(offset).limit(limit).all()]
+
+    version = request_table_versions(request, db, ("publishers",))
+    return reference_cache.get_or_load(("publishers", "page", limit, offset), load_publishers, version)
 
 @router.post("/publishers/", response_model=PublisherCreate)
-async def create_publisher(publisher: PublisherCreate, db: Session = Depends(get_db)):
-    duplicate_publisher = db.query(Publisher).filter(Publisher.name == publisher.name).first()
+async def create_publisher(publisher: PublisherCreate, db: AsyncSession = Depends(get_async_db)):
+    duplicate_publisher = await db.scalar(select(Publisher).where(Publisher.name == publisher.name))
     if duplicate_publisher:
         raise HTTPException(status_code=400, detail="Publisher already exist")
 
@@ -31,10 +43,12 @@ async def create_publisher(publisher: PublisherCreate, db: Session = Depends(get
 
     db.add(new_publisher)
     try:
-        db.commit()
-        db.refresh(new_publisher)
+        await db.commit()
+        await db.refresh(new_publisher)
     except exc.SQLAlchemyError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Failed to create publisher")
 
+    reference_cache.invalidate("publishers")
+
     return new_publisher
@@ -0,0 +1,59 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy import desc, select
+from sqlalchemy.orm import Session
+from database import get_read_db
+from models import Author, AuthorStats, Book, BookStats, Genre, GenreStats
+from schemas import AuthorCirculationStats, BookBorrowStats, GenreCirculationStats
+from typing import List
+
+router = APIRouter()
+
+# every listing walks its summary index backwards, so ties go to the higher id
+
+@router.get("/stats/books/most-borrowed", response_model=List[BookBorrowStats])
+def get_most_borrowed_books(
+    db: Session = Depends(get_read_db),
+    limit: int = Query(10, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+):
+    query = (
+        select(
+            BookStats.book_id, Book.title, BookStats.borrow_count,
+            Book.active_borrow_id.is_not(None).label("borrowed"),
+        )
+        .join(Book, Book.id == BookStats.book_id)
+        .order_by(desc(BookStats.borrow_count), desc(BookStats.book_id))
+        .offset(offset)
+        .limit(limit)
+    )
+    return db.execute(query).mappings().all()
+
+@router.get("/stats/genres", response_model=List[GenreCirculationStats])
+def get_genre_stats(
+    db: Session = Depends(get_read_db),
+    limit: int = Query(10, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+):
+    query = (
+        select(GenreStats.genre_id, Genre.name, GenreStats.borrow_count, GenreStats.active_count)
+        .join(Genre, Genre.id == GenreStats.genre_id)
+        .order_by(desc(GenreStats.borrow_count), desc(GenreStats.genre_id))
+        .offset(offset)
+        .limit(limit)
+    )
+    return db.execute(query).mappings().all()
+
+@router.get("/stats/authors", response_model=List[AuthorCirculationStats])
+def get_author_stats(
+    db: Session = Depends(get_read_db),
+    limit: int = Query(10, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+):
+    query = (
+        select(AuthorStats.author_id, Author.name, AuthorStats.borrow_count, AuthorStats.active_count)
+        .join(Author, Author.id == AuthorStats.author_id)
+        .order_by(desc(AuthorStats.active_count), desc(AuthorStats.author_id))
+        .offset(offset)
+        .limit(limit)
+    )
+    return db.execute(query).mappings().all()
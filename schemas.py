@@ -1,5 +1,5 @@
 from pydantic import BaseModel, field_validator, Field
-from typing import List, Optional
+from typing import List, Literal, Optional
 from datetime import datetime, timezone
 
 
@@ -65,6 +65,15 @@ class BookResponse(BookBase):
         "from_attributes": True
     }
 
+class BulkImportError(BaseModel):
+    row: int
+    errors: List[str]
+
+class BulkImportResponse(BaseModel):
+    imported: int = 0
+    failed: int = 0
+    errors: List[BulkImportError] = []
+
 # Borrow Schemas
 class BorrowBase(BaseModel):
     user_id: int
@@ -105,7 +114,83 @@ class PublisherBase(BaseModel):
 class PublisherCreate(PublisherBase):
     pass
 
+class PublisherResponse(PublisherBase):
+    id: int
+    model_config = {
+        "from_attributes": True
+    }
+
 # Book History Schema
 class BookHistoryResponse(BaseModel):
     borrows: List[BorrowResponse] = []
-    returns: List[ReturnResponse] = []
\ No newline at end of file
+    returns: List[ReturnResponse] = []
+
+class BookHistoryEvent(BaseModel):
+    type: str
+    id: int
+    user_id: int
+    book_id: int
+    is_done: Optional[bool] = None
+    created_at: datetime
+
+class BookTimelineResponse(BaseModel):
+    events: List[BookHistoryEvent] = []
+
+# Slow Query Log Schemas
+class SlowStatement(BaseModel):
+    statement: str
+    parameters: str
+    duration_ms: float
+    plan: Optional[List[str]] = None
+    full_scans: List[str] = []
+
+class SlowRequest(BaseModel):
+    at: datetime
+    method: str
+    route: str
+    status: int
+    duration_ms: float
+    query_count: int
+    statements: List[SlowStatement] = []
+
+# Circulation Stats Schemas
+class BookBorrowStats(BaseModel):
+    book_id: int
+    title: str
+    borrow_count: int
+    borrowed: bool
+
+class GenreCirculationStats(BaseModel):
+    genre_id: int
+    name: str
+    borrow_count: int
+    active_count: int
+
+class AuthorCirculationStats(BaseModel):
+    author_id: int
+    name: str
+    borrow_count: int
+    active_count: int
+
+# Circulation Batch Schemas
+class CirculationOperation(BaseModel):
+    type: Literal["borrow", "return"]
+    user_id: int
+    book_id: int
+
+class CirculationBatch(BaseModel):
+    operations: List[CirculationOperation] = Field(min_length=1, max_length=500)
+
+class CirculationResult(BaseModel):
+    index: int
+    type: str
+    user_id: int
+    book_id: int
+    status_code: int
+    id: Optional[int] = None
+    detail: Optional[str] = None
+
+class CirculationBatchResponse(BaseModel):
+    applied: int = 0
+    failed: int = 0
+    results: List[CirculationResult] = []
@@ -0,0 +1,165 @@
+"""Slow-request log with the SQLite query plans of the statements that made them slow.
+
+A request is logged when it takes at least SLOW_REQUEST_MS, or when one of its statements
+takes at least SLOW_QUERY_MS. Plans are captured with EXPLAIN QUERY PLAN right after a
+slow statement runs, on the same connection, so only slow statements pay for it. Full
+table scans (`SCAN <table>` without an index) are listed per statement and logged as
+warnings. The latest entries are kept in a bounded ring for GET /admin/slow-queries.
+
+While a request runs it only keeps the statements an entry could show (see `KeptStatements`),
+so a bulk import running thousands of statements doesn't hold on to all of their parameters.
+"""
+import heapq
+import itertools
+import logging
+import os
+import re
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+logger = logging.getLogger("slow_queries")
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", 500))
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 100))
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", 100))
+
+# statements shown per logged request: every slow one, topped up with the slowest of the rest
+STATEMENTS_PER_ENTRY = 5
+MAX_PARAMETERS_LENGTH = 500
+
+# older SQLite versions print "SCAN TABLE <table>"
+FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)\b(?! USING (?:COVERING )?INDEX)")
+
+
+def explain(dbapi_connection, statement: str, parameters, executemany: bool):
+    """Returns the EXPLAIN QUERY PLAN detail lines, or None when the statement can't be explained"""
+    if executemany:
+        parameters = parameters[0] if parameters else ()
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return [row[3] for row in cursor.fetchall()]
+    except Exception:
+        return None
+    finally:
+        cursor.close()
+
+
+def full_scans(plan) -> list:
+    """Tables the plan reads in full, e.g. `SCAN borrows`"""
+    scans = []
+    for detail in plan or ():
+        match = FULL_SCAN.match(detail)
+        if match:
+            scans.append(match.group(1))
+    return scans
+
+
+def format_parameters(parameters, executemany: bool) -> str:
+    if executemany:
+        text = f"{len(parameters)} rows, first {parameters[0]!r}" if parameters else "0 rows"
+    else:
+        text = repr(parameters)
+    return text if len(text) <= MAX_PARAMETERS_LENGTH else text[:MAX_PARAMETERS_LENGTH] + "..."
+
+
+class StatementRecord:
+    __slots__ = ("statement", "parameters", "executemany", "seconds", "plan")
+
+    def __init__(self, statement, parameters, executemany, seconds, plan=None):
+        self.statement = statement
+        self.parameters = parameters
+        self.executemany = executemany
+        self.seconds = seconds
+        self.plan = plan
+
+    def to_dict(self) -> dict:
+        return {
+            "statement": self.statement,
+            "parameters": format_parameters(self.parameters, self.executemany),
+            "duration_ms": round(self.seconds * 1000, 3),
+            "plan": self.plan,
+            "full_scans": full_scans(self.plan),
+        }
+
+
+class KeptStatements:
+    """A request's slow statements plus a bounded min-heap of the slowest of the rest"""
+
+    __slots__ = ("slow", "_fastest_first", "_order")
+
+    def __init__(self):
+        self.slow = []
+        self._fastest_first = []
+        self._order = itertools.count()
+
+    def wants(self, seconds: float) -> bool:
+        """Whether a statement that isn't slow would make the top STATEMENTS_PER_ENTRY"""
+        return len(self._fastest_first) < STATEMENTS_PER_ENTRY or seconds > self._fastest_first[0][0]
+
+    def add(self, record: StatementRecord, slow: bool):
+        if slow:
+            self.slow.append(record)
+            return
+        item = (record.seconds, next(self._order), record)
+        if len(self._fastest_first) < STATEMENTS_PER_ENTRY:
+            heapq.heappush(self._fastest_first, item)
+        else:
+            heapq.heapreplace(self._fastest_first, item)
+
+    def shown(self) -> list:
+        """The slowest STATEMENTS_PER_ENTRY, followed by any other slow statement"""
+        ranked = sorted(self.slow + [record for _, _, record in self._fastest_first],
+                        key=lambda record: record.seconds, reverse=True)
+        shown = ranked[:STATEMENTS_PER_ENTRY]
+        return shown + [record for record in self.slow if record not in shown]
+
+
+class SlowQueryLog:
+    def __init__(self, request_ms: float, query_ms: float, size: int):
+        self.request_seconds = request_ms / 1000
+        self.query_seconds = query_ms / 1000
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def is_slow_statement(self, seconds: float) -> bool:
+        return seconds >= self.query_seconds
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float, query_count: int,
+                        statements: KeptStatements):
+        if seconds < self.request_seconds and not statements.slow:
+            return
+
+        shown = statements.shown()
+        entry = {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "method": method,
+            "route": route,
+            "status": status,
+            "duration_ms": round(seconds * 1000, 3),
+            "query_count": query_count,
+            "statements": [record.to_dict() for record in shown],
+        }
+        with self._lock:
+            self._entries.append(entry)
+
+        scanned = sorted({table for statement in entry["statements"] for table in statement["full_scans"]})
+        logger.warning(
+            "Slow request %s %s took %.1f ms with %d statements%s",
+            method, route, entry["duration_ms"], query_count,
+            f"; full scans of {', '.join(scanned)}" if scanned else "",
+            extra={"slow_request": entry},
+        )
+
+    def entries(self) -> list:
+        """Logged requests, newest first"""
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+slow_query_log = SlowQueryLog(SLOW_REQUEST_MS, SLOW_QUERY_MS, SLOW_QUERY_LOG_SIZE)
@@ -1,25 +1,54 @@
+import os
+
+# the fixtures below build the schema themselves; keep the app's lifespan off the default database file
+os.environ.setdefault("DATABASE_SCHEMA_SETUP", "skip")
+
 import pytest
-from sqlalchemy import create_engine, text
+from contextlib import contextmanager
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
-from database import Base, get_db
+from sqlalchemy.pool import NullPool
+from cache import count_cache, idempotency_cache, page_cache, reference_cache
+from database import (
+    Base, DatabaseSettings, create_async_db_engine, create_db_engine, create_read_db_engine, get_async_db, get_db,
+    get_read_only_db,
+)
 from fastapi.testclient import TestClient
+from migrations import migrate
+
+
+@pytest.fixture(scope="session")
+def database_path(tmp_path_factory):
+    """SQLite file shared by the sync and async engines"""
+    return tmp_path_factory.mktemp("db") / "test.db"
+
+
+@pytest.fixture(scope="session")
+def database_settings(database_path):
+    return DatabaseSettings(url=f"sqlite:///{database_path}")
+
 
-TEST_DATABASE_URL = "sqlite:///:memory:"
+@pytest.fixture(scope="session")
+def engine(database_settings):
+    return create_db_engine(database_settings)
 
 
 @pytest.fixture(scope="session")
-def engine():
-    return create_engine(
-        TEST_DATABASE_URL,
-        connect_args={"check_same_thread": False},
-        poolclass=StaticPool
-    )
+def read_engine(database_settings, create_tables):
+    return create_read_db_engine(database_settings)
+
+
+@pytest.fixture(scope="session")
+def async_engine(database_settings):
+    # every TestClient runs its own event loop, so connections must not outlive a request
+    return create_async_db_engine(database_settings, poolclass=NullPool)
 
 
 @pytest.fixture(scope="session")
 def create_tables(engine):
     Base.metadata.create_all(bind=engine)
+    migrate(engine)
     yield
     Base.metadata.drop_all(bind=engine)
 
@@ -36,27 +65,66 @@ def clean_tables(engine):
 @pytest.fixture
 def db(engine, create_tables, clean_tables):
     """Fresh database session with clean tables for each test"""
-    connection = engine.connect()
-    transaction = connection.begin()
     session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
 
     yield session
 
     session.close()
-    transaction.rollback()
-    connection.close()
 
 
 @pytest.fixture
-def client(db):
+def client(db, async_engine, read_engine):
     from main import app
 
+    async_session = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    read_session = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
     def override_get_db():
         try:
             yield db
         finally:
             db.close()
 
+    async def override_get_async_db():
+        async with async_session() as session:
+            yield session
+
+    def override_get_read_only_db():
+        session = read_session()
+        try:
+            yield session
+        finally:
+            session.close()
+
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    app.dependency_overrides[get_read_only_db] = override_get_read_only_db
+    reference_cache.clear()
+    page_cache.clear()
+    count_cache.clear()
+    idempotency_cache.clear()
     with TestClient(app) as c:
-        yield c
\ No newline at end of file
+        yield c
+
+
+@pytest.fixture
+def count_queries(engine, async_engine, read_engine):
+    """Context manager that records every SQL statement executed on the test engines"""
+
+    @contextmanager
+    def counter():
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        targets = (engine, async_engine.sync_engine, read_engine)
+        for target in targets:
+            event.listen(target, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            for target in targets:
+                event.remove(target, "before_cursor_execute", before_cursor_execute)
+
+    return counter
@@ -0,0 +1,83 @@
+import asyncio
+import re
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+from admission import AdmissionGroup, admission_controller
+
+
+def sample(text: str, name: str, **labels) -> float:
+    pattern = re.escape(name + "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}")
+    return float(re.search(rf"^{pattern} (\S+)$", text, re.MULTILINE).group(1))
+
+
+def group(limit=1, queue_size=1, timeout=1.0) -> AdmissionGroup:
+    return AdmissionGroup("writes", [("POST", "/api/borrow/")], limit=limit, queue_size=queue_size, timeout=timeout)
+
+
+def test_waiters_are_admitted_in_order_and_overflow_is_shed():
+    writes = group(limit=1, queue_size=2)
+
+    async def scenario():
+        assert await writes.acquire()
+        first, second = asyncio.create_task(writes.acquire()), asyncio.create_task(writes.acquire())
+        await asyncio.sleep(0)
+        assert writes.queue_depth == 2
+        assert not await writes.acquire()
+
+        writes.release()
+        assert await first
+        assert not second.done()
+        writes.release()
+        assert await second
+        writes.release()
+
+    asyncio.run(scenario())
+    assert (writes.active, writes.queue_depth, writes.admitted) == (0, 0, 3)
+    assert writes.shed == {"queue_full": 1}
+
+
+def test_wait_is_shed_after_timeout():
+    writes = group(timeout=0.01)
+
+    async def scenario():
+        assert await writes.acquire()
+        assert not await writes.acquire()
+        writes.release()
+
+    asyncio.run(scenario())
+    assert (writes.active, writes.queue_depth) == (0, 0)
+    assert writes.shed == {"timeout": 1}
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    writes = group()
+
+    async def scenario():
+        assert await writes.acquire()
+        waiting = asyncio.create_task(writes.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert writes.queue_depth == 0
+        writes.release()
+
+    asyncio.run(scenario())
+    assert writes.active == 0
+
+
+def test_full_group_sheds_writes_with_retry_after(client: TestClient, db: Session, monkeypatch):
+    circulation = admission_controller.group_for("POST", "/api/borrow/")
+    shed_before = sample(client.get("/metrics").text, "admission_shed_total", group="circulation", reason="queue_full")
+    monkeypatch.setattr(circulation, "active", circulation.limit)
+    monkeypatch.setattr(circulation, "queue_size", 0)
+
+    response = client.post("/api/borrow/", json={"book_id": 1, "user_id": 1, "is_done": False})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    # reads and other groups are not held back
+    assert client.get("/api/books").status_code == 200
+    assert client.post("/api/genres/", json={"name": "Fantasy"}).status_code == 200
+
+    text = client.get("/metrics").text
+    assert sample(text, "admission_shed_total", group="circulation", reason="queue_full") == shed_before + 1
+    assert sample(text, "admission_in_flight", group="circulation") == circulation.limit
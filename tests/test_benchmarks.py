@@ -0,0 +1,51 @@
+from sqlalchemy import create_engine, text
+from benchmarks.datagen import dataset
+from benchmarks.suite import compare
+from routes.borrow import MAX_BORROW_COUNT
+
+
+def dump(path, table):
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"SELECT * FROM {table} ORDER BY 1, 2")).all()
+    engine.dispose()
+    return rows
+
+
+def test_dataset_is_deterministic(tmp_path):
+    first = dataset(300, tmp_path / "first")
+    second = dataset(300, tmp_path / "second")
+
+    for table in ("authors", "books", "book_genre", "borrows", "returns", "user_loans"):
+        assert dump(first, table) == dump(second, table)
+    assert dump(first, "books") != dump(dataset(300, tmp_path / "other", seed=7), "books")
+
+
+def test_dataset_keeps_loan_invariants(tmp_path):
+    engine = create_engine(f"sqlite:///{dataset(300, tmp_path)}")
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT max(active_count) FROM user_loans")).scalar() <= MAX_BORROW_COUNT
+        open_borrows = conn.execute(text("SELECT id FROM borrows WHERE NOT is_done ORDER BY id")).scalars().all()
+        active = conn.execute(
+            text("SELECT active_borrow_id FROM books WHERE active_borrow_id IS NOT NULL ORDER BY 1")
+        ).scalars().all()
+        assert open_borrows and open_borrows == active
+        assert conn.execute(text("SELECT count(*) FROM book_search")).scalar() == 300
+    engine.dispose()
+
+
+def result(total_ms, queries=2):
+    return {"total_ms": total_ms, "query_ms": 0.1, "serialize_ms": 0.1, "queries": queries, "p95_ms": total_ms}
+
+
+def test_compare_flags_slowdowns_and_extra_queries():
+    baseline = {"meta": {"books": 1000}, "results": {
+        "steady": result(10.0), "slower": result(10.0), "chattier": result(10.0, queries=2), "noise": result(0.1),
+    }}
+    current = {"meta": {"books": 1000}, "results": {
+        "steady": result(10.5), "slower": result(14.0), "chattier": result(10.0, queries=3), "noise": result(0.2),
+    }}
+
+    _, regressions = compare(baseline, current, threshold=0.25, min_delta_ms=0.2)
+
+    assert regressions == ["slower", "chattier"]
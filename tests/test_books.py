@@ -1,9 +1,14 @@
+import json
 from datetime import datetime,timezone
 
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import text
 from sqlalchemy.orm import Session
-from models import Author, Publisher, Book
+import loaders
+from routes import book as book_routes
+from models import Author, Publisher, Book, Genre, book_genre_association
+from schemas import BookResponse
 
 
 def next_year_utc_datetime() -> str:
@@ -101,3 +106,451 @@ def test_get_books_pagination(client: TestClient, db: Session, params, expected_
     response = client.get("/api/books", params=params)
     assert response.status_code == 200
     assert len(response.json()) == expected_count
+
+def seed_books(db: Session, count: int):
+    genres = [Genre(name="Genre 1"), Genre(name="Genre 2")]
+    db.add(Author(name=TEST_AUTHOR["name"], birth_date=datetime(2000, 1, 1)))
+    db.add(Publisher(name=TEST_PUBLISHER["name"]))
+    db.add_all(genres)
+    db.add_all([
+        Book(**{**TEST_BOOK, "title": f"Book {i}", "publish_date": datetime(2000,1,1,1), "genres": genres})
+        for i in range(count)
+    ])
+    db.commit()
+
+@pytest.mark.parametrize("path", ["/api/books", "/api/author/1/books"])
+def test_get_books_constant_query_count(client: TestClient, db: Session, count_queries, path):
+    seed_books(db, 2)
+    with count_queries() as small_page:
+        response = client.get(path, params={"limit": 100})
+    assert len(response.json()) == 2
+
+    db.add_all([Book(**{**TEST_BOOK, "title": f"Extra {i}", "publish_date": datetime(2000,1,1,1)}) for i in range(20)])
+    db.commit()
+    with count_queries() as large_page:
+        response = client.get(path, params={"limit": 100})
+    assert len(response.json()) == 22
+    assert response.json()[0]["genres"][0]["name"] == "Genre 1"
+
+    assert len(small_page) == len(large_page)
+
+@pytest.mark.parametrize("sort_by", [None, "title", "publish_date", "author"])
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_get_books_cursor_pagination(client: TestClient, db: Session, sort_by, order):
+    authors = [Author(name=f"Author {i}", birth_date=datetime(2000, 1, 1)) for i in range(3)]
+    db.add(Publisher(name=TEST_PUBLISHER["name"]))
+    db.add_all([
+        Book(**{
+            **TEST_BOOK,
+            "title": f"Book {i % 4}",
+            "publish_date": datetime(2000, 1, 1 + i % 3, 1),
+            "author_id": None,
+            "author": authors[i % 3],
+        })
+        for i in range(11)
+    ])
+    db.commit()
+
+    params = {"limit": 100, "order": order, **({"sort_by": sort_by} if sort_by else {})}
+    expected = [book["id"] for book in client.get("/api/books", params=params).json()]
+    if sort_by is None:
+        expected = sorted(expected, reverse=order == "desc")
+
+    seen = []
+    params = {**params, "limit": 3, "cursor": ""}
+    while True:
+        response = client.get("/api/books", params=params)
+        assert response.status_code == 200
+        seen += [book["id"] for book in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        assert 'rel="next"' in response.headers["Link"]
+        params["cursor"] = response.headers["X-Next-Cursor"]
+
+    assert seen == expected
+    assert len(seen) == 11
+
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_get_books_publish_date_cursor_over_whole_second_rows(client: TestClient, db: Session, order):
+    seed_books(db, 8)
+    # rows written outside the ORM, like the benchmark dataset, store no fraction of a second
+    db.execute(text("UPDATE books SET publish_date = '1950-01-01 00:00:00'"))
+    db.commit()
+
+    seen = []
+    params = {"limit": 3, "sort_by": "publish_date", "order": order, "cursor": ""}
+    while True:
+        response = client.get("/api/books", params=params)
+        seen += [book["id"] for book in response.json()]
+        assert len(seen) <= 8, "cursor repeated rows"
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+
+    assert sorted(seen) == [book_id for (book_id,) in db.query(Book.id).order_by(Book.id)]
+    assert seen == sorted(seen, reverse=order == "desc")
+
+def test_get_books_invalid_cursor(client: TestClient, db: Session):
+    response = client.get("/api/books", params={"cursor": "not a cursor"})
+    assert response.status_code == 400
+    assert "Invalid cursor" in response.json()["detail"]
+
+def test_get_books_cursor_sort_mode_mismatch(client: TestClient, db: Session):
+    seed_books(db, 2)
+    cursor = client.get("/api/books", params={"limit": 1, "sort_by": "title"}).headers["X-Next-Cursor"]
+
+    response = client.get("/api/books", params={"cursor": cursor, "sort_by": "author"})
+    assert response.status_code == 400
+
+def test_bulk_import_ndjson(client: TestClient, db: Session):
+    seed_books(db, 0)
+    rows = [
+        {**TEST_BOOK, "title": "Bulk 1", "genre_ids": [1, 2]},
+        {**TEST_BOOK, "title": "Bulk 2"},
+        {**TEST_BOOK, "title": "Missing author", "author_id": 99},
+        {**TEST_BOOK, "title": "Missing genre", "genre_ids": [99]},
+        {**TEST_BOOK, "isbn": "not correct isbn"},
+        {**TEST_BOOK, "title": "Bulk 3"},
+    ]
+    body = "\n".join(json.dumps(row) for row in rows) + "\n{broken json\n"
+
+    response = client.post(
+        "/api/books/bulk",
+        params={"batch_size": 2},
+        content=body,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["imported"] == 3
+    assert data["failed"] == 4
+    assert [error["row"] for error in data["errors"]] == [3, 4, 5, 7]
+    assert data["errors"][0]["errors"] == ["Author not found"]
+    assert "String should match pattern" in data["errors"][2]["errors"][0]
+    assert "Malformed row" in data["errors"][3]["errors"][0]
+
+    book = db.query(Book).filter(Book.title == "Bulk 1").one()
+    assert [genre.id for genre in book.genres] == [1, 2]
+    assert db.query(Book).count() == 3
+
+def test_bulk_import_csv(client: TestClient, db: Session):
+    seed_books(db, 0)
+    body = (
+        "title,isbn,publish_date,author_id,publisher_id,genre_ids\n"
+        f"CSV 1,{TEST_BOOK['isbn']},{TEST_BOOK['publish_date']},1,1,1;2\n"
+        f"\"CSV, quoted\",{TEST_BOOK['isbn']},{TEST_BOOK['publish_date']},1,,\n"
+        "too,few,columns\n"
+    )
+
+    response = client.post("/api/books/bulk", content=body, headers={"Content-Type": "text/csv"})
+    assert response.status_code == 200
+    assert response.json()["imported"] == 2
+    assert response.json()["errors"][0]["row"] == 3
+    assert db.query(Book).filter(Book.title == "CSV, quoted").one().publisher_id is None
+
+def test_bulk_import_csv_multiline_and_invalid_utf8(client: TestClient, db: Session):
+    seed_books(db, 0)
+    body = (
+        "title,isbn,publish_date,author_id,publisher_id,genre_ids\n"
+        f"\"Line1\nLine2\",{TEST_BOOK['isbn']},{TEST_BOOK['publish_date']},1,1,\n"
+    ).encode() + b"\xff\xfe,broken\n" + f"After,{TEST_BOOK['isbn']},{TEST_BOOK['publish_date']},1,1,\n".encode()
+
+    response = client.post("/api/books/bulk", content=body, headers={"Content-Type": "text/csv"})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["imported"] == 2
+    assert [error["row"] for error in data["errors"]] == [2]
+    assert "Malformed row" in data["errors"][0]["errors"][0]
+    assert sorted(title for (title,) in db.query(Book.title)) == ["After", "Line1\nLine2"]
+
+def test_bulk_import_csv_stray_quote_and_carriage_return(client: TestClient, db: Session):
+    seed_books(db, 0)
+    fields = f"{TEST_BOOK['isbn']},{TEST_BOOK['publish_date']},1,1,"
+    body = (
+        "title,isbn,publish_date,author_id,publisher_id,genre_ids\n"
+        f"12\" Vinyl,{fields}\n"
+        f"\"Carriage\rreturn\",{fields}\n"
+        f"Bare\rreturn,{fields}\n"
+        f"After,{fields}\n"
+    )
+
+    response = client.post("/api/books/bulk", content=body, headers={"Content-Type": "text/csv"})
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["imported"], data["failed"]) == (3, 1)
+    assert [error["row"] for error in data["errors"]] == [3]
+    assert "Malformed row" in data["errors"][0]["errors"][0]
+    assert sorted(title for (title,) in db.query(Book.title)) == ["12\" Vinyl", "After", "Carriage\rreturn"]
+
+def test_bulk_import_round_trips_export(client: TestClient, db: Session):
+    seed_books(db, 1)
+    db.add(Book(**{**TEST_BOOK, "title": 'Multi\nline "quoted", title', "publish_date": datetime(2000,1,1,1),
+                   "genres": [db.get(Genre, 2)]}))
+    db.commit()
+    exported = client.get("/api/books/export", params={"format": "csv"}).text
+
+    response = client.post("/api/books/bulk", content=exported, headers={"Content-Type": "text/csv"})
+    assert (response.json()["imported"], response.json()["failed"]) == (2, 0)
+    copies = db.query(Book).filter(Book.title == 'Multi\nline "quoted", title').all()
+    assert [[genre.id for genre in copy.genres] for copy in copies] == [[2], [2]]
+    assert sorted(genre.id for genre in db.query(Book).filter(Book.title == "Book 0").all()[1].genres) == [1, 2]
+
+def test_bulk_import_unsupported_content_type(client: TestClient):
+    response = client.post("/api/books/bulk", json=[TEST_BOOK])
+    assert response.status_code == 415
+
+def test_export_books_ndjson(client: TestClient, db: Session):
+    seed_books(db, 3)
+
+    response = client.get("/api/books/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert [record["title"] for record in records] == ["Book 0", "Book 1", "Book 2"]
+    assert records[0]["author"] == TEST_AUTHOR["name"]
+    assert sorted(records[0]["genres"]) == ["Genre 1", "Genre 2"]
+    assert sorted(records[0]["genre_ids"]) == [1, 2]
+    assert records[0]["publish_date"] == "2000-01-01T01:00:00"
+
+def test_export_books_csv(client: TestClient, db: Session):
+    seed_books(db, 2)
+    db.add(Book(**{**TEST_BOOK, "title": "No genres, no author", "author_id": None, "publish_date": datetime(2000,1,1,1)}))
+    db.commit()
+
+    response = client.get("/api/books/export", params={"format": "csv"})
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines[0] == "id,title,isbn,publish_date,author_id,author,publisher_id,genres,genre_ids"
+    assert len(lines) == 4
+    assert sorted(lines[1].split(",")[-1].split(";")) == ["1", "2"]
+    assert lines[3].endswith(',,1,,')
+
+@pytest.mark.parametrize("book_count", [3, 25])
+def test_export_books_reads_one_cursor(client: TestClient, db: Session, count_queries, monkeypatch, book_count):
+    monkeypatch.setattr(book_routes, "EXPORT_BATCH_SIZE", 10)
+    seed_books(db, book_count)
+
+    with count_queries() as statements:
+        response = client.get("/api/books/export")
+    assert len(response.text.splitlines()) == book_count
+    assert len(statements) == 1
+
+def test_search_books(client: TestClient, db: Session):
+    tolkien = Author(name="J. R. R. Tolkien", birth_date=datetime(1892, 1, 3))
+    db.add(Author(name=TEST_AUTHOR["name"], birth_date=datetime(2000, 1, 1)))
+    db.add_all([
+        Book(**{**TEST_BOOK, "title": "The Hobbit", "publish_date": datetime(1937,9,21), "author_id": None, "author": tolkien}),
+        Book(**{**TEST_BOOK, "title": "The Lord of the Rings", "publish_date": datetime(1954,7,29), "author_id": None, "author": tolkien}),
+        Book(**{**TEST_BOOK, "title": "A Guide to Tolkien", "publish_date": datetime(2000,1,1,1)}),
+        Book(**{**TEST_BOOK, "title": "Unrelated", "publish_date": datetime(2000,1,1,1)}),
+    ])
+    db.commit()
+
+    response = client.get("/api/books/search", params={"q": "tolkien"})
+    assert response.status_code == 200
+    titles = [book["title"] for book in response.json()]
+    assert titles[0] == "A Guide to Tolkien"
+    assert set(titles) == {"A Guide to Tolkien", "The Hobbit", "The Lord of the Rings"}
+
+    response = client.get("/api/books/search", params={"q": "hob tolk"})
+    assert [book["title"] for book in response.json()] == ["The Hobbit"]
+
+    response = client.get("/api/books/search", params={"q": "tolkien", "limit": 2, "offset": 2})
+    assert len(response.json()) == 1
+
+@pytest.mark.parametrize("strategy", ["selectin", "joined"])
+def test_search_books_constant_query_count(client: TestClient, db: Session, count_queries, monkeypatch, strategy):
+    monkeypatch.setattr(loaders, "BOOK_LOAD_STRATEGY", strategy)
+    params = {"q": TEST_AUTHOR["name"], "limit": 100}
+    seed_books(db, 2)
+    with count_queries() as small_page:
+        response = client.get("/api/books/search", params=params)
+    assert len(response.json()) == 2
+
+    db.add_all([Book(**{**TEST_BOOK, "title": f"Extra {i}", "publish_date": datetime(2000,1,1,1)}) for i in range(20)])
+    db.commit()
+    with count_queries() as large_page:
+        response = client.get("/api/books/search", params=params)
+    assert len(response.json()) == 22
+    assert sum(book["genres"][:1] == [{"id": 1, "name": "Genre 1"}] for book in response.json()) == 2
+
+    assert len(small_page) == len(large_page)
+
+def test_search_books_follows_updates(client: TestClient, db: Session):
+    seed_books(db, 1)
+    book = db.query(Book).one()
+    book.title = "Renamed Title"
+    book.author.name = "Someone Else"
+    db.commit()
+    book_id = book.id
+
+    assert client.get("/api/books/search", params={"q": "renamed someone"}).json()[0]["id"] == book_id
+    assert client.get("/api/books/search", params={"q": "Book"}).json() == []
+
+    db.execute(book_genre_association.delete())
+    db.query(Book).delete()
+    db.commit()
+    assert client.get("/api/books/search", params={"q": "renamed"}).json() == []
+
+def test_search_books_ignores_fts_syntax(client: TestClient, db: Session):
+    seed_books(db, 1)
+
+    assert client.get("/api/books/search", params={"q": '"*) OR NEAR('}).json() == []
+    assert len(client.get("/api/books/search", params={"q": 'book" 0*'}).json()) == 1
+
+def test_create_book_reads_reference_data_through_cache(client: TestClient, db: Session, count_queries):
+    seed_books(db, 0)
+    payload = {**TEST_BOOK, "genre_ids": [1, 2]}
+    assert client.post("/api/books/", json=payload).status_code == 200
+
+    with count_queries() as statements:
+        assert client.post("/api/books/", json=payload).status_code == 200
+    assert not [statement for statement in statements if "FROM authors" in statement or "FROM genres" in statement]
+
+    book = db.query(Book).order_by(Book.id.desc()).first()
+    assert sorted(genre.id for genre in book.genres) == [1, 2]
+
+def test_create_book_unknown_genre(client: TestClient, db: Session):
+    seed_books(db, 0)
+
+    response = client.post("/api/books/", json={**TEST_BOOK, "genre_ids": [1, 99]})
+    assert response.status_code == 404
+    assert "One or more genres not found" in response.json()["detail"]
+
+def test_get_books_not_modified(client: TestClient, db: Session, count_queries):
+    seed_books(db, 2)
+    response = client.get("/api/books")
+    etag = response.headers["ETag"]
+
+    with count_queries() as statements:
+        response = client.get("/api/books", headers={"If-None-Match": f'W/{etag}, "other"'})
+    assert response.status_code == 304
+    assert len(statements) == 1
+
+    db.query(Genre).filter(Genre.id == 1).update({"name": "Renamed"})
+    db.commit()
+    assert client.get("/api/books", headers={"If-None-Match": etag}).status_code == 200
+
+def test_get_books_page_is_cached_until_tables_change(client: TestClient, db: Session, count_queries):
+    seed_books(db, 2)
+    first = client.get("/api/books", params={"limit": 1})
+
+    with count_queries() as statements:
+        repeat = client.get("/api/books", params={"limit": 1})
+    assert repeat.json() == first.json()
+    assert repeat.headers["X-Next-Cursor"] == first.headers["X-Next-Cursor"]
+    assert len(statements) == 1
+
+    # a write from another worker, which can't drop this process's cache entries
+    db.query(Genre).filter(Genre.id == 1).update({"name": "Renamed"})
+    db.commit()
+    genres = client.get("/api/books", params={"limit": 1}).json()[0]["genres"]
+    assert "Renamed" in [genre["name"] for genre in genres]
+
+def test_get_books_row_path_matches_orm_serialization(client: TestClient, db: Session):
+    seed_books(db, 3)
+    db.add(Book(**{**TEST_BOOK, "title": "No genres", "publish_date": datetime(2001,2,3,4,5,6,789000)}))
+    db.commit()
+
+    expected = [
+        BookResponse.model_validate(book, from_attributes=True).model_dump(mode="json")
+        for book in db.query(Book).order_by(Book.id).all()
+    ]
+    assert client.get("/api/books", params={"limit": 100}).json() == expected
+    assert client.get("/api/author/1/books").json() == expected
+
+def seed_filter_books(db: Session):
+    """Four books over two authors, two publishers, three genres and three publish years"""
+    genres = [Genre(name=f"Genre {i}") for i in range(1, 4)]
+    authors = [Author(name=f"Author {i}", birth_date=datetime(1950, 1, 1)) for i in range(1, 3)]
+    publishers = [Publisher(name=f"Publisher {i}") for i in range(1, 3)]
+    db.add_all([*genres, *authors, *publishers])
+    db.add_all([
+        Book(title="A", isbn="1-2-3-4", publish_date=datetime(2000, 1, 1), author=authors[0],
+             publisher=publishers[0], genres=[genres[0], genres[1]]),
+        Book(title="B", isbn="1-2-3-4", publish_date=datetime(2005, 6, 1), author=authors[0],
+             publisher=publishers[1], genres=[genres[1]]),
+        Book(title="C", isbn="1-2-3-4", publish_date=datetime(2010, 1, 1), author=authors[1],
+             publisher=publishers[0], genres=[genres[2]]),
+        Book(title="D", isbn="1-2-3-4", publish_date=datetime(2010, 1, 1), author=authors[1],
+             publisher=publishers[1], genres=[]),
+    ])
+    db.commit()
+
+@pytest.mark.parametrize("params,expected", [
+    ({"genre_ids": [1, 2]}, ["A", "B"]),
+    ({"genre_ids": [1, 2], "genre_match": "all"}, ["A"]),
+    ({"genre_ids": [3, 3]}, ["C"]),
+    ({"author_id": 2}, ["C", "D"]),
+    ({"publisher_id": 1}, ["A", "C"]),
+    ({"published_since": "2005-06-01T00:00:00Z"}, ["B", "C", "D"]),
+    ({"published_before": "2010-01-01T00:00:00"}, ["A", "B"]),
+    ({"published_since": "2001-01-01", "published_before": "2011-01-01", "publisher_id": 2, "genre_ids": [2]}, ["B"]),
+    ({"author_id": 1, "publisher_id": 1, "genre_ids": [3]}, []),
+])
+def test_get_books_filters(client: TestClient, db: Session, params, expected):
+    seed_filter_books(db)
+    response = client.get("/api/books", params={**params, "sort_by": "title"})
+    assert response.status_code == 200
+    assert [book["title"] for book in response.json()] == expected
+
+def test_get_books_filters_with_cursor(client: TestClient, db: Session):
+    seed_filter_books(db)
+    params = {"genre_ids": [1, 2, 3], "sort_by": "publish_date", "order": "desc", "limit": 1, "cursor": ""}
+    titles = []
+    while True:
+        response = client.get("/api/books", params=params)
+        titles += [book["title"] for book in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+    assert titles == ["C", "B", "A"]
+
+def test_get_books_genre_filter_uses_exists(client: TestClient, db: Session, count_queries):
+    seed_filter_books(db)
+    with count_queries() as statements:
+        client.get("/api/books", params={"genre_ids": [1, 2]})
+    books_query = next(statement for statement in statements if "FROM books" in statement and "book_genre" in statement)
+    assert "EXISTS" in books_query and "JOIN book_genre" not in books_query
+
+def test_get_books_total_count_unfiltered(client: TestClient, db: Session, count_queries):
+    seed_books(db, 3)
+    with count_queries() as statements:
+        response = client.get("/api/books", params={"limit": 1, "count": "exact"})
+    assert response.headers["X-Total-Count"] == "3"
+    assert response.headers["X-Total-Count-Type"] == "exact"
+    # only the indexed count of books without an author, never a scan of the listed rows
+    assert all("author_id IS NULL" in statement for statement in statements if "count(" in statement)
+
+    db.delete(db.query(Book).first())
+    db.commit()
+    assert client.get("/api/books", params={"count": "exact"}).headers["X-Total-Count"] == "2"
+
+def test_get_books_total_count_skips_books_without_author(client: TestClient, db: Session):
+    seed_books(db, 2)
+    db.add(Book(title="Orphan", isbn="9-9-9-9", publish_date=datetime(2001, 1, 1), author_id=None))
+    db.commit()
+
+    response = client.get("/api/books", params={"count": "exact"})
+    assert response.headers["X-Total-Count"] == "2"
+    assert len(response.json()) == 2
+
+@pytest.mark.parametrize("mode,expected_total,expected_type", [("exact", "3", "exact"), ("estimated", "2", "estimated")])
+def test_get_books_total_count_filtered(client: TestClient, db: Session, count_queries, mode, expected_total, expected_type):
+    seed_filter_books(db)
+    params = {"genre_ids": [1, 2], "limit": 1, "count": mode}
+
+    response = client.get("/api/books", params=params)
+    assert (response.headers["X-Total-Count"], response.headers["X-Total-Count-Type"]) == ("2", "exact")
+    with count_queries() as statements:
+        response = client.get("/api/books", params={**params, "limit": 2})
+    assert response.headers["X-Total-Count"] == "2"
+    assert not any("count(" in statement for statement in statements)
+    # the count reuses the table versions conditional_get already read
+    assert sum("table_versions" in statement for statement in statements) == 1
+
+    db.add(Book(title="E", isbn="1-2-3-4", publish_date=datetime(2001, 1, 1), author_id=1,
+                genres=[db.get(Genre, 1)]))
+    db.commit()
+    response = client.get("/api/books", params=params)
+    assert (response.headers["X-Total-Count"], response.headers["X-Total-Count-Type"]) == (expected_total, expected_type)
@@ -2,7 +2,13 @@ from datetime import datetime, timezone
 from fastapi.testclient import TestClient
 from sqlalchemy.orm import Session
 import pytest
-from models import Borrow, Return, Book, Author, Publisher, Genre
+import asyncio
+import httpx
+from cache import idempotency_cache
+from idempotency import purge_expired, request_fingerprint
+from models import Borrow, Return, Book, Author, Publisher, Genre, IdempotencyKey, UserLoans
+from routes.borrow import MAX_BORROW_COUNT
+from schemas import BorrowCreate
 
 TEST_AUTHOR = {
     "name": "Test Author",
@@ -32,6 +38,17 @@ TEST_RETURN = {
     "user_id": 1
 }
 
+def add_active_borrow(db: Session, book_id: int, user_id: int):
+    """Inserts an open borrow together with the active-loan state the borrow routes maintain"""
+    borrow = Borrow(book_id=book_id, user_id=user_id, is_done=False)
+    db.add(borrow)
+    db.flush()
+
+    db.get(Book, book_id).active_borrow_id = borrow.id
+    loans = db.get(UserLoans, user_id) or UserLoans(user_id=user_id, active_count=0)
+    loans.active_count += 1
+    db.add(loans)
+
 @pytest.fixture(autouse=True)
 def setup_db(db: Session):
     """Setup test data for all tests"""
@@ -54,7 +71,7 @@ def test_create_borrow_success(client: TestClient, db: Session):
     assert borrow.user_id == TEST_BORROW["user_id"]
 
 def test_create_borrow_book_already_borrowed(client: TestClient, db: Session):
-    db.add(Borrow(**TEST_BORROW))
+    add_active_borrow(db, **TEST_RETURN)
     db.commit()
 
     response = client.post("/api/borrow/", json=TEST_BORROW)
@@ -64,7 +81,8 @@ def test_create_borrow_book_already_borrowed(client: TestClient, db: Session):
 def test_create_borrow_user_limit_reached(client: TestClient, db: Session):
     for i in range(1, 4):
         db.add(Book(**{**TEST_BOOK, "title": f"Book {i}"}))
-        db.add(Borrow(book_id=i, user_id=1, is_done=False))
+        db.flush()
+        add_active_borrow(db, book_id=i, user_id=1)
     db.commit()
 
     response = client.post("/api/borrow/", json={"book_id": 4, "user_id": 1, "is_done": False})
@@ -79,7 +97,7 @@ def test_create_borrow_nonexistent_book(client: TestClient):
 
 
 def test_create_return_success(client: TestClient, db: Session):
-    db.add(Borrow(**TEST_BORROW))
+    add_active_borrow(db, **TEST_RETURN)
     db.commit()
 
     response = client.post("/api/return/", json=TEST_RETURN)
@@ -103,3 +121,292 @@ def test_create_return_nonexistent_book(client: TestClient):
     response = client.post("/api/return/", json={"book_id": 999, "user_id": 1})
     assert response.status_code == 404
     assert "Borrow with for this book and user not found" in response.json()["detail"]
+
+def test_create_return_other_book_of_user(client: TestClient, db: Session):
+    db.add(Book(**{**TEST_BOOK, "title": "Book 2"}))
+    add_active_borrow(db, **TEST_RETURN)
+    db.commit()
+
+    response = client.post("/api/return/", json={"book_id": 2, "user_id": 1})
+    assert response.status_code == 404
+    assert db.query(Return).count() == 0
+
+def test_borrow_limit_counts_only_active_loans(client: TestClient, db: Session):
+    db.add_all([Book(**{**TEST_BOOK, "title": f"Book {i}"}) for i in range(2, 5)])
+    db.commit()
+
+    for book_id in (1, 2, 3):
+        assert client.post("/api/borrow/", json={"book_id": book_id, "user_id": 1, "is_done": False}).status_code == 200
+    assert client.post("/api/return/", json={"book_id": 2, "user_id": 1}).status_code == 200
+
+    response = client.post("/api/borrow/", json={"book_id": 4, "user_id": 1, "is_done": False})
+    assert response.status_code == 200
+    assert db.get(UserLoans, 1).active_count == 3
+
+def test_borrow_again_after_return(client: TestClient, db: Session):
+    assert client.post("/api/borrow/", json=TEST_BORROW).status_code == 200
+    assert client.post("/api/return/", json=TEST_RETURN).status_code == 200
+    assert client.post("/api/return/", json=TEST_RETURN).status_code == 404
+
+    response = client.post("/api/borrow/", json={**TEST_BORROW, "user_id": 2})
+    assert response.status_code == 200
+    assert db.get(Book, 1).active_borrow_id == db.query(Borrow).filter_by(user_id=2).one().id
+
+def post_concurrently(client: TestClient, payloads, headers=None):
+    async def send_all():
+        transport = httpx.ASGITransport(app=client.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            return await asyncio.gather(
+                *(async_client.post("/api/borrow/", json=payload, headers=headers) for payload in payloads)
+            )
+
+    return [response.status_code for response in asyncio.run(send_all())]
+
+def test_parallel_borrows_of_same_book(client: TestClient, db: Session):
+    statuses = post_concurrently(client, [{"book_id": 1, "user_id": user_id, "is_done": False} for user_id in range(1, 21)])
+
+    assert statuses.count(200) == 1
+    assert statuses.count(400) == 19
+    assert db.query(Borrow).count() == 1
+
+def test_parallel_borrows_by_same_user(client: TestClient, db: Session):
+    db.add_all([Book(**{**TEST_BOOK, "title": f"Book {i}"}) for i in range(2, 11)])
+    db.commit()
+
+    statuses = post_concurrently(client, [{"book_id": book_id, "user_id": 1, "is_done": False} for book_id in range(1, 11)])
+
+    assert statuses.count(200) == MAX_BORROW_COUNT
+    assert db.query(Borrow).filter_by(user_id=1, is_done=False).count() == MAX_BORROW_COUNT
+    assert db.get(UserLoans, 1).active_count == MAX_BORROW_COUNT
+
+def test_borrow_retry_with_idempotency_key_is_replayed(client: TestClient, db: Session, count_queries):
+    headers = {"Idempotency-Key": "borrow-1"}
+    first = client.post("/api/borrow/", json=TEST_BORROW, headers=headers)
+
+    with count_queries() as statements:
+        retry = client.post("/api/borrow/", json=TEST_BORROW, headers=headers)
+
+    assert retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert statements == []
+    assert db.query(Borrow).count() == 1
+    assert db.get(UserLoans, 1).active_count == 1
+
+def test_idempotent_replay_from_table_skips_write_path(client: TestClient, db: Session, count_queries):
+    headers = {"Idempotency-Key": "return-1"}
+    add_active_borrow(db, **TEST_RETURN)
+    db.commit()
+    first = client.post("/api/return/", json=TEST_RETURN, headers=headers)
+    # another worker, or an evicted entry, only has the table
+    idempotency_cache.clear()
+
+    with count_queries() as statements:
+        retry = client.post("/api/return/", json=TEST_RETURN, headers=headers)
+
+    assert (retry.status_code, retry.json()) == (200, first.json())
+    assert [statement for statement in statements if "BEGIN" not in statement and "idempotency_keys" not in statement] == []
+    assert db.query(Return).count() == 1
+
+def test_idempotency_key_reused_with_other_request(client: TestClient, db: Session):
+    headers = {"Idempotency-Key": "borrow-1"}
+    client.post("/api/borrow/", json=TEST_BORROW, headers=headers)
+
+    response = client.post("/api/borrow/", json={**TEST_BORROW, "user_id": 2}, headers=headers)
+    assert response.status_code == 422
+    assert db.query(Borrow).count() == 1
+
+def test_failed_request_is_not_stored(client: TestClient, db: Session):
+    headers = {"Idempotency-Key": "return-1"}
+    assert client.post("/api/return/", json=TEST_RETURN, headers=headers).status_code == 404
+    add_active_borrow(db, **TEST_RETURN)
+    db.commit()
+
+    response = client.post("/api/return/", json=TEST_RETURN, headers=headers)
+    assert response.status_code == 200
+    assert "Idempotent-Replayed" not in response.headers
+
+def test_parallel_retries_with_same_idempotency_key(client: TestClient, db: Session):
+    statuses = post_concurrently(client, [TEST_BORROW] * 10, headers={"Idempotency-Key": "borrow-1"})
+
+    assert statuses == [200] * 10
+    assert db.query(Borrow).count() == 1
+
+def test_expired_idempotency_keys(client: TestClient, db: Session, async_engine):
+    stale = {"fingerprint": request_fingerprint(BorrowCreate(**TEST_BORROW)), "status_code": 200, "body": "{}",
+             "created_at": datetime(2000, 1, 1)}
+    db.add_all([IdempotencyKey(scope="borrow", key="stale", **stale),
+                IdempotencyKey(scope="borrow", key="other", **stale)])
+    db.commit()
+
+    response = client.post("/api/borrow/", json=TEST_BORROW, headers={"Idempotency-Key": "stale"})
+    assert "Idempotent-Replayed" not in response.headers
+    assert db.query(Borrow).count() == 1
+
+    assert asyncio.run(purge_expired(async_engine)) == 1
+    db.expire_all()
+    assert [row.key for row in db.query(IdempotencyKey)] == ["stale"]
+
+def operation(type, book_id, user_id=1):
+    return {"type": type, "book_id": book_id, "user_id": user_id}
+
+def test_circulation_batch_applies_operations_in_order(client: TestClient, db: Session):
+    response = client.post("/api/circulation/batch", json={"operations": [
+        operation("borrow", 1, user_id=1),
+        operation("borrow", 1, user_id=2),
+        operation("return", 1, user_id=1),
+        operation("borrow", 1, user_id=2),
+        operation("borrow", 999),
+        operation("return", 1, user_id=3),
+    ]})
+
+    assert response.status_code == 200
+    report = response.json()
+    assert (report["applied"], report["failed"]) == (3, 3)
+    assert [result["status_code"] for result in report["results"]] == [200, 400, 200, 200, 404, 404]
+    assert report["results"][1]["detail"] == "Book already borrowed"
+    assert report["results"][4]["detail"] == "Book not found"
+
+    first, second = db.query(Borrow).order_by(Borrow.id).all()
+    assert (first.user_id, first.is_done, second.user_id, second.is_done) == (1, True, 2, False)
+    assert [report["results"][0]["id"], report["results"][3]["id"]] == [first.id, second.id]
+    assert report["results"][2]["id"] == db.query(Return).one().id
+    assert db.get(Book, 1).active_borrow_id == second.id
+    assert (db.get(UserLoans, 1).active_count, db.get(UserLoans, 2).active_count) == (0, 1)
+    assert client.get("/api/stats/books/most-borrowed").json()[0]["borrow_count"] == 2
+
+def test_circulation_batch_closes_existing_loans_and_keeps_limits(client: TestClient, db: Session):
+    db.add_all([Book(**{**TEST_BOOK, "title": f"Book {i}"}) for i in range(2, 6)])
+    for book_id in (1, 2, 3):
+        add_active_borrow(db, book_id=book_id, user_id=1)
+    db.commit()
+
+    report = client.post("/api/circulation/batch", json={"operations": [
+        operation("borrow", 4), operation("return", 2), operation("borrow", 4), operation("borrow", 5),
+    ]}).json()
+
+    assert [result["status_code"] for result in report["results"]] == [400, 200, 200, 400]
+    assert db.query(Borrow).filter_by(book_id=2).one().is_done is True
+    assert db.get(Book, 2).active_borrow_id is None
+    assert db.get(Book, 4).active_borrow_id is not None
+    assert db.get(UserLoans, 1).active_count == MAX_BORROW_COUNT
+
+@pytest.mark.parametrize("size", [1, 20])
+def test_circulation_batch_is_set_based(client: TestClient, db: Session, count_queries, size):
+    db.add_all([Book(**{**TEST_BOOK, "title": f"Book {i}"}) for i in range(2, 21)])
+    db.commit()
+    operations = [operation("borrow", book_id, user_id=book_id) for book_id in range(1, size + 1)]
+
+    with count_queries() as statements:
+        report = client.post("/api/circulation/batch", json={"operations": operations}).json()
+
+    assert report["applied"] == size
+    # BEGIN, the books and user_loans lookups, the next borrow id, then one statement per table written
+    assert len(statements) == 10
+    assert sum(statement.startswith("SELECT") for statement in statements) == 3
+    assert db.query(Borrow).count() == size
+
+def test_circulation_batch_returns_a_loan_without_user_loans_row(client: TestClient, db: Session):
+    add_active_borrow(db, book_id=1, user_id=1)
+    db.query(UserLoans).delete()
+    db.commit()
+
+    report = client.post("/api/circulation/batch", json={"operations": [
+        operation("return", 1), operation("borrow", 1, user_id=2),
+    ]}).json()
+
+    assert [result["status_code"] for result in report["results"]] == [200, 200]
+    assert db.get(Book, 1).active_borrow_id == report["results"][1]["id"]
+    assert (db.get(UserLoans, 1).active_count, db.get(UserLoans, 2).active_count) == (0, 1)
+
+def test_circulation_batch_requires_operations(client: TestClient):
+    assert client.post("/api/circulation/batch", json={"operations": []}).status_code == 422
+
+def test_book_history_not_modified(client: TestClient, db: Session):
+    etag = client.get("/api/books/1/history").headers["ETag"]
+    assert client.get("/api/books/1/history", headers={"If-None-Match": etag}).status_code == 304
+
+    assert client.post("/api/borrow/", json=TEST_BORROW).status_code == 200
+    response = client.get("/api/books/1/history", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.json()["borrows"]) == 1
+
+def test_book_history_of_missing_book_is_never_not_modified(client: TestClient):
+    future = "Fri, 01 Jan 2100 00:00:00 GMT"
+    assert client.get("/api/books/999/history", headers={"If-Modified-Since": future}).status_code == 404
+    assert client.get("/api/books/999/history", headers={"If-None-Match": "*"}).status_code == 404
+
+def test_book_history_with_invalid_id_is_never_not_modified(client: TestClient):
+    assert client.get("/api/books/abc/history", headers={"If-None-Match": "*"}).status_code == 422
+
+def add_history(db: Session):
+    """Two borrows and a return in the same second and one borrow a day later"""
+    same_second = datetime(2024, 1, 1, 10)
+    db.add_all([
+        Borrow(book_id=1, user_id=1, is_done=True, created_at=same_second),
+        Borrow(book_id=1, user_id=2, is_done=True, created_at=same_second),
+        Return(book_id=1, user_id=1, created_at=same_second),
+        Borrow(book_id=1, user_id=3, is_done=False, created_at=datetime(2024, 1, 2, 10)),
+    ])
+    db.commit()
+
+def test_book_history_single_query(client: TestClient, db: Session, count_queries):
+    add_history(db)
+    with count_queries() as statements:
+        response = client.get("/api/books/1/history")
+    assert response.status_code == 200
+    assert len(response.json()["borrows"]) == 3
+    assert len(response.json()["returns"]) == 1
+    # one for the ETag counters, one for the book and its events
+    assert len(statements) == 2
+
+    with count_queries() as statements:
+        assert client.get("/api/books/2/history").status_code == 404
+    assert len(statements) == 2
+
+def test_book_history_empty(client: TestClient):
+    response = client.get("/api/books/1/history")
+    assert response.status_code == 200
+    assert response.json() == {"borrows": [], "returns": []}
+
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_book_history_timeline_cursor(client: TestClient, db: Session, order):
+    add_history(db)
+    full = client.get("/api/books/1/history", params={"timeline": True, "order": order}).json()["events"]
+    assert [event["type"] for event in full] == (
+        ["borrow", "borrow", "return", "borrow"] if order == "asc" else ["borrow", "return", "borrow", "borrow"]
+    )
+
+    events, params = [], {"timeline": True, "order": order, "limit": 1, "cursor": ""}
+    while True:
+        response = client.get("/api/books/1/history", params=params)
+        events += response.json()["events"]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+    assert events == full
+
+def test_book_history_since_until(client: TestClient, db: Session):
+    add_history(db)
+    params = {"since": "2024-01-01T10:00:00Z", "until": "2024-01-02T10:00:00Z"}
+    data = client.get("/api/books/1/history", params=params).json()
+    assert [borrow["user_id"] for borrow in data["borrows"]] == [1, 2]
+    assert len(data["returns"]) == 1
+
+    data = client.get("/api/books/1/history", params={"since": "2024-01-01T10:00:01"}).json()
+    assert [borrow["user_id"] for borrow in data["borrows"]] == [3]
+    assert data["returns"] == []
+
+def test_book_history_invalid_cursor(client: TestClient):
+    assert client.get("/api/books/1/history", params={"cursor": "garbage"}).status_code == 400
+
+def test_book_history_since_server_timestamp(client: TestClient, db: Session):
+    assert client.post("/api/borrow/", json=TEST_BORROW).status_code == 200
+    created_at = db.query(Borrow).one().created_at
+
+    # CURRENT_TIMESTAMP stores whole seconds without a fraction
+    data = client.get("/api/books/1/history", params={"since": created_at.isoformat()}).json()
+    assert len(data["borrows"]) == 1
+    data = client.get("/api/books/1/history", params={"until": created_at.isoformat()}).json()
+    assert data["borrows"] == []
@@ -0,0 +1,69 @@
+from cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = TTLCache(maxsize=10, ttl=5, clock=clock)
+    cache.set(("genres", 1), "Fantasy")
+
+    clock.now = 4.9
+    assert cache.get(("genres", 1)) == "Fantasy"
+    clock.now = 5
+    assert cache.get(("genres", 1)) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set(("genres", 1), 1)
+    cache.set(("genres", 2), 2)
+    cache.get(("genres", 1))
+    cache.set(("genres", 3), 3)
+
+    assert cache.get(("genres", 2)) is None
+    assert cache.get(("genres", 1)) == 1
+    assert cache.get(("genres", 3)) == 3
+
+
+def test_get_or_load_calls_loader_once():
+    cache = TTLCache(maxsize=10, ttl=60)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return []
+
+    assert cache.get_or_load(("publishers", "page"), loader) == []
+    assert cache.get_or_load(("publishers", "page"), loader) == []
+    assert len(calls) == 1
+
+
+def test_invalidate_drops_only_its_namespace():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set(("genres", "page", 10, 0), [])
+    cache.set(("genres", "id", 1), True)
+    cache.set(("publishers", "page", 10, 0), [])
+
+    cache.invalidate("genres")
+
+    assert cache.get(("genres", "id", 1)) is None
+    assert cache.get(("publishers", "page", 10, 0)) == []
+
+
+def test_entry_from_another_version_is_a_miss():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set(("genres", "page", 10, 0), ["Fantasy"], version=(("genres", 1),))
+
+    assert cache.get(("genres", "page", 10, 0), version=(("genres", 1),)) == ["Fantasy"]
+    assert cache.get(("genres", "page", 10, 0), version=(("genres", 2),)) is None
+    assert cache.get_or_load(("genres", "page", 10, 0), lambda: ["Fantasy", "Horror"], (("genres", 2),)) == ["Fantasy", "Horror"]
+    assert cache.get(("genres", "page", 10, 0), version=(("genres", 2),)) == ["Fantasy", "Horror"]
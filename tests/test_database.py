@@ -0,0 +1,152 @@
+import asyncio
+import os
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+from contextlib import contextmanager
+from fastapi.testclient import TestClient
+from sqlalchemy import event, exc, text
+from sqlalchemy.pool import NullPool
+from database import DatabaseSettings, create_async_db_engine, create_db_engine, create_read_db_engine
+from migrations import LATEST_VERSION, current_version
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def test_settings_from_env():
+    settings = DatabaseSettings.from_env({
+        "DATABASE_URL": "sqlite:///./other.db",
+        "DATABASE_POOL_SIZE": "12",
+        "SQLITE_WAL": "false",
+        "SQLITE_SYNCHRONOUS": "full",
+        "SQLITE_BUSY_TIMEOUT": "250",
+    })
+    assert settings.url == "sqlite:///./other.db"
+    assert settings.read_only_url == "sqlite:///file:./other.db?mode=ro&uri=true"
+    assert settings.async_url == "sqlite+aiosqlite:///./other.db"
+    assert settings.pool_size == 12
+    assert settings.wal is False
+    assert ("synchronous", "FULL") in settings.pragmas()
+    assert ("busy_timeout", 250) in settings.pragmas()
+    assert "journal_mode" not in dict(settings.pragmas())
+
+
+def test_async_url_replaces_any_sqlite_driver():
+    settings = DatabaseSettings(url="sqlite+pysqlite:///./other.db")
+    assert settings.async_url == "sqlite+aiosqlite:///./other.db"
+    assert DatabaseSettings(url="sqlite://").async_url == "sqlite+aiosqlite://"
+
+
+def test_settings_reject_unknown_synchronous_level():
+    with pytest.raises(ValueError):
+        DatabaseSettings(synchronous="SOMETIMES")
+
+
+def test_settings_reject_unknown_schema_setup():
+    with pytest.raises(ValueError):
+        DatabaseSettings.from_env({"DATABASE_SCHEMA_SETUP": "sometimes"})
+
+
+def test_importing_the_app_builds_no_engine(tmp_path):
+    script = "import database, main; print(database.get_engine.cache_info().currsize, database.get_async_engine.cache_info().currsize)"
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{tmp_path / 'untouched.db'}"}
+    result = subprocess.run([sys.executable, "-c", script], env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+
+    assert result.stdout.split() == ["0", "0"]
+    assert not (tmp_path / "untouched.db").exists()
+
+
+@pytest.mark.parametrize("mode, expected_version", [("migrate", LATEST_VERSION), ("skip", 0)])
+def test_lifespan_sets_up_schema_unless_skipped(tmp_path, monkeypatch, mode, expected_version):
+    import database
+    from main import app
+
+    settings = DatabaseSettings(url=f"sqlite:///{tmp_path / 'startup.db'}", schema_setup=mode)
+    engine = create_db_engine(settings)
+    monkeypatch.setattr(database, "settings", settings)
+    monkeypatch.setattr(database, "get_engine", lambda: engine)
+
+    with TestClient(app):
+        pass
+
+    with engine.connect() as conn:
+        assert current_version(conn) == expected_version
+    engine.dispose()
+
+
+def test_engine_applies_pragmas(tmp_path):
+    settings = DatabaseSettings(url=f"sqlite:///{tmp_path / 'pragmas.db'}", busy_timeout=1234, mmap_size=0)
+    engine = create_db_engine(settings)
+
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 1234
+        assert conn.execute(text("PRAGMA temp_store")).scalar() == 2
+    engine.dispose()
+
+
+def test_async_engine_applies_pragmas(tmp_path):
+    settings = DatabaseSettings(url=f"sqlite:///{tmp_path / 'pragmas.db'}", busy_timeout=4321)
+    engine = create_async_db_engine(settings, poolclass=NullPool)
+
+    async def read_pragmas():
+        async with engine.connect() as conn:
+            return (
+                await conn.scalar(text("PRAGMA journal_mode")),
+                await conn.scalar(text("PRAGMA busy_timeout")),
+            )
+
+    assert asyncio.run(read_pragmas()) == ("wal", 4321)
+
+
+def test_in_memory_engine_skips_wal():
+    engine = create_db_engine(DatabaseSettings(url="sqlite:///:memory:"))
+
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "memory"
+
+
+def test_read_engine_is_read_only(tmp_path):
+    settings = DatabaseSettings(url=f"sqlite:///{tmp_path / 'primary.db'}")
+    engine = create_db_engine(settings)
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE notes (body TEXT)"))
+        conn.execute(text("INSERT INTO notes VALUES ('written')"))
+    read_engine = create_read_db_engine(settings)
+
+    with read_engine.connect() as conn:
+        assert conn.execute(text("SELECT body FROM notes")).scalar() == "written"
+        with pytest.raises(exc.OperationalError, match="readonly"):
+            conn.execute(text("INSERT INTO notes VALUES ('rejected')"))
+    assert DatabaseSettings(read_url="sqlite:///./replica.db").read_only_url == "sqlite:///./replica.db"
+    read_engine.dispose()
+    engine.dispose()
+
+
+@contextmanager
+def engine_statements(*engines):
+    """Statements executed per engine, in the order the engines are given"""
+    statements = [[] for _ in engines]
+    listeners = []
+    for engine, recorded in zip(engines, statements):
+        def record(conn, cursor, statement, parameters, context, executemany, recorded=recorded):
+            recorded.append(statement)
+        event.listen(engine, "before_cursor_execute", record)
+        listeners.append((engine, record))
+    try:
+        yield statements
+    finally:
+        for engine, record in listeners:
+            event.remove(engine, "before_cursor_execute", record)
+
+
+def test_get_routes_read_through_read_engine(client: TestClient, engine, read_engine):
+    with engine_statements(engine, read_engine) as (primary, read_only):
+        assert client.get("/api/genres/").status_code == 200
+    assert primary == [] and read_only
+
+    with engine_statements(engine, read_engine) as (primary, read_only):
+        assert client.get("/api/books", headers={"X-Read-Your-Writes": "true"}).status_code == 200
+    assert primary and read_only == []
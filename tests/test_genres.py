@@ -58,3 +58,54 @@ def test_create_duplicate_publisher(client: TestClient, db: Session):
     response = client.post("/api/genres/", json=DUPLICATE_GENRE)
     assert response.status_code == 400
     assert "Publisher already exist" in response.json()["detail"]
+
+
+def test_get_genres_is_cached_until_genres_change(client: TestClient, db: Session, count_queries):
+    db.add(Genre(name="Genre 1"))
+    db.commit()
+    assert len(client.get("/api/genres/").json()) == 1
+
+    with count_queries() as statements:
+        assert len(client.get("/api/genres/").json()) == 1
+    assert not [statement for statement in statements if "FROM genres" in statement]
+
+    # a write from another worker, which can't drop this process's cache entries
+    db.add(Genre(name="Added behind the cache"))
+    db.commit()
+    assert len(client.get("/api/genres/").json()) == 2
+
+    client.post("/api/genres/", json=TEST_GENRE)
+    assert len(client.get("/api/genres/").json()) == 3
+
+
+def test_get_genres_not_modified(client: TestClient, db: Session, count_queries):
+    db.add(Genre(name="Genre 1"))
+    db.commit()
+    etag = client.get("/api/genres/").headers["ETag"]
+
+    with count_queries() as statements:
+        response = client.get("/api/genres/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert len(statements) == 1
+
+    assert client.get("/api/genres/", params={"limit": 5}, headers={"If-None-Match": etag}).status_code == 200
+
+    client.post("/api/genres/", json=TEST_GENRE)
+    response = client.get("/api/genres/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_get_genres_total_count(client: TestClient, db: Session):
+    db.add_all([Genre(name=f"Genre {i}") for i in range(3)])
+    db.commit()
+
+    assert "X-Total-Count" not in client.get("/api/genres/").headers
+    response = client.get("/api/genres/", params={"limit": 1, "count": "exact"})
+    assert len(response.json()) == 1
+    assert response.headers["X-Total-Count"] == "3"
+    assert response.headers["X-Total-Count-Type"] == "exact"
+
+    client.post("/api/genres/", json={"name": "Poetry"})
+    assert client.get("/api/genres/", params={"count": "estimated"}).headers["X-Total-Count"] == "4"
@@ -0,0 +1,72 @@
+import re
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+from metrics import Histogram, MetricsRegistry, RequestMetrics, registry
+from models import Genre
+
+
+@pytest.fixture(autouse=True)
+def empty_registry():
+    registry.clear()
+    yield
+    registry.clear()
+
+
+def sample(text: str, name: str, **labels) -> float:
+    """Value of the series `name` whose labels include `labels`"""
+    for line in text.splitlines():
+        match = re.fullmatch(rf"{name}\{{(.*)\}} (\S+)", line)
+        if match and all(f'{key}="{value}"' in match.group(1) for key, value in labels.items()):
+            return float(match.group(2))
+    raise AssertionError(f"{name} {labels} not found")
+
+
+def test_metrics_record_sql_per_route(client: TestClient, db: Session, count_queries):
+    db.add_all([Genre(name=f"Genre {i}") for i in range(3)])
+    db.commit()
+
+    with count_queries() as statements:
+        assert client.get("/api/genres/", params={"limit": 100}).status_code == 200
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    route = {"method": "GET", "route": "/api/genres/"}
+    assert sample(response.text, "http_requests_total", status="200", **route) == 1
+    assert sample(response.text, "http_request_duration_seconds_count", **route) == 1
+    assert sample(response.text, "db_queries_total", **route) == len(statements)
+    assert sample(response.text, "db_query_duration_seconds_total", **route) > 0
+    # three genres plus the table_versions row behind the ETag
+    assert sample(response.text, "db_rows_total", **route) == 4
+    assert sample(response.text, "db_pool_wait_seconds_total", **route) >= 0
+
+
+def test_metrics_cover_async_routes_and_unmatched_paths(client: TestClient):
+    assert client.post("/api/genres/", json={"name": "Fantasy"}).status_code == 200
+    assert client.get("/api/no-such-route").status_code == 404
+    text = client.get("/metrics").text
+
+    assert sample(text, "db_queries_total", method="POST", route="/api/genres/") > 0
+    assert sample(text, "http_requests_total", route="unmatched", status="404") == 1
+    assert "/api/no-such-route" not in text
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = MetricsRegistry()
+    for seconds in (0.0005, 0.03, 20.0):
+        metrics.observe("GET", "/api/books", 200, seconds, RequestMetrics())
+    text = metrics.render()
+
+    assert sample(text, "http_request_duration_seconds_bucket", le="0.001") == 1
+    assert sample(text, "http_request_duration_seconds_bucket", le="0.05") == 2
+    assert sample(text, "http_request_duration_seconds_bucket", le="10.0") == 2
+    assert sample(text, "http_request_duration_seconds_bucket", le="+Inf") == 3
+    assert sample(text, "http_request_duration_seconds_count") == 3
+
+
+def test_histogram_ignores_values_above_the_last_bound():
+    histogram = Histogram((1, 2))
+    histogram.observe(5)
+    assert histogram.counts == [0, 0]
+    assert histogram.count == 1
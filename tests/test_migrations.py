@@ -0,0 +1,61 @@
+from sqlalchemy import create_engine, event, text
+import models  # noqa: F401 - registers the tables on Base.metadata
+from database import Base
+from migrations import LATEST_VERSION, current_version, migrate, setup_schema
+
+
+def index_names(conn, table):
+    return {row[1] for row in conn.execute(text(f"PRAGMA index_list({table})"))}
+
+
+def test_migrate_adds_indexes_to_existing_tables(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for (name,) in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%'")).all():
+            conn.execute(text(f"DROP INDEX {name}"))
+
+    assert migrate(engine) == list(range(1, LATEST_VERSION + 1))
+
+    with engine.connect() as conn:
+        assert current_version(conn) == LATEST_VERSION
+        assert {"ix_borrows_book_id_is_done", "ix_borrows_user_id_is_done"} <= index_names(conn, "borrows")
+        assert "ix_book_genre_genre_id_book_id" in index_names(conn, "book_genre")
+        plan = " ".join(
+            row[3] for row in conn.execute(text("EXPLAIN QUERY PLAN SELECT id FROM borrows WHERE book_id = 1 AND is_done = 0"))
+        )
+        assert "ix_borrows_book_id_is_done" in plan
+
+
+def test_migrate_is_a_noop_when_up_to_date(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    Base.metadata.create_all(bind=engine)
+
+    migrate(engine)
+    assert migrate(engine) == []
+
+
+def test_migrate_backfills_row_counts(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'counted.db'}")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO genres (name) VALUES ('Fantasy'), ('Horror')"))
+
+    migrate(engine)
+
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO genres (name) VALUES ('Poetry')"))
+        conn.execute(text("DELETE FROM genres WHERE name = 'Horror'"))
+        row_count = conn.execute(text("SELECT row_count FROM table_versions WHERE name = 'genres'")).scalar()
+    assert row_count == 2
+
+
+def test_setup_schema_only_checks_version_when_current(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'startup.db'}")
+    assert setup_schema(engine) == list(range(1, LATEST_VERSION + 1))
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    assert setup_schema(engine) == []
+    assert statements == ["PRAGMA user_version"]
+    engine.dispose()
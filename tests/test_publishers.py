@@ -1,5 +1,8 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 from models import Publisher
 
@@ -58,3 +61,49 @@ def test_create_duplicate_publisher(client: TestClient, db: Session):
     response = client.post("/api/publishers/", json=DUPLICATE_PUBLISHER)
     assert response.status_code == 400
     assert "Publisher already exist" in response.json()["detail"]
+
+
+def test_get_publishers_is_cached_until_publishers_change(client: TestClient, db: Session, count_queries):
+    db.add(Publisher(name="Publisher 1"))
+    db.commit()
+    assert len(client.get("/api/publishers/").json()) == 1
+
+    with count_queries() as statements:
+        assert len(client.get("/api/publishers/").json()) == 1
+    assert not [statement for statement in statements if "FROM publishers" in statement]
+
+    # a write from another worker, which can't drop this process's cache entries
+    db.add(Publisher(name="Added behind the cache"))
+    db.commit()
+    assert len(client.get("/api/publishers/").json()) == 2
+
+    client.post("/api/publishers/", json=TEST_PUBLISHER)
+    assert len(client.get("/api/publishers/").json()) == 3
+
+
+def test_get_publishers_not_modified_since(client: TestClient, db: Session):
+    db.add(Publisher(name="Publisher 1"))
+    db.commit()
+    db.execute(text("UPDATE table_versions SET updated_at = '2024-01-01 10:00:00.250' WHERE name = 'publishers'"))
+    db.commit()
+    last_modified = client.get("/api/publishers/").headers["Last-Modified"]
+    assert last_modified == "Mon, 01 Jan 2024 10:00:00 GMT"
+
+    response = client.get("/api/publishers/", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    assert response.headers["Last-Modified"] == last_modified
+
+    response = client.get("/api/publishers/", headers={"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"})
+    assert response.status_code == 200
+
+
+def test_write_in_the_current_second_is_never_hidden(client: TestClient, db: Session):
+    client.post("/api/publishers/", json=TEST_PUBLISHER)
+    response = client.get("/api/publishers/")
+    # a second write could still land in this second, so no whole-second validator is offered
+    assert "Last-Modified" not in response.headers
+
+    now = format_datetime(datetime.now(timezone.utc), usegmt=True)
+    response = client.get("/api/publishers/", headers={"If-Modified-Since": now})
+    assert response.status_code == 200
+    assert len(response.json()) == 1
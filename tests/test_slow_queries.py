@@ -0,0 +1,110 @@
+import logging
+from datetime import datetime
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+import routes.monitoring as monitoring
+from models import Book, Genre
+from slow_queries import STATEMENTS_PER_ENTRY, KeptStatements, SlowQueryLog, StatementRecord, full_scans, slow_query_log
+
+
+ADMIN_HEADERS = {"X-Admin-Token": "secret"}
+
+
+@pytest.fixture(autouse=True)
+def admin_token(monkeypatch):
+    monkeypatch.setattr(monitoring, "ADMIN_TOKEN", "secret")
+
+
+@pytest.fixture(autouse=True)
+def empty_log():
+    slow_query_log.clear()
+    yield
+    slow_query_log.clear()
+
+
+@pytest.fixture
+def log_everything(monkeypatch):
+    monkeypatch.setattr(slow_query_log, "request_seconds", 0)
+    monkeypatch.setattr(slow_query_log, "query_seconds", 0)
+
+
+def test_fast_requests_are_not_logged(client: TestClient):
+    assert client.get("/api/genres/").status_code == 200
+    assert client.get("/admin/slow-queries", headers=ADMIN_HEADERS).json() == []
+
+
+def test_slow_request_is_logged_with_plans(client: TestClient, db: Session, log_everything, caplog):
+    db.add(Genre(name="Fantasy"))
+    db.commit()
+
+    with caplog.at_level(logging.WARNING, logger="slow_queries"):
+        assert client.get("/api/genres/", params={"limit": 5}).status_code == 200
+    entries = client.get("/admin/slow-queries", headers=ADMIN_HEADERS).json()
+
+    entry = next(entry for entry in entries if entry["route"] == "/api/genres/")
+    assert entry["method"] == "GET" and entry["status"] == 200
+    assert entry["query_count"] == len(entry["statements"])
+    genres_query = next(statement for statement in entry["statements"] if "FROM genres" in statement["statement"])
+    assert genres_query["plan"] and genres_query["full_scans"] == ["genres"]
+    assert "5" in genres_query["parameters"]
+    assert "full scans of genres" in caplog.text
+
+
+def test_indexed_lookups_are_not_full_scans(client: TestClient, db: Session, log_everything):
+    db.add(Book(title="Dune", isbn="0-306-40615-2", publish_date=datetime(2000, 1, 1)))
+    db.commit()
+    client.get("/api/books/1/history")
+    entry = client.get("/admin/slow-queries", headers=ADMIN_HEADERS).json()[-1]
+
+    history_query = next(statement for statement in entry["statements"] if "FROM borrows" in statement["statement"])
+    assert history_query["plan"]
+    assert not {"borrows", "returns"} & set(history_query["full_scans"])
+
+
+def test_ring_keeps_the_latest_entries():
+    log = SlowQueryLog(request_ms=0, query_ms=1000, size=2)
+    for route in ("/a", "/b", "/c"):
+        statements = KeptStatements()
+        statements.add(StatementRecord("SELECT 1", (), False, 0.001), slow=False)
+        log.observe_request("GET", route, 200, 0.01, 1, statements)
+
+    assert [entry["route"] for entry in log.entries()] == ["/c", "/b"]
+
+
+@pytest.mark.parametrize("detail,expected", [
+    ("SCAN borrows", ["borrows"]),
+    ("SCAN TABLE book_genre", ["book_genre"]),
+    ("SCAN borrows USING INDEX ix_borrows_book_id_is_done", []),
+    ("SCAN book_genre USING COVERING INDEX ix_book_genre_genre_id_book_id", []),
+    ("SEARCH returns USING INDEX ix_returns_book_id_created_at (book_id=?)", []),
+])
+def test_full_scans(detail, expected):
+    assert full_scans([detail]) == expected
+
+
+def test_admin_token(client: TestClient, monkeypatch):
+    assert client.get("/admin/slow-queries").status_code == 403
+    assert client.get("/admin/slow-queries", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get("/admin/slow-queries", headers=ADMIN_HEADERS).status_code == 200
+    assert client.delete("/admin/slow-queries", headers=ADMIN_HEADERS).status_code == 204
+
+
+def test_admin_routes_are_closed_without_a_token(client: TestClient, monkeypatch):
+    monkeypatch.setattr(monitoring, "ADMIN_TOKEN", None)
+
+    assert client.get("/admin/slow-queries").status_code == 403
+    assert client.delete("/admin/slow-queries", headers={"X-Admin-Token": ""}).status_code == 403
+
+
+def test_request_keeps_only_the_statements_it_could_show():
+    statements = KeptStatements()
+    for milliseconds in range(100):
+        record = StatementRecord("SELECT ?", (milliseconds,), False, milliseconds / 1000)
+        if statements.wants(record.seconds):
+            statements.add(record, slow=False)
+    statements.add(StatementRecord("UPDATE books", (), False, 0.0005), slow=True)
+
+    shown = statements.shown()
+    assert [record.parameters for record in shown] == [(99,), (98,), (97,), (96,), (95,), ()]
+    assert len(statements._fastest_first) == STATEMENTS_PER_ENTRY
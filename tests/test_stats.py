@@ -0,0 +1,91 @@
+import re
+from datetime import datetime
+from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+import pytest
+from circulation_stats import rebuild
+from models import Author, Book, Genre
+
+BOOKS = {1: ("Dune", 1, [1]), 2: ("Emma", 2, [1, 2]), 3: ("Ulysses", 2, [2])}
+
+
+@pytest.fixture(autouse=True)
+def setup_db(db: Session):
+    db.add_all([Author(id=1, name="Herbert", birth_date=datetime(1920, 1, 1)),
+                Author(id=2, name="Austen", birth_date=datetime(1775, 1, 1))])
+    genres = {1: Genre(id=1, name="Fantasy"), 2: Genre(id=2, name="Classic")}
+    db.add_all(genres.values())
+    for book_id, (title, author_id, genre_ids) in BOOKS.items():
+        db.add(Book(id=book_id, title=title, isbn="0-306-40615-2", publish_date=datetime(2000, 1, 1),
+                    author_id=author_id, genres=[genres[genre_id] for genre_id in genre_ids]))
+    db.commit()
+
+
+def circulate(client: TestClient):
+    for book_id, user_id in ((2, 1), (3, 2), (1, 3)):
+        assert client.post("/api/borrow/", json={"book_id": book_id, "user_id": user_id, "is_done": False}).status_code == 200
+    assert client.post("/api/return/", json={"book_id": 2, "user_id": 1}).status_code == 200
+    assert client.post("/api/borrow/", json={"book_id": 2, "user_id": 2, "is_done": False}).status_code == 200
+    assert client.post("/api/return/", json={"book_id": 1, "user_id": 3}).status_code == 200
+
+
+def snapshot(client: TestClient):
+    return {path: client.get(f"/api/stats/{path}").json() for path in ("books/most-borrowed", "genres", "authors")}
+
+
+def test_stats_follow_borrows_and_returns(client: TestClient):
+    circulate(client)
+
+    assert client.get("/api/stats/books/most-borrowed").json() == [
+        {"book_id": 2, "title": "Emma", "borrow_count": 2, "borrowed": True},
+        {"book_id": 3, "title": "Ulysses", "borrow_count": 1, "borrowed": True},
+        {"book_id": 1, "title": "Dune", "borrow_count": 1, "borrowed": False},
+    ]
+    assert client.get("/api/stats/genres").json() == [
+        {"genre_id": 2, "name": "Classic", "borrow_count": 3, "active_count": 2},
+        {"genre_id": 1, "name": "Fantasy", "borrow_count": 3, "active_count": 1},
+    ]
+    assert client.get("/api/stats/authors", params={"limit": 1}).json() == [
+        {"author_id": 2, "name": "Austen", "borrow_count": 3, "active_count": 2},
+    ]
+
+
+def test_rejected_borrow_leaves_stats_unchanged(client: TestClient):
+    assert client.post("/api/borrow/", json={"book_id": 1, "user_id": 1, "is_done": False}).status_code == 200
+    assert client.post("/api/borrow/", json={"book_id": 1, "user_id": 2, "is_done": False}).status_code == 400
+
+    assert client.get("/api/stats/books/most-borrowed").json()[0]["borrow_count"] == 1
+
+
+def test_rebuild_matches_incremental_stats(client: TestClient, db: Session, engine):
+    circulate(client)
+    incremental = snapshot(client)
+
+    db.execute(text("UPDATE genre_stats SET borrow_count = 0, active_count = 7"))
+    db.execute(text("DELETE FROM book_stats"))
+    db.commit()
+    rebuild(engine)
+
+    assert snapshot(client) == incremental
+
+
+@pytest.mark.parametrize("path", ["books/most-borrowed", "genres", "authors"])
+def test_stats_pages_are_read_in_index_order(client: TestClient, read_engine, path):
+    circulate(client)
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append((statement, parameters))
+
+    event.listen(read_engine, "before_cursor_execute", record)
+    try:
+        client.get(f"/api/stats/{path}")
+    finally:
+        event.remove(read_engine, "before_cursor_execute", record)
+
+    statement, parameters = next(executed_pair for executed_pair in executed if "_stats" in executed_pair[0])
+    with read_engine.connect() as conn:
+        plan = [row[3] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+    assert any(re.match(r"SCAN \w+_stats USING (COVERING )?INDEX ix_", detail) for detail in plan)
+    assert not any("TEMP B-TREE" in detail for detail in plan)